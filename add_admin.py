@@ -47,11 +47,20 @@ def load_users():
         return {"admins": [], "operators": []}
 
 def save_users(data):
+    # временный файл + атомарная замена: запущенный бот не прочитает users.enc наполовину записанным
+    tmp_path = f"{USERS_FILE}.{os.getpid()}.tmp"
     try:
-        with open(USERS_FILE, "wb") as f:
+        with open(tmp_path, "wb") as f:
             f.write(fernet.encrypt(json.dumps(data).encode()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, USERS_FILE)
     except Exception:
         print("Ошибка при сохранении users.enc:\n", traceback.format_exc())
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
 
 # -----------------------
 # === Добавление администратора ===
@@ -0,0 +1,157 @@
+# bench_export.py — офлайн-бенчмарк экспорта участников
+# Изменения: прогон export_members_to_xlsx_and_send через синтетический клиент и заглушку send_document;
+# на каждый размер и формат — время, строк/с, пиковый RSS и размер файла
+# Изменения: --flood-wait — FloodWait на третьей странице участников (проверка продолжения скана после ожидания)
+#
+# Запуск из корня репозитория:
+#   python benchmarks/bench_export.py
+#   python benchmarks/bench_export.py --sizes 1000,10000 --formats xlsx,csv --json bench.json
+#   python benchmarks/bench_export.py --sizes 10000 --formats csv --flood-wait 3
+#
+# Каждый прогон идет в отдельном процессе (чистый RSS и холодный кэш участников), рабочая директория —
+# временная, поэтому users_data и .env репозитория не затрагиваются.
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+DEFAULT_FORMATS = ["xlsx", "csv", "csv.gz", "jsonl", "parquet"]
+
+
+def _prepare_env(workdir: str):
+    # config.py читает .env и пишет users_data относительно текущей директории
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "bench")
+    os.environ["METRICS_PORT"] = "0"
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+
+class StubBot:
+    def __init__(self):
+        self.sent_bytes = 0
+        self.messages = []
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        # document — InputFile поверх буфера экспорта
+        buf = getattr(document, "input_file_content", document)
+        buf.seek(0, os.SEEK_END)
+        self.sent_bytes = buf.tell()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append(text)
+
+
+class StubApp:
+    def __init__(self):
+        self.bot = StubBot()
+
+
+def _peak_rss_bytes() -> int:
+    # ru_maxrss: Linux — КиБ, macOS — байты
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_single(size: int, fmt: str, flood_wait: int = 0) -> dict:
+    from fake_telethon import FakeChat, FakeTelegramClient
+    from utils.export_utils import export_members_to_xlsx_and_send
+    from utils.export_writers import format_available
+
+    chat = FakeChat(channel_id=1000 + size % 997, title=f"bench {size}", size=size)
+    client = FakeTelegramClient([chat], flood_pages=(2,) if flood_wait else (), flood_seconds=flood_wait)
+    app = StubApp()
+    baseline_rss = _peak_rss_bytes()
+
+    started = time.perf_counter()
+    rows = asyncio.run(export_members_to_xlsx_and_send(client, chat.entity, 1, app, limit=0, fmt=fmt))
+    wall = time.perf_counter() - started
+
+    return {
+        "rows": size,
+        "format": fmt,
+        "effective_format": fmt if format_available(fmt) else "csv",
+        "exported": rows or 0,
+        "wall_seconds": round(wall, 3),
+        "rows_per_second": round((rows or 0) / wall) if wall > 0 else 0,
+        "peak_rss_mb": round(_peak_rss_bytes() / 2**20, 1),
+        "rss_growth_mb": round((_peak_rss_bytes() - baseline_rss) / 2**20, 1),
+        "output_bytes": app.bot.sent_bytes,
+        "messages": app.bot.messages,
+    }
+
+
+def _run_isolated(size: int, fmt: str, flood_wait: int = 0) -> dict:
+    workdir = tempfile.mkdtemp(prefix="scanbot-bench-")
+    try:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--single", str(size), fmt, "--workdir", workdir,
+             "--flood-wait", str(flood_wait)],
+            capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            return {"rows": size, "format": fmt, "error": proc.stderr.strip().splitlines()[-1:] or ["failed"]}
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _print_table(results: list):
+    header = f"{'rows':>9} {'format':<8} {'wall, s':>9} {'rows/s':>9} {'peak RSS, MB':>13} {'output, KB':>11}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print(f"{r['rows']:>9} {r['format']:<8} ERROR: {' '.join(r['error'])}")
+            continue
+        fmt = r["format"] if r["effective_format"] == r["format"] else f"{r['format']}*"
+        print(
+            f"{r['rows']:>9} {fmt:<8} {r['wall_seconds']:>9.2f} {r['rows_per_second']:>9} "
+            f"{r['peak_rss_mb']:>13.1f} {r['output_bytes'] / 1024:>11.0f}"
+        )
+    if any(r.get("effective_format") not in (None, r["format"]) for r in results):
+        print("* формат недоступен (нет зависимости) — измерен резервный CSV")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк экспорта участников")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="число участников через запятую")
+    parser.add_argument("--formats", default=",".join(DEFAULT_FORMATS), help="форматы через запятую")
+    parser.add_argument("--flood-wait", type=int, default=0, help="FloodWait (с) на третьей странице участников")
+    parser.add_argument("--json", dest="json_path", help="сохранить результаты в JSON")
+    parser.add_argument("--single", nargs=2, metavar=("SIZE", "FORMAT"), help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        _prepare_env(args.workdir)
+        print(json.dumps(run_single(int(args.single[0]), args.single[1], args.flood_wait), ensure_ascii=False))
+        return
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    formats = [f for f in args.formats.split(",") if f]
+    results = []
+    for size in sizes:
+        for fmt in formats:
+            result = _run_isolated(size, fmt, args.flood_wait)
+            results.append(result)
+            print(f"  {size} {fmt}: {result.get('wall_seconds', 'error')}", file=sys.stderr)
+    _print_table(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# fake_telethon.py — синтетический клиент Telethon для бенчмарков и нагрузочных прогонов
+# Изменения: генератор участников с реалистичными длинами имен, долей администраторов и пропущенными полями
+# Изменения: итератор участников устроен как RequestIter Telethon (страница в buffer, смещение после успешной страницы),
+# flood_pages — страницы, первый запрос которых получает FloodWaitError
+# Изменения: смещение запроса в requests.offset и отдельная инициализация (_init), как у итератора участников канала;
+# участники страницы генерируются по ее номеру — скан, продолженный со смещения, получает те же строки
+# Изменения: итератор участников — подкласс RequestIter: страницы загружаются в _load_next_chunk, перебор — __anext__ Telethon
+
+import random
+import asyncio
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+from telethon.errors import SessionPasswordNeededError, FloodWaitError
+from telethon.requestiter import RequestIter
+from telethon.tl.types import PeerChannel
+
+
+_LATIN = "abcdefghijklmnopqrstuvwxyz"
+_CYRILLIC = "абвгдеёжзийклмнопрстуфхцчшщыэюя"
+_BASE_TS = int(datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp())
+
+# Доли по умолчанию — примерно как в реальных группах: у большинства нет username/телефона, фамилия есть не у всех
+ADMIN_RATIO = 0.005
+USERNAME_RATIO = 0.6
+LAST_NAME_RATIO = 0.7
+PHONE_RATIO = 0.05
+
+
+def _word(rng: random.Random, lo: int, hi: int) -> str:
+    alphabet = _CYRILLIC if rng.random() < 0.6 else _LATIN
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(lo, hi))).capitalize()
+
+
+class FakeParticipant:
+    __slots__ = ("date",)
+
+    def __init__(self, date):
+        self.date = date
+
+
+class FakeUser:
+    __slots__ = ("id", "username", "first_name", "last_name", "phone", "participant")
+
+    def __init__(self, uid, username, first_name, last_name, phone, participant):
+        self.id = uid
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.phone = phone
+        self.participant = participant
+
+
+def make_user(rng: random.Random, uid: int) -> FakeUser:
+    username = None
+    if rng.random() < USERNAME_RATIO:
+        username = "".join(rng.choice(_LATIN + "_0123456789") for _ in range(rng.randint(5, 20)))
+    last_name = _word(rng, 4, 14) if rng.random() < LAST_NAME_RATIO else None
+    phone = f"79{rng.randint(0, 999999999):09d}" if rng.random() < PHONE_RATIO else None
+    joined = datetime.fromtimestamp(_BASE_TS + rng.randint(0, 5 * 365 * 86400), timezone.utc)
+    return FakeUser(uid, username, _word(rng, 3, 12), last_name, phone, FakeParticipant(joined))
+
+
+class FakeParticipantIter(RequestIter):
+    # как у Telethon: async-итератор с атрибутом total; страницы по 200 с паузой page_delay
+    PAGE_SIZE = 200
+
+    def __init__(self, chat, limit=None, page_delay: float = 0.0, flood_pages=(), flood_seconds: int = 0):
+        self.chat = chat
+        self.limit = min(limit, chat.size) if limit else chat.size
+        self.left = self.limit
+        self.total = chat.size
+        self.page_delay = page_delay
+        self.flood_pages = set(flood_pages)
+        self.flood_seconds = flood_seconds
+        self.kwargs = {}
+        self.requests = None
+        self.buffer = None
+        self.index = 0
+        self.wait_time = None
+        self.last_load = 0
+
+    async def _init(self):
+        await asyncio.sleep(self.page_delay)
+        self.requests = SimpleNamespace(offset=0)
+
+    async def _load_next_chunk(self):
+        # буфер уже сброшен RequestIter.__anext__; True — страниц больше нет
+        offset = self.requests.offset
+        if offset >= self.limit:
+            return True
+        await asyncio.sleep(self.page_delay)
+        page = offset // self.PAGE_SIZE
+        if page in self.flood_pages:
+            self.flood_pages.discard(page)
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        n = min(self.PAGE_SIZE, self.limit - offset)
+        rng = random.Random(self.chat.seed * 1_000_003 + page)
+        self.buffer = [make_user(rng, self.chat.first_uid + offset + i) for i in range(n)]
+        self.requests.offset += n
+
+
+class FakeChat:
+    def __init__(self, channel_id: int, title: str, size: int, seed: int = 0):
+        self.entity = PeerChannel(channel_id)
+        self.id = -1000000000000 - channel_id
+        self.title = title
+        self.size = size
+        self.seed = seed or channel_id
+        self.first_uid = channel_id * 10_000_000
+        self.is_group = True
+        self.is_channel = False
+
+    def admins(self) -> list:
+        # администраторы — детерминированная доля участников
+        rng = random.Random(self.seed)
+        step = max(1, int(1 / ADMIN_RATIO))
+        return [make_user(rng, self.first_uid + i) for i in range(0, self.size, step)]
+
+
+class FakeSession:
+    def save(self) -> str:
+        return "fake-session"
+
+
+class FakeTelegramClient:
+    # достаточно методов для полного flow бота: вход (с 2FA), список чатов и экспорт участников;
+    # latency — задержка каждого «сетевого» вызова
+    def __init__(self, chats: list, latency: float = 0.0, password: str = None, page_delay: float = 0.0,
+                 flood_pages=(), flood_seconds: int = 0):
+        self.chats = {c.entity.channel_id: c for c in chats}
+        self.latency = latency
+        self.password = password
+        self.page_delay = page_delay
+        self.flood_pages = flood_pages
+        self.flood_seconds = flood_seconds
+        self.session = FakeSession()
+        self._connected = False
+
+    async def _net(self):
+        await asyncio.sleep(self.latency)
+
+    async def connect(self):
+        await self._net()
+        self._connected = True
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def disconnect(self):
+        self._connected = False
+
+    async def send_code_request(self, phone):
+        await self._net()
+        return SimpleNamespace(phone_code_hash="fake-hash")
+
+    async def sign_in(self, phone=None, code=None, password=None, phone_code_hash=None):
+        await self._net()
+        if password is None and self.password:
+            raise SessionPasswordNeededError(request=None)
+        return True
+
+    async def iter_dialogs(self, **kwargs):
+        await self._net()
+        for chat in self.chats.values():
+            yield chat
+
+    def _chat(self, entity) -> FakeChat:
+        return self.chats[getattr(entity, "channel_id", None)]
+
+    async def get_participants(self, entity, filter=None, **kwargs):
+        await self._net()
+        return self._chat(entity).admins()
+
+    def iter_participants(self, entity, limit=None, filter=None, **kwargs):
+        return FakeParticipantIter(self._chat(entity), limit, self.page_delay, self.flood_pages, self.flood_seconds)
@@ -0,0 +1,481 @@
+# load_harness.py — нагрузочный стенд: N операторов одновременно проходят полный сценарий сканирования
+# Изменения: Application бота (build_application из main.py) работает против локальной заглушки Bot API
+# (getUpdates/sendMessage/sendDocument/...) и синтетического Telethon; на выходе — p50/p95/p99 задержки ответа и пропускная способность
+# Изменения: --enforce-limits — заглушка отвечает 429 (retry_after) при превышении лимитов Telegram, как настоящий Bot API;
+# --no-rate-limiter — прогон без лимитера исходящих запросов для сравнения
+# Изменения: --check-limiter — проверка лимитера против заглушки (приоритет ответа над статусом, пауза и повтор после 429)
+#
+# Запуск из корня репозитория:
+#   python benchmarks/load_harness.py --operators 50 --members 2000 --telethon-latency 0.05
+#   python benchmarks/load_harness.py --operators 50 --enforce-limits [--no-rate-limiter]
+#   python benchmarks/load_harness.py --check-limiter
+#
+# Сценарий каждого оператора: «Сканировать» → телефон → код → пароль 2FA → выбор чата кнопкой → файл → «Отмена».
+# Задержка шага — от отправки update в очередь getUpdates до первого ответа бота этому оператору.
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+from collections import deque
+from urllib.parse import parse_qs
+from email.parser import BytesParser
+from email.policy import HTTP
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_ID = 777000
+TOKEN = "777000:load-harness"
+
+# лимиты заглушки в режиме --enforce-limits: сообщений в чат и всего за скользящую секунду
+# (в чат — 1 в секунду плюс короткий всплеск, как описывает Telegram)
+API_CHAT_PER_SECOND = 4
+API_GLOBAL_PER_SECOND = 30
+_SENDING_PREFIXES = ("send", "edit", "copy", "forward")
+_LIMITED_PREFIXES = _SENDING_PREFIXES + ("delete",)
+
+
+# -----------------------
+# === Заглушка Bot API ===
+# -----------------------
+class FakeBotApi:
+    # минимальный HTTP/1.1 сервер (keep-alive) с методами, которые использует бот
+    def __init__(self, enforce_limits: bool = False):
+        self.enforce_limits = enforce_limits
+        self.sent_global = deque()
+        self.sent_chat = {}  # chat_id -> deque времени отправки
+        self.rejected = {}  # method -> число ответов 429
+        self.reject_next = 0  # столько следующих отправок получат 429 независимо от лимитов (--check-limiter)
+        self.retry_after = 1
+        self.updates = []
+        self.update_id = 0
+        self.message_id = 0
+        self.new_update = asyncio.Event()
+        self.listeners = {}  # chat_id -> asyncio.Queue событий (method, params, ts)
+        self.calls = {}
+        self.server = None
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+
+    # --- входящие update'ы ---
+    def push_update(self, payload: dict):
+        self.update_id += 1
+        payload["update_id"] = self.update_id
+        self.updates.append(payload)
+        self.new_update.set()
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)
+
+    # --- исходящие вызовы бота ---
+    def _message(self, chat_id, **extra) -> dict:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id, "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "scanbot"},
+            **extra,
+        }
+
+    def _over_limit(self, method: str, chat_id) -> bool:
+        # скользящее окно в 1 с: в чат учитываются отправка и правка сообщений, в общий лимит — и удаление
+        if not method.startswith(_LIMITED_PREFIXES):
+            return False
+        now = time.monotonic()
+        windows = [self.sent_global]
+        if chat_id is not None and method.startswith(_SENDING_PREFIXES):
+            windows.append(self.sent_chat.setdefault(int(chat_id), deque()))
+        for window in windows:
+            while window and window[0] <= now - 1:
+                window.popleft()
+        if len(self.sent_global) >= API_GLOBAL_PER_SECOND or (len(windows) > 1 and len(windows[1]) >= API_CHAT_PER_SECOND):
+            return True
+        for window in windows:
+            window.append(now)
+        return False
+
+    def _forced_reject(self, method: str) -> bool:
+        if self.reject_next and method.startswith(_SENDING_PREFIXES):
+            self.reject_next -= 1
+            return True
+        return False
+
+    async def _call(self, method: str, params: dict):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "scanbot", "username": "scanbot_load_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            queue = self.listeners.get(int(chat_id))
+            if queue is not None:
+                queue.put_nowait((method, params, time.perf_counter()))
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            return self._message(chat_id or 0, text=params.get("text", ""))
+        if method == "sendDocument":
+            return self._message(chat_id, document={"file_id": "doc", "file_unique_id": "doc"})
+        return True
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                method = request_line.split()[1].decode().rstrip("/").rsplit("/", 1)[-1]
+                params = _parse_params(headers.get("content-type", ""), body)
+                if self._forced_reject(method) or (self.enforce_limits and self._over_limit(method, params.get("chat_id"))):
+                    self.rejected[method] = self.rejected.get(method, 0) + 1
+                    status = b"429 Too Many Requests"
+                    payload = json.dumps({"ok": False, "error_code": 429,
+                                          "description": f"Too Many Requests: retry after {self.retry_after}",
+                                          "parameters": {"retry_after": self.retry_after}}).encode()
+                else:
+                    status = b"200 OK"
+                    payload = json.dumps({"ok": True, "result": await self._call(method, params)}).encode()
+                writer.write(
+                    b"HTTP/1.1 " + status + b"\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # CancelledError — незавершенный long poll getUpdates при остановке стенда
+            pass
+        finally:
+            writer.close()
+
+
+def _parse_params(content_type: str, body: bytes) -> dict:
+    # PTB отправляет form-urlencoded/JSON, файлы — multipart; сложные значения закодированы как JSON-строки
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        params = {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                params[name] = {"filename": part.get_filename(), "size": len(part.get_payload(decode=True) or b"")}
+            else:
+                params[name] = part.get_content().strip()
+        return params
+    return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+
+# -----------------------
+# === Оператор ===
+# -----------------------
+class Operator:
+    def __init__(self, api: FakeBotApi, user_id: int, step_timeout: float):
+        self.api = api
+        self.user_id = user_id
+        self.step_timeout = step_timeout
+        self.events = asyncio.Queue()
+        api.listeners[user_id] = self.events
+        self.latencies = {}
+        self.message_seq = 0
+
+    def _user(self) -> dict:
+        return {"id": self.user_id, "is_bot": False, "first_name": f"op{self.user_id}"}
+
+    def send_text(self, text: str):
+        self.message_seq += 1
+        self.api.push_update({"message": {
+            "message_id": self.message_seq, "date": int(time.time()), "text": text,
+            "chat": {"id": self.user_id, "type": "private"}, "from": self._user(),
+        }})
+
+    def press(self, data: str):
+        self.api.push_update({"callback_query": {
+            "id": f"{self.user_id}-{self.message_seq}", "from": self._user(), "chat_instance": str(self.user_id),
+            "data": data, "message": {
+                "message_id": 1, "date": int(time.time()), "text": "chats",
+                "chat": {"id": self.user_id, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "scanbot"},
+            },
+        }})
+
+    async def wait_for(self, predicate):
+        deadline = time.perf_counter() + self.step_timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError("нет ответа бота")
+            method, params, ts = await asyncio.wait_for(self.events.get(), remaining)
+            if predicate(method, params):
+                return params, ts
+
+    async def step(self, name: str, action, predicate):
+        # сбрасываем хвост ответов предыдущего шага, чтобы задержка считалась от нового update
+        while not self.events.empty():
+            self.events.get_nowait()
+        started = time.perf_counter()
+        action()
+        params, ts = await self.wait_for(predicate)
+        self.latencies.setdefault(name, []).append(ts - started)
+        return params
+
+    async def run_flow(self, password: str):
+        is_reply = lambda m, p: m == "sendMessage"
+        await self.step("scan", lambda: self.send_text("Сканировать"), is_reply)
+        await self.step("phone", lambda: self.send_text(f"+7999{self.user_id:07d}"), is_reply)
+        await self.wait_for(lambda m, p: m == "sendMessage" and "Код подтверждения отправлен" in p.get("text", ""))
+        await self.step("code", lambda: self.send_text("12345"), is_reply)
+        params = await self.step(
+            "password", lambda: self.send_text(password),
+            lambda m, p: m == "sendMessage" and "chat:" in str(p.get("reply_markup", "")),
+        )
+        markup = params["reply_markup"]
+        markup = json.loads(markup) if isinstance(markup, str) else markup
+        chat_buttons = [b["callback_data"] for row in markup["inline_keyboard"] for b in row
+                        if b.get("callback_data", "").startswith("chat:")]
+        picked = time.perf_counter()
+        await self.step("pick", lambda: self.press(random.choice(chat_buttons)), lambda m, p: m == "editMessageText")
+        # файл приходит из фоновой задачи scan_scheduler: сквозная задержка — от нажатия кнопки до sendDocument
+        _, ts = await self.wait_for(lambda m, p: m == "sendDocument")
+        self.latencies.setdefault("export", []).append(ts - picked)
+        await self.step("cancel", lambda: self.send_text("Отмена"), is_reply)
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+# -----------------------
+# === Прогон ===
+# -----------------------
+async def run(args) -> dict:
+    from telegram.ext import ApplicationBuilder
+    from fake_telethon import FakeChat, FakeTelegramClient
+    import main as bot_main
+    import utils.telethon_client as telethon_client
+    import utils.message_handlers as message_handlers
+    from utils.user_management import role_store
+
+    password = "2fa-secret"
+    chats = [FakeChat(channel_id=100 + i, title=f"Load chat {i}", size=args.members) for i in range(args.chats)]
+
+    def _fake_client(session_key: str):
+        return FakeTelegramClient(chats, latency=args.telethon_latency, password=password, page_delay=args.telethon_latency)
+
+    # слой Telethon подменяется синтетическим клиентом, весь остальной код бота — настоящий
+    telethon_client.new_client = _fake_client
+    message_handlers.new_client = _fake_client
+
+    api = FakeBotApi(enforce_limits=args.enforce_limits)
+    port = await api.start()
+    builder = (
+        ApplicationBuilder().token(TOKEN)
+        .base_url(f"http://127.0.0.1:{port}/bot")
+        .base_file_url(f"http://127.0.0.1:{port}/file/bot")
+        .connection_pool_size(args.pool_size)
+        .get_updates_connection_pool_size(2)
+    )
+    options = {}
+    if args.concurrent_updates is not None:
+        options["concurrent_updates"] = args.concurrent_updates
+    if args.no_rate_limiter:
+        options["rate_limiter"] = None
+    app = bot_main.build_application(builder, **options)
+
+    operators = [Operator(api, 5_000_000 + i, args.step_timeout) for i in range(args.operators)]
+    for op in operators:
+        role_store.operators[op.user_id] = None
+
+    failures = []
+    async with app:
+        await app.post_init(app)
+        await app.start()
+        await app.updater.start_polling(poll_interval=0, timeout=10)
+        started = time.perf_counter()
+
+        async def _one(op: Operator):
+            await asyncio.sleep(random.uniform(0, args.ramp_up))
+            try:
+                await op.run_flow(password)
+            except Exception as e:
+                failures.append(f"{op.user_id}: {type(e).__name__}: {e}")
+
+        await asyncio.gather(*(_one(op) for op in operators))
+        elapsed = time.perf_counter() - started
+        await app.updater.stop()
+        await app.stop()
+    await api.stop()
+
+    steps = {}
+    for op in operators:
+        for name, values in op.latencies.items():
+            steps.setdefault(name, []).extend(values)
+    replies = [v for name, values in steps.items() if name != "export" for v in values]
+    completed = args.operators - len(failures)
+    return {
+        "operators": args.operators,
+        "completed": completed,
+        "failures": failures[:10],
+        "elapsed_seconds": round(elapsed, 3),
+        "flows_per_second": round(completed / elapsed, 3) if elapsed else 0,
+        "updates_per_second": round(api.update_id / elapsed, 1) if elapsed else 0,
+        "reply_latency_ms": {
+            "p50": round(_percentile(replies, 0.50) * 1000, 1),
+            "p95": round(_percentile(replies, 0.95) * 1000, 1),
+            "p99": round(_percentile(replies, 0.99) * 1000, 1),
+            "max": round(max(replies, default=0) * 1000, 1),
+        },
+        "steps_ms": {
+            name: {
+                "p50": round(_percentile(v, 0.50) * 1000, 1),
+                "p95": round(_percentile(v, 0.95) * 1000, 1),
+                "p99": round(_percentile(v, 0.99) * 1000, 1),
+                "mean": round(statistics.fmean(v) * 1000, 1),
+            }
+            for name, v in steps.items()
+        },
+        "bot_api_calls": api.calls,
+        "bot_api_429": api.rejected,
+    }
+
+
+# -----------------------
+# === Проверка лимитера ===
+# -----------------------
+async def check_limiter() -> list:
+    # PriorityRateLimiter против заглушки; возвращает список нарушений (пустой — проверка пройдена)
+    from telegram.ext import ExtBot
+    from utils.rate_limiter import PriorityRateLimiter, PRIORITY_PROGRESS
+
+    api = FakeBotApi()
+    port = await api.start()
+    chat_id = 4_000_001
+    events = api.listeners[chat_id] = asyncio.Queue()
+    limiter = PriorityRateLimiter(chat_per_second=2, chat_burst=1, max_retries=1)
+    bot = ExtBot(TOKEN, base_url=f"http://127.0.0.1:{port}/bot", rate_limiter=limiter)
+    errors = []
+    async with bot:
+        # первое сообщение забирает токен чата; правка статуса встает в очередь раньше ответа пользователю,
+        # но ответ (приоритет interactive) должен уйти первым
+        await bot.send_message(chat_id, "warm-up")
+        status = asyncio.create_task(
+            bot.edit_message_text("status", chat_id=chat_id, message_id=1, rate_limit_args=PRIORITY_PROGRESS)
+        )
+        await asyncio.sleep(0.05)
+        reply = asyncio.create_task(bot.send_message(chat_id, "reply"))
+        await asyncio.gather(status, reply)
+        order = []
+        while not events.empty():
+            method, params, _ = events.get_nowait()
+            order.append(params.get("text"))
+        if order != ["warm-up", "reply", "status"]:
+            errors.append(f"порядок отправки {order}, ожидался ['warm-up', 'reply', 'status']")
+
+        # 429: лимитер выдерживает retry_after и повторяет запрос, вызывающий код ошибки не видит
+        api.reject_next = 1
+        started = time.perf_counter()
+        try:
+            await bot.send_message(chat_id, "after 429")
+        except Exception as e:
+            errors.append(f"запрос после 429 не повторен: {type(e).__name__}: {e}")
+        elapsed = time.perf_counter() - started
+        if api.rejected.get("sendMessage") != 1:
+            errors.append(f"ответов 429 на sendMessage: {api.rejected.get('sendMessage')}, ожидался 1")
+        if elapsed < api.retry_after:
+            errors.append(f"повтор через {elapsed:.2f} с — раньше retry_after={api.retry_after} с")
+        delivered = []
+        while not events.empty():
+            delivered.append(events.get_nowait()[1].get("text"))
+        if delivered != ["after 429"]:
+            errors.append(f"после 429 доставлено {delivered}, ожидалось ['after 429']")
+    await api.stop()
+    return errors
+
+
+def _print_report(r: dict):
+    print(f"Операторов: {r['operators']}, завершили сценарий: {r['completed']}, время: {r['elapsed_seconds']} с")
+    print(f"Пропускная способность: {r['flows_per_second']} сценариев/с, {r['updates_per_second']} update/с")
+    lat = r["reply_latency_ms"]
+    print(f"Задержка ответа, мс: p50={lat['p50']} p95={lat['p95']} p99={lat['p99']} max={lat['max']}")
+    print(f"{'шаг':<10} {'p50':>9} {'p95':>9} {'p99':>9} {'mean':>9}")
+    for name, s in r["steps_ms"].items():
+        print(f"{name:<10} {s['p50']:>9} {s['p95']:>9} {s['p99']:>9} {s['mean']:>9}")
+    if r["bot_api_429"]:
+        print("Ответов 429:", ", ".join(f"{m}={n}" for m, n in sorted(r["bot_api_429"].items())))
+    for f in r["failures"]:
+        print("  ошибка:", f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд: одновременные операторы")
+    parser.add_argument("--operators", type=int, default=20)
+    parser.add_argument("--chats", type=int, default=5, help="чатов в каждом аккаунте")
+    parser.add_argument("--members", type=int, default=2000, help="участников в каждом чате")
+    parser.add_argument("--telethon-latency", type=float, default=0.02, help="задержка вызова Telethon, с")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="разброс старта операторов, с")
+    parser.add_argument("--step-timeout", type=float, default=120.0)
+    parser.add_argument("--pool-size", type=int, default=64, help="соединений HTTP к Bot API")
+    parser.add_argument("--concurrent-updates", type=int, default=None, help="по умолчанию — как в main.py; 0 — последовательно")
+    parser.add_argument("--enforce-limits", action="store_true", help="заглушка отвечает 429 при превышении лимитов Telegram")
+    parser.add_argument("--no-rate-limiter", action="store_true", help="собрать бота без лимитера исходящих запросов")
+    parser.add_argument("--json", dest="json_path", help="сохранить результаты в JSON")
+    parser.add_argument("--check-limiter", action="store_true", help="проверить лимитер против заглушки и выйти (код 1 при ошибке)")
+    args = parser.parse_args()
+
+    # рабочая директория — временная: users_data, хранилище сессий и кэш участников стенда не смешиваются с настоящими
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "load")
+    os.environ["METRICS_PORT"] = "0"
+    os.chdir(tempfile.mkdtemp(prefix="scanbot-load-"))
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+    if args.check_limiter:
+        errors = asyncio.run(check_limiter())
+        for e in errors:
+            print("  ошибка:", e)
+        print("Лимитер: проверка не пройдена" if errors else "Лимитер: приоритеты и повтор после 429 — OK")
+        sys.exit(1 if errors else 0)
+
+    result = asyncio.run(run(args))
+    _print_report(result)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
 # main.py — исправленная версия (рефакторинг)
 # Тихое игнорирование неавторизованных, предупреждение на /start, комментарии на русском.
 # Изменения: Рефакторинг на модульную структуру, основной код перенесен в отдельные файлы
+# Изменения: сборка Application вынесена в build_application (используется и нагрузочным стендом)
+# Изменения: незавершенные flow и сроки сессий восстанавливаются при старте и сохраняются при остановке (flow_store)
+# Изменения: config.GLOBAL_APP задается при сборке приложения (раньше ссылка оставалась None в других модулях)
+# Изменения: исходящие запросы к Bot API идут через общий лимитер с приоритетами (utils/rate_limiter.py)
+# Изменения: update разных пользователей обрабатываются параллельно, одного пользователя — по очереди
+# Изменения: задачи экспорта, прерванные остановкой или падением, после старта снова ставятся в очередь
+# Изменения: flow выбора чата восстанавливаются в фоне, post_init не ждет подключения их клиентов
 
-import os
 import time
 import asyncio
 
@@ -10,38 +16,85 @@ from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
+    CallbackQueryHandler,
     filters,
 )
 
-from utils.config import BOT_TOKEN, SESSIONS_DIR, GLOBAL_APP
+from utils import config
+from utils.config import BOT_TOKEN, UPDATE_CONCURRENCY
 from utils.command_handlers import start, cancel
-from utils.message_handlers import handle_message
+from utils.message_handlers import handle_message, resume_export
+from utils.callback_handlers import handle_callback
 from utils.background_tasks import session_and_pending_cleaner
+from utils.session_vault import session_vault, purge_legacy_session_files
+from utils.scan_jobs import scan_scheduler
 from utils.logging_utils import log_error
+from utils.metrics import start_metrics_server
+from utils.user_management import role_store
+from utils.flow_store import flow_store
+from utils.rate_limiter import outbound_limiter
+from utils.update_processor import PerUserUpdateProcessor
 
 
-# -----------------------
-# === Supervisor и запуск приложения ===
-# -----------------------
-def main():
-    global GLOBAL_APP
-    if not os.path.exists(SESSIONS_DIR):
-        os.makedirs(SESSIONS_DIR)
+async def _start_background_tasks(application):
+    # восстановление — до запуска планировщика истечения, чтобы сроки восстановленных записей сразу учитывались
+    try:
+        await flow_store.restore()
+    except Exception:
+        log_error("Не удалось восстановить flow и сессии:\n" + str(locals()))
+    try:
+        asyncio.create_task(session_and_pending_cleaner())
+        asyncio.create_task(flow_store.watch())
+        asyncio.create_task(role_store.watch())
+        scan_scheduler.start()
+        # клиенты и списки чатов восстанавливаемых flow и задач запрашиваются в фоне — запуск бота их не ждет
+        asyncio.create_task(flow_store.restore_chat_pickers())
+        asyncio.create_task(flow_store.resume_jobs(lambda spec, client, chats: resume_export(application, spec, client, chats)))
+    except Exception:
+        log_error("Не удалось запустить фоновые задачи:\n" + str(locals()))
+    try:
+        await start_metrics_server()
+    except Exception:
+        log_error("Не удалось запустить эндпоинт метрик:\n" + str(locals()))
+
+
+async def _save_state(application):
+    try:
+        await flow_store.flush()
+    except Exception:
+        log_error("Не удалось сохранить flow при остановке:\n" + str(locals()))
+
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    GLOBAL_APP = app
+def build_application(builder=None, rate_limiter=outbound_limiter, concurrent_updates=UPDATE_CONCURRENCY):
+    # обработчики и фоновые задачи; builder позволяет задать, например, другой base_url Bot API (нагрузочный стенд),
+    # rate_limiter=None отключает лимитер исходящих запросов, concurrent_updates=0 — последовательная обработка update
+    if builder is None:
+        builder = ApplicationBuilder().token(BOT_TOKEN)
+    if concurrent_updates:
+        # пока чат одного пользователя ждет лимитер, update остальных обрабатываются
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(concurrent_updates))
+    if rate_limiter is not None:
+        builder = builder.rate_limiter(rate_limiter)
+    app = builder.post_init(_start_background_tasks).post_shutdown(_save_state).build()
+    # ссылка для фоновых задач (удаление авторизационных сообщений)
+    config.GLOBAL_APP = app
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("cancel", cancel))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(CallbackQueryHandler(handle_callback))
+    return app
 
-    async def _start_background_tasks(application):
-        try:
-            asyncio.create_task(session_and_pending_cleaner())
-        except Exception:
-            log_error("Не удалось запустить фоновые задачи:\n" + str(locals()))
 
-    app.post_init = _start_background_tasks
+# -----------------------
+# === Supervisor и запуск приложения ===
+# -----------------------
+def main():
+    # сессии старого формата (SQLite-файлы) и просроченные записи хранилища не переживают перезапуск
+    purge_legacy_session_files()
+    session_vault.purge_expired()
+
+    app = build_application()
 
     # Цикл supervisor
     while True:
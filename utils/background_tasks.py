@@ -1,61 +1,107 @@
 # background_tasks.py — фоновые задачи
 # Изменения: вынесены функции фоновой очистки из main.py
+# Изменения: при истечении сессии закрывается клиент из пула и завершается связанный flow
+# Изменения: сессии удаляются из session_vault по ключу, без сканирования SESSIONS_DIR
+# Изменения: вместо опроса раз в 30 секунд — планировщик дедлайнов (expiry_scheduler)
+# Изменения: сессия с выполняющимся экспортом закрывается после его завершения
+# Изменения: flow пользователя — FlowState (utils/flow_state.py)
 
-import os
-import asyncio
 import time
 
-from utils.config import SESSIONS_DIR, SESSION_TTL_SECONDS
+from utils.config import SESSION_TTL_SECONDS, SESSION_EXPIRY_RETRY_SECONDS
 from utils.config import active_sessions, pending_action
 from utils.logging_utils import log_session, log_error
+from utils.client_pool import client_pool, release_client
+from utils.session_vault import session_vault
+from utils.expiry_scheduler import expiry_scheduler
+from utils.scan_jobs import scan_scheduler
+from utils.flow_state import FlowState, STATE_CHOOSE_CHAT
+
+
+# -----------------------
+# === Регистрация дедлайнов ===
+# -----------------------
+def track_session(session_key: str, owner: int, created: float = None):
+    created = created or time.time()
+    active_sessions[session_key] = {"created": created, "expiry": created + SESSION_TTL_SECONDS, "owner": owner}
+    expiry_scheduler.schedule(("session", session_key), created + SESSION_TTL_SECONDS)
+
+
+def track_pending(user_id: int):
+    # достаточно одного дедлайна на flow: при срабатывании он сверяется с актуальным start_time
+    pa = pending_action.get(user_id)
+    if pa is None:
+        return
+    expiry_scheduler.schedule(("pending", user_id), pa.start_time + SESSION_TTL_SECONDS)
+
+
+# -----------------------
+# === Обработчики истечения ===
+# -----------------------
+async def expire_session(session_key: str):
+    meta = active_sessions.get(session_key)
+    if meta is None:
+        return
+    deadline = meta.get("created", 0) + SESSION_TTL_SECONDS
+    if time.time() < deadline:
+        # сессию переиспользовали — срок сдвинулся
+        expiry_scheduler.schedule(("session", session_key), deadline)
+        return
+    owner = meta.get("owner")
+    if scan_scheduler.has_active(owner):
+        # клиент нужен выполняющемуся экспорту — проверим снова позже
+        expiry_scheduler.schedule(("session", session_key), time.time() + SESSION_EXPIRY_RETRY_SECONDS)
+        return
+    active_sessions.pop(session_key, None)
+    # сначала отключаем клиент, затем удаляем сессию из хранилища
+    await client_pool.close(session_key)
+    try:
+        if await session_vault.delete(session_key):
+            log_session(f"Удалена устаревшая сессия: {session_key}")
+    except Exception:
+        log_error("Не удалось удалить сессию в очистке:\n" + str(locals()))
+    # flow выбора чата владельца держал этот клиент — завершаем его
+    pa = pending_action.get(owner)
+    if pa is not None and pa.state == STATE_CHOOSE_CHAT and not client_pool.is_pooled(pa.client):
+        await _teardown_pending(owner, pa)
+
+
+async def expire_pending(user_id: int):
+    pa = pending_action.get(user_id)
+    if pa is None:
+        return
+    deadline = pa.start_time + SESSION_TTL_SECONDS
+    if time.time() < deadline:
+        expiry_scheduler.schedule(("pending", user_id), deadline)
+        return
+    await _teardown_pending(user_id, pa)
+
+
+async def _teardown_pending(user_id: int, pa: FlowState):
+    try:
+        await release_client(pa.client)
+    except Exception:
+        log_error("Ошибка отключения клиента во время очистки pending:\n" + str(locals()))
+    try:
+        from utils.message_cleanup import purge_auth_messages_for_user
+        await purge_auth_messages_for_user(user_id)
+    except Exception:
+        log_error("Не удалось очистить авторизационные сообщения во время очистки pending:\n" + str(locals()))
+    if pending_action.get(user_id) is pa:
+        pending_action.pop(user_id, None)
+
+
+async def _handle_expiry(key):
+    kind, ident = key
+    if kind == "session":
+        await expire_session(ident)
+    elif kind == "pending":
+        await expire_pending(ident)
 
 
 # -----------------------
 # === Фоновая очистка сессий и pending ===
 # -----------------------
 async def session_and_pending_cleaner():
-    global active_sessions, pending_action
-    while True:
-        now = time.time()
-        # Удаляем устаревшие сессии по времени создания
-        to_remove_sessions = []
-        for session_path, meta in list(active_sessions.items()):
-            created = meta.get("created", 0)
-            if now >= (created + SESSION_TTL_SECONDS):
-                session_base = os.path.splitext(session_path)[0]
-                try:
-                    for fname in os.listdir(SESSIONS_DIR):
-                        if fname.startswith(os.path.basename(session_base)):
-                            fpath = os.path.join(SESSIONS_DIR, fname)
-                            try:
-                                os.remove(fpath)
-                                log_session(f"Удален устаревший файл сессии: {fpath}")
-                            except Exception:
-                                log_error("Не удалось удалить файл сессии в очистке:\n" + str(locals()))
-                except Exception:
-                    log_error("Ошибка сканирования директории сессий в очистке:\n" + str(locals()))
-                to_remove_sessions.append(session_path)
-        for p in to_remove_sessions:
-            active_sessions.pop(p, None)
-
-        # Очищаем зависшие pending flows старше TTL
-        stale_users = []
-        for uid, pa in list(pending_action.items()):
-            start = pa.get("start_time")
-            if start and (now - start) > SESSION_TTL_SECONDS:
-                client = pa.get("client")
-                try:
-                    if client:
-                        await client.disconnect()
-                except Exception:
-                    log_error("Ошибка отключения клиента во время очистки pending:\n" + str(locals()))
-                try:
-                    from utils.message_cleanup import purge_auth_messages_for_user
-                    await purge_auth_messages_for_user(uid)
-                except Exception:
-                    log_error("Не удалось очистить авторизационные сообщения во время очистки pending:\n" + str(locals()))
-                stale_users.append(uid)
-        for uid in stale_users:
-            pending_action.pop(uid, None)
-
-        await asyncio.sleep(30)
+    # просыпается к ближайшему дедлайну; закрытие многих истекших записей идет параллельно с ограничением
+    await expiry_scheduler.run(_handle_expiry)
@@ -0,0 +1,77 @@
+# cache_utils.py — кэши в памяти
+# Изменения: TTL-кэш с ограничением размера (LRU-вытеснение)
+# Изменения: single-flight — одновременные запросы по одному ключу обслуживаются одной задачей
+
+import time
+import asyncio
+from collections import OrderedDict
+
+
+class TTLCache:
+    # Записи живут ttl секунд; при переполнении вытесняется давно не использованная запись
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()  # key -> (expiry, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expiry, value = item
+        if time.monotonic() >= expiry:
+            self._data.pop(key, None)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        expiry = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expiry, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def __contains__(self, key):
+        return self.get(key, None) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight:
+    # Пока задача по ключу выполняется, новые вызовы ждут ее результат, а не запускают свою.
+    # Задача отменяется, только если от нее отказались все ожидающие.
+    def __init__(self):
+        self._flights = {}  # key -> [task, waiters]
+
+    async def run(self, key, factory):
+        flight = self._flights.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(factory())
+            flight = [task, 0]
+            self._flights[key] = flight
+            task.add_done_callback(lambda t, k=key: self._done(k, t))
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        except asyncio.CancelledError:
+            if not flight[0].done() and flight[1] == 1:
+                flight[0].cancel()
+                # новый вызов (например, повторный скан сразу после отмены) запускает свою задачу, а не ждет отменяемую
+                self._done(key, flight[0])
+            raise
+        finally:
+            flight[1] -= 1
+
+    def _done(self, key, task):
+        flight = self._flights.get(key)
+        if flight is not None and flight[0] is task:
+            self._flights.pop(key, None)
+
+    def in_flight(self, key) -> bool:
+        return key in self._flights
@@ -0,0 +1,156 @@
+# callback_handlers.py — обработчики нажатий inline-кнопок
+# Изменения: выбор чата и листание списка чатов по callback_data с dialog_id
+# Изменения: кнопка Отмена в статусе экспорта прерывает конкретное сканирование
+# Изменения: выбор формата файла экспорта кнопками под списком чатов
+# Изменения: пакетный режим — отметка нескольких чатов, выбор упаковки и запуск одной задачи
+# Изменения: состояние выбора чата читается из FlowState
+
+import traceback
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from utils.config import pending_action, BATCH_MAX_CHATS
+from utils.user_management import get_user_role
+from utils.ui_utils import chat_picker_keyboard, send_main_menu
+from utils.ui_utils import CB_CHAT, CB_CHATS_PAGE, CB_CHATS_FORMAT, CB_CHATS_CANCEL, CB_CHATS_BATCH, CB_CHATS_BUNDLE, CB_CHATS_RUN
+from utils.export_writers import format_available
+from utils.export_utils import BUNDLE_WORKBOOK, BUNDLE_ZIP
+from utils.logging_utils import log_wrong_access, log_error
+from utils.message_handlers import cancel_flow, reply_cancelled, export_selected_chat, export_selected_chats
+from utils.progress import CB_SCAN_CANCEL
+from utils.scan_jobs import scan_scheduler
+from utils.flow_state import FlowState, STATE_CHOOSE_CHAT
+
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    if get_user_role(user_id) is None:
+        log_wrong_access(user_id, f"Неавторизованное нажатие кнопки: {(query.data or '')[:200]}")
+        return
+
+    data = query.data or ""
+    try:
+        await query.answer()
+    except Exception:
+        log_error("Не удалось ответить на callback:\n" + traceback.format_exc())
+
+    if data.startswith(CB_SCAN_CANCEL):
+        try:
+            job_id = int(data[len(CB_SCAN_CANCEL):])
+        except ValueError:
+            return
+        # статус сообщения обновит сама задача при отмене
+        if not await scan_scheduler.cancel(user_id, job_id):
+            try:
+                await query.edit_message_reply_markup(reply_markup=None)
+            except Exception:
+                log_error("Не удалось убрать кнопку отмены сканирования:\n" + traceback.format_exc())
+        return
+
+    if data == CB_CHATS_CANCEL:
+        try:
+            await query.edit_message_reply_markup(reply_markup=None)
+        except Exception:
+            log_error("Не удалось убрать клавиатуру выбора чата:\n" + traceback.format_exc())
+        await reply_cancelled(update, await cancel_flow(user_id))
+        await send_main_menu(update, user_id)
+        return
+
+    action = pending_action.get(user_id)
+    if action is None or action.state != STATE_CHOOSE_CHAT:
+        try:
+            await query.edit_message_text("Список чатов устарел. Начните сканирование заново.")
+        except Exception:
+            log_error("Не удалось отметить устаревший список чатов:\n" + traceback.format_exc())
+        return
+    chats = action.chats
+
+    if data.startswith(CB_CHATS_PAGE):
+        try:
+            action.page = int(data[len(CB_CHATS_PAGE):])
+        except ValueError:
+            return
+        await _refresh_picker(query, action)
+        return
+
+    if data.startswith(CB_CHATS_FORMAT):
+        fmt = data[len(CB_CHATS_FORMAT):]
+        if not format_available(fmt) or fmt == action.format:
+            return
+        action.format = fmt
+        await _refresh_picker(query, action)
+        return
+
+    if data == CB_CHATS_BATCH:
+        # переключение между выбором одного чата и пакетным режимом
+        if action.selected is None:
+            action.selected = []
+            if action.bundle is None:
+                action.bundle = BUNDLE_WORKBOOK if format_available("xlsx") else BUNDLE_ZIP
+        else:
+            action.selected = None
+        await _refresh_picker(query, action)
+        return
+
+    if data.startswith(CB_CHATS_BUNDLE):
+        bundle = data[len(CB_CHATS_BUNDLE):]
+        if bundle not in (BUNDLE_WORKBOOK, BUNDLE_ZIP) or bundle == action.bundle:
+            return
+        action.bundle = bundle
+        await _refresh_picker(query, action)
+        return
+
+    if data == CB_CHATS_RUN:
+        selected = [chats.get(i) for i in action.selected or []]
+        selected = [c for c in selected if c is not None]
+        if not selected:
+            # кнопка показывает счетчик «(0)» — пустой пакет просто не запускаем
+            return
+        try:
+            await query.edit_message_text("Выбраны чаты:\n" + "\n".join(c["title"] for c in selected))
+        except Exception:
+            log_error("Не удалось отметить выбранные чаты:\n" + traceback.format_exc())
+        action.selected = []
+        await export_selected_chats(update, context, selected, action.bundle or BUNDLE_ZIP)
+        return
+
+    if data.startswith(CB_CHAT):
+        try:
+            chat = chats.get(int(data[len(CB_CHAT):]))
+        except ValueError:
+            chat = None
+        if chat is None:
+            try:
+                await query.edit_message_text("❌ Чат не найден. Начните сканирование заново.")
+            except Exception:
+                log_error("Не удалось ответить 'чат не найден' (callback):\n" + traceback.format_exc())
+            return
+        selected = action.selected
+        if selected is not None:
+            # пакетный режим: нажатие отмечает/снимает чат
+            if chat["id"] in selected:
+                selected.remove(chat["id"])
+            elif len(selected) >= BATCH_MAX_CHATS:
+                try:
+                    await query.message.reply_text(f"⚠️ Не больше {BATCH_MAX_CHATS} чатов в одном пакете.")
+                except Exception:
+                    log_error("Не удалось сообщить о лимите пакета:\n" + traceback.format_exc())
+                return
+            else:
+                selected.append(chat["id"])
+            await _refresh_picker(query, action)
+            return
+        try:
+            await query.edit_message_text(f"Выбран чат: {chat['title']}")
+        except Exception:
+            log_error("Не удалось отметить выбранный чат:\n" + traceback.format_exc())
+        await export_selected_chat(update, context, chat)
+
+
+async def _refresh_picker(query, action: FlowState):
+    try:
+        await query.edit_message_reply_markup(reply_markup=chat_picker_keyboard(action))
+    except Exception:
+        log_error("Не удалось обновить клавиатуру выбора чата:\n" + traceback.format_exc())
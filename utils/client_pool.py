@@ -0,0 +1,68 @@
+# client_pool.py — пул авторизованных клиентов Telethon
+# Изменения: клиент остается подключенным до истечения SESSION_TTL_SECONDS и переиспользуется между сканами
+# Изменения: число клиентов в пуле публикуется как метрика, время переподключения попадает в гистограмму этапов
+# Изменения: ключ сессии клиента из пула (session_key_of) — для сохранения задач экспорта
+
+import time
+
+from utils.logging_utils import log_session, log_error
+from utils.metrics import STAGE_SECONDS, register_gauge
+
+
+class ClientPool:
+    def __init__(self):
+        self._entries = {}  # session_key -> {"client": client, "expiry": ts, "owner": user_id}
+        self._keys = {}  # id(client) -> session_key
+
+    def put(self, session_key: str, client, expiry: float, owner: int):
+        old = self._entries.get(session_key)
+        if old is not None and old["client"] is not client:
+            self._keys.pop(id(old["client"]), None)
+        self._entries[session_key] = {"client": client, "expiry": expiry, "owner": owner}
+        self._keys[id(client)] = session_key
+
+    async def get(self, session_key: str):
+        entry = self._entries.get(session_key)
+        if entry is None or time.time() >= entry["expiry"]:
+            return None
+        client = entry["client"]
+        try:
+            if not client.is_connected():
+                with STAGE_SECONDS.time(stage="connect"):
+                    await client.connect()
+        except Exception:
+            log_error(f"Не удалось переподключить клиент из пула ({session_key}):\n" + str(locals()))
+            await self.close(session_key)
+            return None
+        return client
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_pooled(self, client) -> bool:
+        return client is not None and id(client) in self._keys
+
+    def session_key_of(self, client):
+        return self._keys.get(id(client)) if client is not None else None
+
+    async def close(self, session_key: str):
+        entry = self._entries.pop(session_key, None)
+        if entry is None:
+            return
+        self._keys.pop(id(entry["client"]), None)
+        try:
+            await entry["client"].disconnect()
+            log_session(f"Клиент из пула отключен ({session_key})")
+        except Exception:
+            log_error(f"Ошибка отключения клиента из пула ({session_key}):\n" + str(locals()))
+
+
+client_pool = ClientPool()
+register_gauge("scanbot_active_clients", "Подключенные клиенты Telethon в пуле", lambda: len(client_pool))
+
+
+async def release_client(client):
+    # клиенты из пула живут до истечения сессии; остальные (незавершенный логин) отключаем сразу
+    if client is None or client_pool.is_pooled(client):
+        return
+    await client.disconnect()
@@ -41,19 +41,6 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log_wrong_access(user_id, "Попытка использовать /cancel без доступа")
         return
 
-    from utils.config import pending_action
-    if user_id in pending_action:
-        client = pending_action[user_id].get("client")
-        try:
-            if client:
-                from telethon import TelegramClient
-                await client.disconnect()
-        except Exception:
-            log_error("Ошибка отключения клиента при отмене:\n" + traceback.format_exc())
-        try:
-            from utils.message_cleanup import purge_auth_messages_for_user
-            await purge_auth_messages_for_user(user_id)
-        except Exception:
-            log_error("Не удалось очистить авторизационные сообщения при отмене:\n" + traceback.format_exc())
-        pending_action.pop(user_id, None)
+    from utils.message_handlers import cancel_flow, reply_cancelled
+    await reply_cancelled(update, await cancel_flow(user_id))
     await send_main_menu(update, user_id)
@@ -38,8 +38,11 @@ if not BOT_TOKEN:
 # -----------------------
 USERS_FILE = "./users_data/users.enc"
 KEY_FILE = "./users_data/secret.key"
-SESSIONS_DIR = "./users_data/sessions"
+SESSIONS_DIR = "./users_data/sessions"  # только для удаления файлов сессий старого формата
+SESSIONS_VAULT_FILE = "./users_data/sessions.vault"
 LOG_DIR = "./users_data/logs"
+PARTICIPANTS_DB = "./users_data/participants.db"
+FLOWS_DB = "./users_data/flows.db"
 
 # -----------------------
 # === Временные структуры в памяти ===
@@ -50,12 +53,118 @@ GLOBAL_APP = None
 # TTL сессии (в секундах)
 SESSION_TTL_SECONDS = 15 * 60  # 15 минут
 
+# Через сколько повторить закрытие истекшей сессии, если ее клиент занят экспортом
+SESSION_EXPIRY_RETRY_SECONDS = 60
+
+# Сколько истекших сессий/flow закрываются одновременно
+EXPIRY_TEARDOWN_CONCURRENCY = 8
+
+# Как часто проверяется изменение users.enc на диске (например, через add_admin.py)
+USERS_RELOAD_INTERVAL_SECONDS = 5
+
+# Удаление авторизационных сообщений: максимум сообщений в одном deleteMessages (лимит Bot API)
+# и сколько запросов удаления идут одновременно
+DELETE_MESSAGES_CHUNK = 100
+CLEANUP_DELETE_CONCURRENCY = 4
+
+# Лимиты исходящих запросов к Bot API: на бота — в секунду с допустимым всплеском (в сумме не больше 30 за любую секунду),
+# в личный чат — в секунду с всплеском, в группу — в минуту; сколько раз запрос повторяется после 429 (RetryAfter)
+RATE_LIMIT_GLOBAL_PER_SECOND = 25
+RATE_LIMIT_GLOBAL_BURST = 5
+RATE_LIMIT_CHAT_PER_SECOND = 1
+RATE_LIMIT_CHAT_BURST = 3
+RATE_LIMIT_GROUP_PER_MINUTE = 20
+RATE_LIMIT_MAX_RETRIES = 3
+
+# Сколько update обрабатывается одновременно (update одного пользователя — всегда по очереди)
+UPDATE_CONCURRENCY = 64
+
+# Как часто изменившиеся flow и сроки сессий сохраняются на диск (переживают перезапуск бота)
+FLOW_SNAPSHOT_INTERVAL_SECONDS = 2
+
+# Кэш списка чатов аккаунта (на время жизни сессии) и максимум сессий в кэше
+DIALOGS_CACHE_MAX_SESSIONS = 64
+
+# -----------------------
+# === Экспорт участников ===
+# -----------------------
+# Максимальное число участников в одном экспорте (0 — без ограничения)
+try:
+    EXPORT_MEMBERS_LIMIT = max(0, int(os.getenv("EXPORT_MEMBERS_LIMIT", "0")))
+except Exception:
+    EXPORT_MEMBERS_LIMIT = 0
+
+# Число потоков для формирования файлов экспорта (вне event loop)
+try:
+    EXPORT_WORKERS = max(1, int(os.getenv("EXPORT_WORKERS", "2")))
+except Exception:
+    EXPORT_WORKERS = 2
+
+# Размер пачки строк, передаваемой в поток записи
+EXPORT_BATCH_SIZE = 500
+
+# Формат файла экспорта по умолчанию (xlsx, csv, csv.gz, jsonl, parquet); администратор может изменить его в боте
+DEFAULT_EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "xlsx")
+
+# Файл экспорта держится в памяти до этого размера, затем автоматически уходит во временный файл
+try:
+    EXPORT_SPOOL_MAX_BYTES = max(0, int(os.getenv("EXPORT_SPOOL_MAX_BYTES", str(8 * 1024 * 1024))))
+except Exception:
+    EXPORT_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+# Фоновые задачи сканирования: число воркеров, задач одного оператора одновременно
+# и общий бюджет памяти (оценка на задачу — буфер файла и пачки строк)
+try:
+    SCAN_WORKERS = max(1, int(os.getenv("SCAN_WORKERS", "4")))
+except Exception:
+    SCAN_WORKERS = 4
+SCAN_JOBS_PER_USER = 1
+SCAN_JOB_MEMORY_ESTIMATE = EXPORT_SPOOL_MAX_BYTES + 16 * 1024 * 1024
+try:
+    SCAN_MEMORY_BUDGET_BYTES = int(os.getenv("SCAN_MEMORY_BUDGET_BYTES", str(256 * 1024 * 1024)))
+except Exception:
+    SCAN_MEMORY_BUDGET_BYTES = 256 * 1024 * 1024
+
+# Пакетный экспорт: максимум чатов в одном пакете и сколько чатов одного клиента читаются одновременно
+BATCH_MAX_CHATS = 50
+BATCH_FETCH_CONCURRENCY = 3
+
+# Сообщение о ходе экспорта обновляется не чаще, чем раз в столько секунд
+PROGRESS_MIN_INTERVAL_SECONDS = 15
+
+# Кэш списка администраторов чата: время жизни записи и максимум чатов в кэше
+ADMIN_CACHE_TTL_SECONDS = 10 * 60  # 10 минут
+ADMIN_CACHE_MAX_CHATS = 256
+
+# Локальный кэш участников: снимок моложе FRESH используется без запросов к Telegram,
+# старше — догружаются только новые участники; раз в FULL_REFRESH снимок перечитывается целиком
+PARTICIPANTS_CACHE_FRESH_SECONDS = 5 * 60  # 5 минут
+PARTICIPANTS_FULL_REFRESH_SECONDS = 24 * 60 * 60  # сутки
+# Прерванный полный проход продолжается с checkpoint'а, если тот не старше этого (иначе состав чата мог заметно измениться)
+SCAN_CHECKPOINT_MAX_AGE_SECONDS = 60 * 60  # час
+
+# FloodWait Telethon: ожидание до FLOOD_WAIT_MAX_SECONDS выдерживается и запрос повторяется (скан продолжается
+# с той же страницы), более долгое — ошибка скана; после FloodWait запросы аккаунта идут с паузой, которая
+# удваивается на каждый новый FloodWait (от BASE до MAX) и уменьшается в DECAY раз после каждого успешного запроса
+FLOOD_WAIT_MAX_SECONDS = 15 * 60  # 15 минут
+FLOOD_PACE_BASE_SECONDS = 0.5
+FLOOD_PACE_MAX_SECONDS = 5
+FLOOD_PACE_DECAY = 0.9
+
+# Метрики в формате Prometheus: эндпоинт /metrics слушает только локальный адрес, 0 — отключен
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+try:
+    METRICS_PORT = max(0, int(os.getenv("METRICS_PORT", "9108")))
+except Exception:
+    METRICS_PORT = 9108
+
 # -----------------------
 # === Глобальные переменные ===
 # -----------------------
 # словарь текущих flow для пользователей
-pending_action = {}  # словарь текущих flow для пользователей
+pending_action = {}  # user_id -> FlowState (utils/flow_state.py)
 # active_sessions: map session_key -> {"created": ts, "expiry": ts, "owner": user_id}
+# session_key — "session_<sha256 телефона>", ключ в хранилище сессий (session_vault)
 active_sessions = {}
 
 # -----------------------
@@ -65,7 +174,11 @@ LABEL_ADD_ADMIN = "➕ Добавить администратора"
 LABEL_ADD_OPERATOR = "➕ Добавить оператора"
 LABEL_REMOVE_OPERATOR = "➖ Удалить оператора"
 LABEL_LIST_OPERATORS = "📋 Список операторов"
+LABEL_EXPORT_FORMAT = "🗂 Формат экспорта"
 LABEL_SCAN = "Сканировать"
 LABEL_CANCEL = "Отмена"
 
+# Число чатов на одной странице выбора
+CHATS_PAGE_SIZE = 10
+
 WARNING_TEXT = "⚠️ Внимание! Использование аккаунта Telegram для сканирования чатов может привести к его блокировке. Вы используете это на свой риск."
@@ -0,0 +1,78 @@
+# expiry_scheduler.py — планировщик истечения сроков по дедлайнам
+# Изменения: куча дедлайнов вместо опроса раз в 30 секунд; просыпается ровно к ближайшему дедлайну
+
+import time
+import heapq
+import asyncio
+import itertools
+
+from utils.config import EXPIRY_TEARDOWN_CONCURRENCY
+from utils.logging_utils import log_error
+
+
+class ExpiryScheduler:
+    # schedule/cancel — O(log n)/O(1); отмененные и перенесенные записи удаляются из кучи лениво
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self._heap = []  # (deadline, seq, key)
+        self._current = {}  # key -> seq актуальной записи в куче
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._tasks = set()
+
+    def schedule(self, key, deadline: float):
+        seq = next(self._seq)
+        self._current[key] = seq
+        heapq.heappush(self._heap, (deadline, seq, key))
+        if len(self._heap) > 2 * len(self._current) + 64:
+            self._compact()
+        # новый дедлайн раньше текущего ожидания — будим цикл
+        if self._wakeup is not None and self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        self._current.pop(key, None)
+
+    def _compact(self):
+        self._heap = [item for item in self._heap if self._current.get(item[2]) == item[1]]
+        heapq.heapify(self._heap)
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, seq, key = heapq.heappop(self._heap)
+            if self._current.get(key) == seq:
+                del self._current[key]
+                due.append(key)
+        return due
+
+    async def run(self, handler):
+        # handler(key) вызывается для каждого истекшего ключа; одновременно не больше max_concurrency
+        self._wakeup = asyncio.Event()
+        sem = asyncio.Semaphore(self.max_concurrency)
+
+        async def _run_one(key):
+            async with sem:
+                try:
+                    await handler(key)
+                except Exception:
+                    log_error(f"Ошибка обработки истечения {key}:\n" + str(locals()))
+
+        while True:
+            due = self._pop_due(time.time())
+            for key in due:
+                task = asyncio.ensure_future(_run_one(key))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            self._wakeup.clear()
+            timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def __len__(self):
+        return len(self._current)
+
+
+expiry_scheduler = ExpiryScheduler(EXPIRY_TEARDOWN_CONCURRENCY)
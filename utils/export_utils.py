@@ -1,176 +1,427 @@
 # export_utils.py — функции экспорта участников
 # Изменения: вынесены функции экспорта участников из main.py
+# Изменения: потоковый экспорт — строки из iter_participants сразу пишутся в файл, без списка members в памяти
+# Изменения: запись и сохранение файла выполняются в пуле потоков, event loop только ждет результат
+# Изменения: файл собирается в SpooledTemporaryFile и отправляется из буфера, без файлов в рабочей директории
+# Изменения: буфер передается в send_document как InputFile с явным именем — PTB не читает его целиком в память
+# и не падает на безымянном SpooledTemporaryFile (name=None, пока файл не ушел на диск)
+# Изменения: список администраторов кэшируется по чату и запрашивается параллельно с перебором участников
+# Изменения: участники берутся из локального кэша (participants_cache), файл строится из снимка
+# Изменения: ход экспорта отображается через ExportProgress, отмена задачи корректно освобождает ресурсы
+# Изменения: длительность этапов admins/render/upload, число строк и отправленные байты пишутся в метрики
+# Изменения: writer'ы вынесены в export_writers, формат файла (XLSX/CSV/CSV.gz/JSONL/Parquet) выбирается на каждый скан
+# Изменения: пакетный экспорт нескольких чатов одним клиентом — одна книга с листом на чат или ZIP-архив
+# Изменения: администраторы запрашиваются через flood_governor, при долгом FloodWait оператор видит срок ожидания
+# Изменения: при отмене экспорта курсор и файл закрываются только после завершения шага, уже запущенного в потоке
 
-import os
+import io
 import re
 import time
-import csv
-from datetime import datetime
-
-
-# попытка импортировать openpyxl для создания xlsx
-try:
-    from openpyxl import Workbook
-    from openpyxl.utils import get_column_letter
-    OPENPYXL_AVAILABLE = True
-except Exception:
-    OPENPYXL_AVAILABLE = False
+import asyncio
+import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
+from telegram import InputFile
 from telethon.tl.types import ChannelParticipantsAdmins
+from telethon.utils import get_peer_id
+from utils.config import EXPORT_MEMBERS_LIMIT, EXPORT_WORKERS, EXPORT_BATCH_SIZE, EXPORT_SPOOL_MAX_BYTES
+from utils.config import ADMIN_CACHE_TTL_SECONDS, ADMIN_CACHE_MAX_CHATS, DEFAULT_EXPORT_FORMAT, BATCH_FETCH_CONCURRENCY
+from utils.cache_utils import TTLCache
+from utils.participants_cache import refresh_participants, participants_store
+from utils.export_writers import open_writer, format_available, format_label, EXPORT_FORMATS, XlsxWorkbookWriter
+from utils.user_management import role_store
 from utils.logging_utils import log_error
+from utils.metrics import STAGE_SECONDS, ROWS_EXPORTED, UPLOAD_BYTES, record_flood_wait
+from utils.flood_governor import flood_governor, flood_seconds
+
+
+# Пул потоков для формирования файлов: openpyxl/csv и файловый I/O не блокируют event loop
+EXPORT_EXECUTOR = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+
+async def run_in_export_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(EXPORT_EXECUTOR, func, *args)
+
+
+class ExportSteps:
+    # шаги одного экспорта в EXPORT_EXECUTOR; отмена await не останавливает функцию, уже запущенную в потоке,
+    # поэтому перед закрытием курсора и файла нужно дождаться ее завершения (settle)
+    def __init__(self):
+        self._pending = None
+
+    async def run(self, func, *args):
+        self._pending = EXPORT_EXECUTOR.submit(func, *args)
+        return await asyncio.wrap_future(self._pending)
+
+    async def settle(self):
+        if self._pending is not None and not self._pending.done():
+            await asyncio.wait({asyncio.wrap_future(self._pending)})
+
+
+# dialog_id -> set(admin_id); повторные сканы чата в пределах TTL не запрашивают администраторов
+admin_ids_cache = TTLCache(ADMIN_CACHE_TTL_SECONDS, ADMIN_CACHE_MAX_CHATS)
+
+
+async def fetch_admin_ids(client, entity, dialog_id) -> set:
+    cached = admin_ids_cache.get(dialog_id)
+    if cached is not None:
+        return cached
+    try:
+        with STAGE_SECONDS.time(stage="admins"):
+            admins = await flood_governor.call(client, "admins", client.get_participants, entity, filter=ChannelParticipantsAdmins())
+    except Exception as e:
+        record_flood_wait(e, "admins")
+        # ошибку не кэшируем: без прав на список админов все участники помечаются как User
+        return set()
+    admin_ids = frozenset(u.id for u in admins)
+    admin_ids_cache.set(dialog_id, admin_ids)
+    return admin_ids
+
+
+def fetch_error_text(exc) -> str:
+    # FloodWait дольше FLOOD_WAIT_MAX_SECONDS не выжидается — оператору сообщается, когда можно повторить
+    seconds = flood_seconds(exc)
+    if seconds is not None:
+        return f"❌ Telegram ограничил запросы этого аккаунта на {seconds // 60} мин {seconds % 60:02d} с. Повторите скан позже."
+    return "❌ Ошибка при получении участников."
 
 
 def safe_filename(s: str) -> str:
     return "".join(c if c.isalnum() or c in " _-()" else "_" for c in s)[:120]
 
 
-async def export_members_to_xlsx_and_send(client, dialog, requester_chat_id: int, bot_app):
-    members = []
+def member_row(record: tuple, admin_ids: set) -> list:
+    uid, username, fname, lname, phone, joined_ts = record
+    if username and not username.startswith("@"):
+        username = "@" + username
+    full_name = (fname + " " + lname).strip()
+    phone_display = normalize_phone(phone) if phone else ""
+    joined = ""
+    if joined_ts:
+        try:
+            joined = datetime.fromtimestamp(joined_ts, timezone.utc).strftime("%Y-%m-%d")
+        except Exception:
+            joined = str(joined_ts)
+
+    status = "Admin" if uid in admin_ids else "User"
+    return [uid, status, username, full_name, phone_display, joined]
+
+
+def _copy_snapshot_batch(cursor, writer, admin_ids) -> int:
+    # одна пачка: чтение из кэша, форматирование и запись в файл — целиком в потоке экспорта
+    records = cursor.fetchmany(EXPORT_BATCH_SIZE)
+    if records:
+        writer.write_rows([member_row(r, admin_ids) for r in records])
+    return len(records)
+
+
+def default_export_format() -> str:
+    # формат по умолчанию задает администратор (хранится в users.enc), иначе EXPORT_FORMAT из .env
+    return role_store.get_setting("export_format") or DEFAULT_EXPORT_FORMAT
+
+
+def _upload_file(out, filename: str) -> InputFile:
+    # read_file_handle=False: httpx читает буфер при отправке; имя файла задаем сами —
+    # у SpooledTemporaryFile в памяти name=None, и угадывание имени в PTB завершается TypeError
+    out.seek(0)
+    return InputFile(out, filename=filename, read_file_handle=False)
+
+
+def _open_writer(fmt: str):
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    try:
+        return open_writer(fmt, out)
+    except Exception:
+        out.close()
+        raise
+
+
+def _dialog_key(dialog):
+    # (entity, dialog_id) — dialog_id совпадает с ключом кэшей участников и администраторов
     try:
         entity = dialog.entity
     except Exception:
         entity = dialog
+    try:
+        dialog_id = get_peer_id(entity)
+    except Exception:
+        dialog_id = getattr(dialog, "id", int(time.time()))
+    return entity, dialog_id
+
 
+async def _notify(bot_app, chat_id: int, text: str):
     try:
-        admins = await client.get_participants(entity, filter=ChannelParticipantsAdmins())
-        admin_ids = {u.id for u in admins}
+        await bot_app.bot.send_message(chat_id=chat_id, text=text)
     except Exception:
-        admin_ids = set()
+        log_error("Не удалось отправить сообщение экспорта:\n" + str(locals()))
+
+
+async def export_members_to_xlsx_and_send(client, dialog, requester_chat_id: int, bot_app, limit: int = None, progress=None, fmt: str = None):
+    if limit is None:
+        limit = EXPORT_MEMBERS_LIMIT
+    if fmt is None:
+        fmt = default_export_format()
+
+    entity, dialog_id = _dialog_key(dialog)
+    ts = int(time.time())
+    base_filename = f"chat_members_{dialog_id}_{ts}"
 
-    cnt = 0
     try:
-        async for user in client.iter_participants(entity, limit=10):
-            uid = getattr(user, "id", "")
-            username = getattr(user, "username", "") or ""
-            if username and not username.startswith("@"):
-                username = "@" + username
-            fname = getattr(user, "first_name", "") or ""
-            lname = getattr(user, "last_name", "") or ""
-            full_name = (fname + " " + lname).strip()
-            phone = getattr(user, "phone", "") or ""
-            phone_display = normalize_phone(phone) if phone else ""  # Эта функция должна быть определена или импортирована
-            joined = ""
-            try:
-                part = getattr(user, "participant", None)
-                if part is not None:
-                    joined_attr = getattr(part, "date", None)
-                    if joined_attr:
-                        try:
-                            joined = joined_attr.strftime("%Y-%m-%d")
-                        except Exception:
-                            joined = str(joined_attr)
-            except Exception:
-                joined = ""
-
-            status = "Admin" if uid in admin_ids else "User"
-
-            members.append({
-                "TelegramID": uid,
-                "Status": status,
-                "Username": username,
-                "FullName": full_name,
-                "Phone": phone_display,
-                "JoinedDate": joined
-            })
-            cnt += 1
-            if cnt >= 100:
-                break
+        writer, notice = await run_in_export_executor(_open_writer, fmt)
     except Exception:
-        log_error("Ошибка при переборе участников:\n" + str(locals()))
+        log_error("Не удалось создать файл экспорта:\n" + str(locals()))
         try:
-            await bot_app.bot.send_message(chat_id=requester_chat_id, text=f"❌ Ошибка при получении участников.")
+            await bot_app.bot.send_message(chat_id=requester_chat_id, text="❌ Ошибка при создании файла экспорта.")
         except Exception:
-            log_error("Не удалось уведомить пользователя об ошибке получения участников:\n" + str(locals()))
+            log_error("Не удалось уведомить об ошибке создания файла экспорта:\n" + str(locals()))
         return
 
-    if not members:
+    if notice:
         try:
-            await bot_app.bot.send_message(chat_id=requester_chat_id, text="(В выбранной группе нет участников)")
+            await bot_app.bot.send_message(chat_id=requester_chat_id, text=notice)
         except Exception:
-            log_error("Не удалось уведомить об отсутствии участников:\n" + str(locals()))
-        return
+            log_error("Не удалось уведомить о резервном формате:\n" + str(locals()))
 
-    dialog_id = getattr(dialog, "id", int(time.time()))
-    safe_title = safe_filename(getattr(dialog, "title", None) or getattr(dialog, "name", "") or str(dialog_id))
-    ts = int(time.time())
-    xlsx_filename = f"chat_members_{dialog_id}_{ts}.xlsx"
-    csv_fallback = f"chat_members_{dialog_id}_{ts}.csv"
+    # администраторы запрашиваются параллельно с участниками (или берутся из кэша)
+    admin_task = asyncio.ensure_future(fetch_admin_ids(client, entity, dialog_id))
 
-    if OPENPYXL_AVAILABLE:
+    cnt = 0
+    reader = None
+    steps = ExportSteps()
+    try:
         try:
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Members"
-
-            headers = ["TelegramID", "Status", "Username", "FullName", "Phone", "JoinedDate"]
-            ws.append(headers)
-
-            max_lens = [len(h) for h in headers]
-            for row in members:
-                row_values = [row["TelegramID"], row["Status"], row["Username"], row["FullName"], row["Phone"], row["JoinedDate"]]
-                ws.append(row_values)
-                for i, v in enumerate(row_values):
-                    s = "" if v is None else str(v)
-                    l = len(s)
-                    if l > max_lens[i]:
-                        max_lens[i] = l
-
-            for i, width in enumerate(max_lens, start=1):
-                col_letter = get_column_letter(i)
-                calc_width = min(max(8, int(width * 1.1) + 2), 80)
-                ws.column_dimensions[col_letter].width = calc_width
-
-            wb.save(xlsx_filename)
-            await bot_app.bot.send_document(chat_id=requester_chat_id, document=open(xlsx_filename, "rb"))
-        except Exception:
-            log_error("Создание/отправка XLSX не удалось:\n" + str(locals()))
+            snap = await refresh_participants(client, entity, dialog_id, limit, progress)
+            admin_ids = await admin_task
+            if progress is not None:
+                expected = snap["count"] if snap else None
+                progress.set_stage("write", min(expected, limit) if expected and limit else expected)
+            render_started = time.monotonic()
+            reader = await steps.run(participants_store.open_reader, dialog_id, limit)
+            while True:
+                n = await steps.run(_copy_snapshot_batch, reader[1], writer, admin_ids)
+                if not n:
+                    break
+                cnt += n
+                if progress is not None:
+                    progress.update(cnt)
+        except Exception as e:
+            log_error("Ошибка при переборе участников:\n" + str(locals()))
             try:
-                await bot_app.bot.send_message(chat_id=requester_chat_id, text="⚠️ XLSX не удалось, резервный вариант — CSV.")
+                await bot_app.bot.send_message(chat_id=requester_chat_id, text=fetch_error_text(e))
             except Exception:
-                log_error("Не удалось уведомить о резервном варианте XLSX:\n" + str(locals()))
+                log_error("Не удалось уведомить пользователя об ошибке получения участников:\n" + str(locals()))
+            return
+
+        if not cnt:
             try:
-                with open(csv_fallback, "w", newline="", encoding="utf-8-sig") as csvfile:
-                    fieldnames = ["TelegramID", "Status", "Username", "FullName", "Phone", "JoinedDate"]
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=";", quoting=csv.QUOTE_ALL)
-                    writer.writeheader()
-                    for r in members:
-                        writer.writerow(r)
-                await bot_app.bot.send_document(chat_id=requester_chat_id, document=open(csv_fallback, "rb"))
+                await bot_app.bot.send_message(chat_id=requester_chat_id, text="(В выбранной группе нет участников)")
             except Exception:
-                log_error("Не удалось отправить резервный CSV:\n" + str(locals()))
-            finally:
-                try:
-                    if os.path.exists(csv_fallback):
-                        os.remove(csv_fallback)
-                except Exception:
-                    pass
-        finally:
+                log_error("Не удалось уведомить об отсутствии участников:\n" + str(locals()))
+            return
+
+        try:
+            await steps.run(writer.close)
+            STAGE_SECONDS.observe(time.monotonic() - render_started, stage="render")
+            ROWS_EXPORTED.inc(cnt)
+            if progress is not None:
+                progress.set_stage("upload")
+            size = writer.out.seek(0, io.SEEK_END)
+            document = _upload_file(writer.out, f"{base_filename}.{writer.extension}")
+            with STAGE_SECONDS.time(stage="upload"):
+                await bot_app.bot.send_document(chat_id=requester_chat_id, document=document)
+            UPLOAD_BYTES.inc(size)
+            return cnt
+        except Exception:
+            log_error(f"Создание/отправка {writer.extension.upper()} не удалось:\n" + str(locals()))
             try:
-                if os.path.exists(xlsx_filename):
-                    os.remove(xlsx_filename)
+                await bot_app.bot.send_message(chat_id=requester_chat_id, text="❌ Не удалось сформировать или отправить файл.")
             except Exception:
-                pass
-    else:
+                log_error("Не удалось уведомить об ошибке отправки файла:\n" + str(locals()))
+    finally:
+        if not admin_task.done():
+            admin_task.cancel()
+        await steps.settle()
+        if reader is not None:
+            await run_in_export_executor(reader[0].close)
+        await run_in_export_executor(_discard_writer, writer)
+
+
+# -----------------------
+# === Пакетный экспорт ===
+# -----------------------
+# Способ упаковки пакета: одна книга XLSX с листом на каждый чат или ZIP с файлом на чат в выбранном формате
+BUNDLE_WORKBOOK = "workbook"
+BUNDLE_ZIP = "zip"
+
+
+async def _fetch_for_batch(client, chat: dict, limit: int, sem: asyncio.Semaphore):
+    # участники попадают в кэш, файл потом строится из снимков по очереди
+    entity, dialog_id = _dialog_key(chat["dialog"])
+    async with sem:
+        admin_task = asyncio.ensure_future(fetch_admin_ids(client, entity, dialog_id))
+        try:
+            await refresh_participants(client, entity, dialog_id, limit)
+            return dialog_id, await admin_task
+        finally:
+            if not admin_task.done():
+                admin_task.cancel()
+
+
+def _open_bundle(bundle: str):
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    try:
+        if bundle == BUNDLE_WORKBOOK:
+            return out, XlsxWorkbookWriter(out)
+        return out, zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED)
+    except Exception:
+        out.close()
+        raise
+
+
+def _begin_chat(container, bundle: str, fmt: str, title: str, dialog_id: int):
+    # (writer, поток файла в архиве) для строк одного чата
+    if bundle == BUNDLE_WORKBOOK:
+        container.start_sheet(title)
+        return container, None
+    writer_cls = EXPORT_FORMATS[fmt][1]
+    info = zipfile.ZipInfo(f"{safe_filename(title)}_{dialog_id}.{writer_cls.extension}", time.localtime()[:6])
+    # XLSX, CSV.gz и Parquet уже сжаты — повторно не сжимаем
+    info.compress_type = zipfile.ZIP_STORED if fmt in ("xlsx", "csv.gz", "parquet") else zipfile.ZIP_DEFLATED
+    stream = container.open(info, "w", force_zip64=True)
+    try:
+        return writer_cls(stream), stream
+    except Exception:
+        stream.close()
+        raise
+
+
+def _end_chat(writer, stream):
+    if stream is None:
+        return
+    try:
+        writer.close()
+    finally:
+        stream.close()
+
+
+async def export_batch_and_send(client, chats: list, requester_chat_id: int, bot_app, bundle: str = BUNDLE_ZIP,
+                                fmt: str = None, limit: int = None, progress=None):
+    # чаты читаются параллельно (не больше BATCH_FETCH_CONCURRENCY на одном клиенте), файл собирается последовательно
+    if limit is None:
+        limit = EXPORT_MEMBERS_LIMIT
+    if fmt is None:
+        fmt = default_export_format()
+    if bundle == BUNDLE_WORKBOOK and not format_available("xlsx"):
+        await _notify(bot_app, requester_chat_id, "⚠️ 'openpyxl' не установлен — вместо книги XLSX будет ZIP-архив.")
+        bundle = BUNDLE_ZIP
+    if bundle == BUNDLE_ZIP and not format_available(fmt):
+        await _notify(bot_app, requester_chat_id, f"⚠️ {format_label(fmt)} недоступен — файлы в архиве будут в CSV.")
+        fmt = "csv"
+
+    if progress is not None:
+        progress.set_stage("fetch", len(chats), unit="Чатов")
+    sem = asyncio.Semaphore(BATCH_FETCH_CONCURRENCY)
+    fetched = 0
+
+    async def _fetch(chat):
+        nonlocal fetched
+        try:
+            return await _fetch_for_batch(client, chat, limit, sem)
+        finally:
+            fetched += 1
+            if progress is not None:
+                progress.update(fetched)
+
+    results = await asyncio.gather(*(_fetch(c) for c in chats), return_exceptions=True)
+    ready = []
+    failed = []
+    for chat, res in zip(chats, results):
+        if isinstance(res, asyncio.CancelledError):
+            raise res
+        if isinstance(res, BaseException):
+            log_error(f"Ошибка получения участников чата «{chat['title']}» (пакет):\n" + repr(res))
+            failed.append(chat["title"])
+        else:
+            ready.append((chat, *res))
+    if failed:
+        await _notify(bot_app, requester_chat_id, "❌ Не удалось получить участников:\n" + "\n".join(failed))
+    if not ready:
+        return None
+
+    try:
+        out, container = await run_in_export_executor(_open_bundle, bundle)
+    except Exception:
+        log_error("Не удалось создать файл пакетного экспорта:\n" + str(locals()))
+        await _notify(bot_app, requester_chat_id, "❌ Ошибка при создании файла экспорта.")
+        return None
+
+    total = 0
+    reader = None
+    steps = ExportSteps()
+    try:
+        try:
+            render_started = time.monotonic()
+            if progress is not None:
+                progress.set_stage("write")
+            for chat, dialog_id, admin_ids in ready:
+                reader = await steps.run(participants_store.open_reader, dialog_id, limit)
+                writer, stream = await steps.run(_begin_chat, container, bundle, fmt, chat["title"], dialog_id)
+                try:
+                    while True:
+                        n = await steps.run(_copy_snapshot_batch, reader[1], writer, admin_ids)
+                        if not n:
+                            break
+                        total += n
+                        if progress is not None:
+                            progress.update(total)
+                finally:
+                    await steps.settle()
+                    await run_in_export_executor(_end_chat, writer, stream)
+                    await run_in_export_executor(reader[0].close)
+                    reader = None
+            await steps.run(container.close)
+            STAGE_SECONDS.observe(time.monotonic() - render_started, stage="render")
+            ROWS_EXPORTED.inc(total)
+        except Exception:
+            log_error("Ошибка формирования файла пакетного экспорта:\n" + str(locals()))
+            await _notify(bot_app, requester_chat_id, "❌ Не удалось сформировать файл.")
+            return None
+
         try:
-            await bot_app.bot.send_message(chat_id=requester_chat_id, text="⚠️ 'openpyxl' не установлен — отправка CSV вместо этого. Для включения XLSX установите: pip install openpyxl")
+            if progress is not None:
+                progress.set_stage("upload")
+            extension = "xlsx" if bundle == BUNDLE_WORKBOOK else "zip"
+            size = out.seek(0, io.SEEK_END)
+            document = _upload_file(out, f"chat_members_batch_{int(time.time())}.{extension}")
+            with STAGE_SECONDS.time(stage="upload"):
+                await bot_app.bot.send_document(
+                    chat_id=requester_chat_id, document=document, caption=f"Чатов: {len(ready)}, строк: {total}"
+                )
+            UPLOAD_BYTES.inc(size)
+            return len(ready), total
         except Exception:
-            pass
+            log_error("Отправка файла пакетного экспорта не удалась:\n" + str(locals()))
+            await _notify(bot_app, requester_chat_id, "❌ Не удалось отправить файл.")
+            return None
+    finally:
+        await steps.settle()
+        if reader is not None:
+            await run_in_export_executor(reader[0].close)
         try:
-            with open(csv_fallback, "w", newline="", encoding="utf-8-sig") as csvfile:
-                fieldnames = ["TelegramID", "Status", "Username", "FullName", "Phone", "JoinedDate"]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=";", quoting=csv.QUOTE_ALL)
-                writer.writeheader()
-                for r in members:
-                    writer.writerow(r)
-            await bot_app.bot.send_document(chat_id=requester_chat_id, document=open(csv_fallback, "rb"))
+            out.close()
         except Exception:
-            log_error("Не удалось создать/отправить резервный csv:\n" + str(locals()))
-        finally:
-            try:
-                if os.path.exists(csv_fallback):
-                    os.remove(csv_fallback)
-            except Exception:
-                pass
+            pass
+
+
+def _discard_writer(writer):
+    # закрытие буфера освобождает память или удаляет временный файл, если он был создан
+    try:
+        writer.out.close()
+    except Exception:
+        pass
 
 
 def normalize_phone(raw: str) -> str:
@@ -187,6 +438,6 @@ def normalize_phone(raw: str) -> str:
         return "+" + digits
     if len(digits) == 10:
         return "+7" + digits
-    if digits > 0:
+    if digits:
         return "+" + digits
     return raw
@@ -0,0 +1,216 @@
+# export_writers.py — форматы файлов экспорта
+# Изменения: общий интерфейс writer'а (write_rows/close) и реализации XLSX, CSV, CSV.gz, JSONL и Parquet;
+# формат выбирается по ключу, недоступный формат заменяется на CSV
+# Изменения: книга XLSX с отдельным листом на каждый чат для пакетного экспорта
+
+import io
+import re
+import csv
+import gzip
+import json
+
+# попытка импортировать openpyxl для создания xlsx
+try:
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+    OPENPYXL_AVAILABLE = True
+except Exception:
+    OPENPYXL_AVAILABLE = False
+
+# pyarrow — необязательная зависимость для Parquet
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except Exception:
+    PYARROW_AVAILABLE = False
+
+from utils.logging_utils import log_error
+
+
+EXPORT_HEADERS = ["TelegramID", "Status", "Username", "FullName", "Phone", "JoinedDate"]
+# В write-only режиме ширина колонок задается до записи строк, поэтому используем фиксированные значения
+XLSX_COLUMN_WIDTHS = [14, 8, 24, 36, 16, 12]
+# Строки Parquet копятся до размера группы: мелкие группы по EXPORT_BATCH_SIZE плохо сжимаются и медленно читаются
+PARQUET_ROW_GROUP_SIZE = 50_000
+
+
+# Writer пишет в бинарный буфер out (SpooledTemporaryFile): маленькие файлы остаются в памяти,
+# большие автоматически уходят во временный файл, который удаляется при закрытии буфера.
+# Все writer'ы получают одни и те же строки (member_row) и не закрывают сам буфер.
+class XlsxStreamWriter:
+    # openpyxl write-only: строки сразу сериализуются, память не растет с числом участников
+    # (сам openpyxl держит XML листа во временном файле и удаляет его после save)
+    extension = "xlsx"
+
+    def __init__(self, out):
+        self.out = out
+        self.wb = Workbook(write_only=True)
+        self._add_sheet("Members")
+
+    def _add_sheet(self, name: str):
+        self.ws = self.wb.create_sheet(name)
+        for i, width in enumerate(XLSX_COLUMN_WIDTHS, start=1):
+            self.ws.column_dimensions[get_column_letter(i)].width = width
+        self.ws.append(EXPORT_HEADERS)
+
+    def write_rows(self, rows: list):
+        for row in rows:
+            self.ws.append(row)
+
+    def close(self):
+        self.wb.save(self.out)
+
+
+class XlsxWorkbookWriter(XlsxStreamWriter):
+    # пакетный экспорт: один файл, лист на каждый чат (start_sheet перед строками чата)
+    def __init__(self, out):
+        self.out = out
+        self.wb = Workbook(write_only=True)
+        self.ws = None
+        self._names = set()
+
+    def start_sheet(self, title: str):
+        # имя листа Excel: до 31 символа, без []:*?/\ и уникальное без учета регистра
+        base = re.sub(r"[\[\]:*?/\\]", "_", title).strip("' ")[:31] or "Chat"
+        name = base
+        n = 2
+        while name.lower() in self._names:
+            suffix = f" ({n})"
+            name = base[:31 - len(suffix)] + suffix
+            n += 1
+        self._names.add(name.lower())
+        self._add_sheet(name)
+
+
+class CsvStreamWriter:
+    extension = "csv"
+
+    def __init__(self, out):
+        self.out = out
+        self.f = io.TextIOWrapper(self._sink(out), newline="", encoding="utf-8-sig")
+        self.writer = csv.writer(self.f, delimiter=";", quoting=csv.QUOTE_ALL)
+        self.writer.writerow(EXPORT_HEADERS)
+
+    def _sink(self, out):
+        return out
+
+    def write_rows(self, rows: list):
+        self.writer.writerows(rows)
+
+    def close(self):
+        # detach, чтобы закрытие обертки не закрыло сам буфер
+        self.f.flush()
+        self.f.detach()
+
+
+class GzipCsvStreamWriter(CsvStreamWriter):
+    extension = "csv.gz"
+
+    def _sink(self, out):
+        # GzipFile с fileobj не закрывает out при close
+        self.gz = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6)
+        return self.gz
+
+    def close(self):
+        super().close()
+        self.gz.close()
+
+
+class JsonlStreamWriter:
+    # одна строка — один JSON-объект с ключами EXPORT_HEADERS
+    extension = "jsonl"
+
+    def __init__(self, out):
+        self.out = out
+        self.f = io.TextIOWrapper(out, encoding="utf-8", newline="\n")
+
+    def write_rows(self, rows: list):
+        self.f.write("".join(json.dumps(dict(zip(EXPORT_HEADERS, row)), ensure_ascii=False) + "\n" for row in rows))
+
+    def close(self):
+        self.f.flush()
+        self.f.detach()
+
+
+class ParquetStreamWriter:
+    extension = "parquet"
+
+    def __init__(self, out):
+        self.out = out
+        self.schema = pa.schema(
+            [("TelegramID", pa.int64())] + [(name, pa.string()) for name in EXPORT_HEADERS[1:]]
+        )
+        # NativeFile-обертка: ParquetWriter не закрывает переданный ему поток
+        self.sink = pa.PythonFile(out, mode="w")
+        self.writer = pq.ParquetWriter(self.sink, self.schema, compression="zstd")
+        self.pending = []
+
+    def _flush(self):
+        if not self.pending:
+            return
+        columns = list(zip(*self.pending))
+        self.writer.write_table(pa.Table.from_arrays(
+            [pa.array(col, type=field.type) for col, field in zip(columns, self.schema)], schema=self.schema
+        ))
+        self.pending = []
+
+    def write_rows(self, rows: list):
+        self.pending.extend(rows)
+        if len(self.pending) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+# -----------------------
+# === Реестр форматов ===
+# -----------------------
+# ключ -> (подпись на кнопке, класс writer'а); порядок — порядок кнопок выбора формата
+EXPORT_FORMATS = {
+    "xlsx": ("XLSX", XlsxStreamWriter),
+    "csv": ("CSV", CsvStreamWriter),
+    "csv.gz": ("CSV.gz", GzipCsvStreamWriter),
+    "jsonl": ("JSONL", JsonlStreamWriter),
+    "parquet": ("Parquet", ParquetStreamWriter),
+}
+
+_MISSING_DEPENDENCY_NOTICES = {
+    "xlsx": "⚠️ 'openpyxl' не установлен — отправка CSV вместо этого. Для включения XLSX установите: pip install openpyxl",
+    "parquet": "⚠️ 'pyarrow' не установлен — отправка CSV вместо этого. Для включения Parquet установите: pip install pyarrow",
+}
+
+
+def format_available(fmt: str) -> bool:
+    if fmt == "xlsx":
+        return OPENPYXL_AVAILABLE
+    if fmt == "parquet":
+        return PYARROW_AVAILABLE
+    return fmt in EXPORT_FORMATS
+
+
+def available_formats() -> list:
+    return [fmt for fmt in EXPORT_FORMATS if format_available(fmt)]
+
+
+def format_label(fmt: str) -> str:
+    return EXPORT_FORMATS.get(fmt, (fmt.upper(), None))[0]
+
+
+def open_writer(fmt: str, out):
+    # (writer, notice): CSV — если формат неизвестен, его зависимость не установлена или writer не создался
+    if fmt not in EXPORT_FORMATS:
+        fmt = "csv"
+    if not format_available(fmt):
+        return CsvStreamWriter(out), _MISSING_DEPENDENCY_NOTICES.get(fmt)
+    try:
+        return EXPORT_FORMATS[fmt][1](out), None
+    except Exception:
+        if fmt == "csv":
+            raise
+        log_error(f"Не удалось создать {format_label(fmt)} writer:\n" + str(locals()))
+        out.seek(0)
+        out.truncate()
+        return CsvStreamWriter(out), f"⚠️ {format_label(fmt)} не удалось, резервный вариант — CSV."
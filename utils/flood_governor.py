@@ -0,0 +1,142 @@
+# flood_governor.py — FloodWait Telegram для вызовов Telethon
+# Изменения: ожидание, назначенное сервером, вместо прерывания скана; постраничный поток (участники, диалоги)
+# после ожидания продолжается с той же страницы; после FloodWait запросы аккаунта идут с паузой
+# Изменения: повтор страницы только для RequestIter с ожидаемыми buffer/index (Telethon 1.45, requirements.txt);
+# иначе FloodWait пробрасывается вызывающему
+
+import time
+import asyncio
+import weakref
+
+from telethon.errors import FloodError
+from telethon.requestiter import RequestIter
+
+from utils.config import FLOOD_WAIT_MAX_SECONDS, FLOOD_PACE_BASE_SECONDS, FLOOD_PACE_MAX_SECONDS, FLOOD_PACE_DECAY
+from utils.logging_utils import log_session
+from utils.metrics import record_flood_wait
+
+
+# пауза меньше этой считается сброшенной — аккаунт снова работает без ограничений
+_PACE_RESET_SECONDS = 0.05
+
+
+def flood_seconds(exc):
+    # FloodWaitError/FloodPremiumWaitError несут время ожидания в seconds; у прочих FloodError его нет
+    seconds = getattr(exc, "seconds", None)
+    return seconds if isinstance(seconds, (int, float)) and seconds >= 0 else None
+
+
+def _resumable(it) -> bool:
+    # внутренности RequestIter проверены на версии Telethon из requirements.txt: buffer — None (до _init) или список
+    # страницы, index — позиция в нем; при другом устройстве итератора страницу повторять нельзя
+    buffer = getattr(it, "buffer", ())
+    return isinstance(it, RequestIter) and isinstance(getattr(it, "index", None), int) and (buffer is None or isinstance(buffer, list))
+
+
+class _AccountPace:
+    __slots__ = ("ready_at", "interval")
+
+    def __init__(self):
+        self.ready_at = 0.0
+        self.interval = 0.0
+
+
+class FloodGovernor:
+    # Состояние на клиента Telethon (один клиент — один аккаунт): до какого момента запросы ждут и текущая пауза
+    # между ними. Короткие FloodWait (до flood_sleep_threshold клиента) Telethon выжидает сам — сюда доходят длинные.
+    def __init__(self, max_wait: float = FLOOD_WAIT_MAX_SECONDS):
+        self.max_wait = max_wait
+        self._accounts = weakref.WeakKeyDictionary()  # client -> _AccountPace
+
+    async def wait_turn(self, client):
+        pace = self._accounts.get(client)
+        if pace is None:
+            return
+        delay = pace.ready_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # следующий запрос аккаунта (в том числе из другого скана) — не раньше чем через interval
+        pace.ready_at = max(pace.ready_at, time.monotonic()) + pace.interval
+
+    def on_success(self, client):
+        pace = self._accounts.get(client)
+        if pace is None:
+            return
+        pace.interval *= FLOOD_PACE_DECAY
+        if pace.interval < _PACE_RESET_SECONDS and pace.ready_at <= time.monotonic():
+            self._accounts.pop(client, None)
+
+    def on_flood(self, client, exc, method: str, on_wait=None):
+        # FloodWait, который можно выждать: аккаунт ставится на паузу; иначе исключение уходит вызывающему
+        seconds = flood_seconds(exc)
+        if seconds is None or seconds > self.max_wait:
+            raise exc
+        record_flood_wait(exc, method)
+        pace = self._accounts.get(client)
+        if pace is None:
+            pace = self._accounts[client] = _AccountPace()
+        pace.interval = min(max(pace.interval * 2, FLOOD_PACE_BASE_SECONDS), FLOOD_PACE_MAX_SECONDS)
+        pace.ready_at = max(pace.ready_at, time.monotonic() + seconds)
+        log_session(f"FloodWait {seconds} с ({method}): ожидание и повтор запроса, пауза аккаунта {pace.interval:.1f} с")
+        if on_wait is not None:
+            on_wait(seconds)
+
+    async def call(self, client, method: str, func, *args, on_wait=None, **kwargs):
+        # одиночный запрос: await governor.call(client, "admins", client.get_participants, entity, filter=...)
+        while True:
+            await self.wait_turn(client)
+            try:
+                result = await func(*args, **kwargs)
+            except FloodError as e:
+                self.on_flood(client, e, method, on_wait)
+                continue
+            self.on_success(client)
+            return result
+
+    def stream(self, client, method: str, iterator, on_wait=None) -> "GovernedIter":
+        # постраничный поток: async for user in governor.stream(client, "participants", client.iter_participants(...))
+        return GovernedIter(self, client, method, iterator, on_wait)
+
+
+class GovernedIter:
+    # Итераторы Telethon (RequestIter) сдвигают смещение запроса только после успешной страницы, а буфер
+    # сбрасывают до запроса — повторный __anext__ после FloodWait запрашивает ту же страницу. Обычный
+    # async-генератор после исключения продолжить нельзя: для него FloodWait пробрасывается вызывающему.
+    def __init__(self, governor: FloodGovernor, client, method: str, iterator, on_wait=None):
+        self._governor = governor
+        self._client = client
+        self._method = method
+        self._it = iterator.__aiter__()
+        self._on_wait = on_wait
+
+    @property
+    def total(self):
+        return getattr(self._it, "total", None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            resumable = _resumable(self._it)
+            buffer = self._it.buffer if resumable else None
+            # сетевой запрос будет только на границе страницы (или при первой инициализации)
+            loads_page = buffer is None or self._it.index >= len(buffer)
+            if loads_page:
+                await self._governor.wait_turn(self._client)
+            try:
+                item = await self._it.__anext__()
+            except FloodError as e:
+                if not resumable:
+                    raise
+                if buffer is None:
+                    # ошибка в _init: на следующем шаге инициализация повторится целиком
+                    self._it.buffer = None
+                self._governor.on_flood(self._client, e, self._method, self._on_wait)
+                continue
+            if loads_page:
+                self._governor.on_success(self._client)
+            return item
+
+
+flood_governor = FloodGovernor()
@@ -0,0 +1,88 @@
+# flow_state.py — состояние flow пользователя
+# Изменения: flow — конечный автомат с явными состояниями (вход, код, 2FA, выбор чата, действия администратора);
+# состояние пользователя хранится в объекте с __slots__ вместо словаря, который пересобирался на каждом шаге
+# Изменения: phone_code_hash запроса кода хранится в flow — вход продолжается новым клиентом после перезапуска
+
+import time
+
+from utils.config import pending_action
+
+
+# -----------------------
+# === Состояния flow ===
+# -----------------------
+STATE_IDLE = "idle"  # шага нет, есть только авторизационные сообщения к удалению
+STATE_PHONE = "phone"
+STATE_CODE = "code"
+STATE_PASSWORD = "password"
+STATE_CHOOSE_CHAT = "choose_chat"
+STATE_ADD_ADMIN = "add_admin"
+STATE_ADD_OPERATOR = "add_operator"
+STATE_REMOVE_OPERATOR = "remove_operator"
+STATE_SET_EXPORT_FORMAT = "set_export_format"
+
+# допустимые переходы внутри одного flow; новый flow из меню начинается новым FlowState
+TRANSITIONS = {
+    STATE_IDLE: frozenset(),
+    STATE_PHONE: frozenset({STATE_CODE, STATE_CHOOSE_CHAT}),
+    STATE_CODE: frozenset({STATE_PASSWORD, STATE_CHOOSE_CHAT}),
+    STATE_PASSWORD: frozenset({STATE_CHOOSE_CHAT}),
+    STATE_CHOOSE_CHAT: frozenset(),
+    STATE_ADD_ADMIN: frozenset(),
+    STATE_ADD_OPERATOR: frozenset(),
+    STATE_REMOVE_OPERATOR: frozenset(),
+    STATE_SET_EXPORT_FORMAT: frozenset(),
+}
+
+# состояния входа: из них список чатов открывается тем же flow (авторизационные сообщения и start_time сохраняются)
+LOGIN_STATES = frozenset({STATE_PHONE, STATE_CODE, STATE_PASSWORD})
+
+
+class FlowState:
+    # auth_messages — список (chat_id, message_id, from_bot) для удаления после входа;
+    # поля выбора чата (chats/results/page/format/selected/bundle) заполняются в STATE_CHOOSE_CHAT
+    __slots__ = (
+        "state", "start_time", "auth_messages", "client", "phone", "code_hash",
+        "chats", "results", "page", "format", "selected", "bundle",
+    )
+
+    def __init__(self, state: str = STATE_IDLE, start_time: float = None):
+        self.state = state
+        self.start_time = start_time or time.time()
+        self.auth_messages = []
+        self.client = None
+        self.phone = None
+        self.code_hash = None
+        self.chats = None
+        self.results = None
+        self.page = 0
+        self.format = None
+        self.selected = None  # None — выбор одного чата, список dialog_id — пакетный режим
+        self.bundle = None
+
+    def advance(self, state: str):
+        if state not in TRANSITIONS.get(self.state, ()):
+            raise ValueError(f"Недопустимый переход flow: {self.state} -> {state}")
+        self.state = state
+
+    def enter_choose_chat(self, client, chats, fmt: str):
+        # chats — ChatIndex аккаунта; результаты поиска по умолчанию — все чаты
+        self.advance(STATE_CHOOSE_CHAT)
+        self.client = client
+        self.chats = chats
+        self.results = chats.order
+        self.page = 0
+        self.format = fmt
+
+    def __repr__(self):
+        return f"FlowState(state={self.state!r}, phone={self.phone!r})"
+
+
+def start_flow(user_id: int, state: str) -> FlowState:
+    # новый flow заменяет предыдущий; неудаленные авторизационные сообщения старого flow переходят в новый
+    previous = pending_action.get(user_id)
+    flow = FlowState(state)
+    if previous is not None:
+        flow.auth_messages = previous.auth_messages
+    pending_action[user_id] = flow
+    return flow
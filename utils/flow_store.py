@@ -0,0 +1,343 @@
+# flow_store.py — незавершенные flow и сроки сессий между перезапусками бота (SQLite)
+# Изменения: снимки pending_action и active_sessions пишутся инкрементально — только изменившиеся записи;
+# при старте flow восстанавливаются (вход продолжается с того же шага), истечение сессий и flow снова планируется
+# Изменения: сохраняются и задачи экспорта в очереди и в работе; после перезапуска они снова ставятся в очередь
+# (resume_jobs), сканирование продолжается с checkpoint'а participants_cache
+# Изменения: flow выбора чата восстанавливаются в фоне (restore_chat_pickers) — подключение клиента и список чатов
+# не задерживают запуск бота
+# Изменения: клиент сессии из хранилища подключается один раз, даже если его одновременно ждут flow и задачи экспорта
+
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.config import FLOWS_DB, FLOW_SNAPSHOT_INTERVAL_SECONDS, SESSION_TTL_SECONDS
+from utils.config import pending_action, active_sessions
+from utils.user_management import fernet
+from utils.logging_utils import log_session, log_error
+from utils.flow_state import FlowState, TRANSITIONS, STATE_CODE, STATE_PASSWORD, STATE_CHOOSE_CHAT
+from utils.session_vault import session_vault
+from utils.client_pool import client_pool
+from utils.cache_utils import SingleFlight
+from utils.expiry_scheduler import expiry_scheduler
+from utils.background_tasks import track_pending
+from utils.scan_jobs import scan_scheduler
+from utils.telethon_client import new_client, client_from_session_string, get_chat_index, _session_key_for_phone
+
+
+# Запись в базу идет через один поток: снимок собирается в event loop, шифрование и запись — вне его
+FLOWS_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="flows-db")
+
+# на шагах code/password сохраняется строка StringSession клиента входа: по ней вход продолжается после перезапуска
+LOGIN_CLIENT_STATES = frozenset({STATE_CODE, STATE_PASSWORD})
+
+
+async def run_in_flows_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(FLOWS_EXECUTOR, func, *args)
+
+
+def flow_snapshot(flow: FlowState) -> dict:
+    # сериализуемая часть flow; живые объекты (клиент, индекс чатов) восстанавливаются заново
+    data = {
+        "state": flow.state,
+        "start_time": flow.start_time,
+        "phone": flow.phone,
+        "auth_messages": [list(m) for m in flow.auth_messages],
+    }
+    if flow.state in LOGIN_CLIENT_STATES and flow.client is not None:
+        data["session"] = flow.client.session.save()
+        data["code_hash"] = flow.code_hash
+    elif flow.state == STATE_CHOOSE_CHAT:
+        data.update(format=flow.format, page=flow.page, selected=flow.selected, bundle=flow.bundle)
+        if flow.chats is not None and flow.results is not flow.chats.order:
+            data["results"] = flow.results
+    return data
+
+
+def _jobs_snapshot(resuming: dict) -> dict:
+    # ключ задачи -> JSON spec; задачи, которые еще восстанавливаются, тоже остаются в базе
+    jobs = dict(resuming)
+    for key, spec in scan_scheduler.specs().items():
+        jobs[key] = json.dumps(spec, ensure_ascii=False, sort_keys=True)
+    return jobs
+
+
+def _is_chat_picker(payload: str) -> bool:
+    try:
+        return json.loads(payload).get("state") == STATE_CHOOSE_CHAT
+    except Exception:
+        return False
+
+
+# -----------------------
+# === Хранилище SQLite ===
+# -----------------------
+class FlowStore:
+    # flows: user_id -> зашифрованный снимок flow (номер телефона, строка сессии входа);
+    # sessions: session_key -> владелец и время создания — для планировщика истечения;
+    # jobs: ключ задачи экспорта -> зашифрованное описание (spec) из scan_scheduler
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+        self._written_flows = {}  # user_id -> JSON последнего записанного снимка
+        self._written_sessions = {}  # session_key -> (owner, created)
+        self._written_jobs = {}  # ключ задачи -> JSON spec
+        self._resuming = {}  # ключ задачи -> JSON spec: загружены из базы, еще не в очереди
+        self._restoring_flows = {}  # user_id -> JSON снимка flow выбора чата, который восстанавливается в фоне
+        self._client_flights = SingleFlight()  # session_key -> подключение клиента и чтение списка чатов
+
+    def _db(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS flows (
+                    user_id INTEGER PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    updated REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_key TEXT PRIMARY KEY,
+                    owner INTEGER,
+                    created REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_key TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    updated REAL NOT NULL
+                );
+                """
+            )
+            self.conn = conn
+        return self.conn
+
+    def _write(self, flow_rows: list, flow_deletes: list, session_rows: list, session_deletes: list,
+               job_rows: list, job_deletes: list):
+        now = time.time()
+        encrypted = [(user_id, fernet.encrypt(payload.encode()), now) for user_id, payload in flow_rows]
+        encrypted_jobs = [(key, fernet.encrypt(payload.encode()), now) for key, payload in job_rows]
+        with self.lock:
+            db = self._db()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO flows (user_id, data, updated) VALUES (?, ?, ?)", encrypted)
+                db.executemany("DELETE FROM flows WHERE user_id = ?", [(u,) for u in flow_deletes])
+                db.executemany("INSERT OR REPLACE INTO sessions (session_key, owner, created) VALUES (?, ?, ?)", session_rows)
+                db.executemany("DELETE FROM sessions WHERE session_key = ?", [(k,) for k in session_deletes])
+                db.executemany("INSERT OR REPLACE INTO jobs (job_key, data, updated) VALUES (?, ?, ?)", encrypted_jobs)
+                db.executemany("DELETE FROM jobs WHERE job_key = ?", [(k,) for k in job_deletes])
+
+    def _load(self):
+        flows = {}
+        with self.lock:
+            db = self._db()
+            for user_id, blob in db.execute("SELECT user_id, data FROM flows"):
+                try:
+                    flows[user_id] = fernet.decrypt(blob).decode()
+                except Exception:
+                    log_error(f"Не удалось расшифровать сохраненный flow пользователя {user_id}:\n" + traceback.format_exc())
+            sessions = {k: (owner, created) for k, owner, created in db.execute("SELECT session_key, owner, created FROM sessions")}
+            jobs = {}
+            for key, blob in db.execute("SELECT job_key, data FROM jobs"):
+                try:
+                    jobs[key] = fernet.decrypt(blob).decode()
+                except Exception:
+                    log_error(f"Не удалось расшифровать сохраненную задачу экспорта {key}:\n" + traceback.format_exc())
+        return flows, sessions, jobs
+
+    def _collect(self):
+        # сравнение с последней записью: в базу уходят только новые, изменившиеся и удаленные записи
+        flows = {}
+        for user_id, flow in list(pending_action.items()):
+            try:
+                flows[user_id] = json.dumps(flow_snapshot(flow), ensure_ascii=False, sort_keys=True)
+            except Exception:
+                log_error(f"Не удалось сохранить flow пользователя {user_id}:\n" + traceback.format_exc())
+                flows[user_id] = self._written_flows.get(user_id)
+        for user_id, payload in list(self._restoring_flows.items()):
+            flows.setdefault(user_id, payload)
+        flows = {u: p for u, p in flows.items() if p is not None}
+        sessions = {k: (meta.get("owner"), meta.get("created", 0)) for k, meta in list(active_sessions.items())}
+        jobs = _jobs_snapshot(self._resuming)
+
+        flow_rows = [(u, p) for u, p in flows.items() if self._written_flows.get(u) != p]
+        flow_deletes = [u for u in self._written_flows if u not in flows]
+        session_rows = [(k, *v) for k, v in sessions.items() if self._written_sessions.get(k) != v]
+        session_deletes = [k for k in self._written_sessions if k not in sessions]
+        job_rows = [(k, p) for k, p in jobs.items() if self._written_jobs.get(k) != p]
+        job_deletes = [k for k in self._written_jobs if k not in jobs]
+        return flows, sessions, jobs, (flow_rows, flow_deletes, session_rows, session_deletes, job_rows, job_deletes)
+
+    async def flush(self) -> int:
+        flows, sessions, jobs, changes = self._collect()
+        if not any(changes):
+            return 0
+        await run_in_flows_executor(self._write, *changes)
+        self._written_flows = flows
+        self._written_sessions = sessions
+        self._written_jobs = jobs
+        return sum(len(c) for c in changes)
+
+    async def watch(self, interval: float = FLOW_SNAPSHOT_INTERVAL_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                log_error("Не удалось сохранить снимок flow:\n" + traceback.format_exc())
+
+    # -----------------------
+    # === Восстановление ===
+    # -----------------------
+    async def restore(self):
+        # перезапуск run_polling supervisor'ом: flow еще в памяти, но их клиенты привязаны к старому event loop —
+        # сначала сохраняем их, затем восстанавливаем из базы с новыми клиентами
+        if pending_action or active_sessions or scan_scheduler.specs():
+            await self.flush()
+        flows, sessions, jobs = await run_in_flows_executor(self._load)
+        self._written_flows = dict(flows)
+        self._written_sessions = dict(sessions)
+        self._written_jobs = dict(jobs)
+        self._resuming = dict(jobs)
+        self._restore_sessions(sessions)
+
+        pending_action.clear()
+        # flow выбора чата ждут подключения клиента и списка чатов — они восстанавливаются в фоне
+        self._restoring_flows = {u: p for u, p in flows.items() if _is_chat_picker(p)}
+        user_ids = [u for u in flows if u not in self._restoring_flows]
+        restored = await asyncio.gather(*(self._restore_flow(u, flows[u]) for u in user_ids))
+        for user_id, flow in zip(user_ids, restored):
+            if flow is None:
+                continue
+            pending_action[user_id] = flow
+            track_pending(user_id)
+        log_session(
+            f"Восстановлено flow: {len(pending_action)} из {len(user_ids)}, flow выбора чата в очереди: "
+            f"{len(self._restoring_flows)}, сессий: {len(active_sessions)}, задач экспорта к продолжению: {len(jobs)}"
+        )
+
+    async def restore_chat_pickers(self):
+        # flow выбора чата, отложенные restore (запускается после старта); flow, начатый пользователем
+        # до окончания восстановления, не заменяется
+        user_ids = list(self._restoring_flows)
+        restored = await asyncio.gather(*(self._restore_deferred(u) for u in user_ids))
+        log_session(f"Восстановлено flow выбора чата: {sum(restored)} из {len(user_ids)}")
+
+    async def _restore_deferred(self, user_id: int) -> bool:
+        try:
+            flow = await self._restore_flow(user_id, self._restoring_flows[user_id])
+        finally:
+            self._restoring_flows.pop(user_id, None)
+        if flow is None or user_id in pending_action:
+            return False
+        pending_action[user_id] = flow
+        track_pending(user_id)
+        return True
+
+    def _restore_sessions(self, sessions: dict):
+        # срок истечения получает каждая сессия хранилища; у сессий без записи (сохраненных до перезапуска
+        # старой версией) владелец неизвестен, срок считается от времени сохранения в хранилище
+        active_sessions.clear()
+        for session_key, saved in session_vault.created().items():
+            owner, created = sessions.get(session_key, (None, saved))
+            active_sessions[session_key] = {"created": created, "expiry": created + SESSION_TTL_SECONDS, "owner": owner}
+            expiry_scheduler.schedule(("session", session_key), created + SESSION_TTL_SECONDS)
+
+    async def _restore_flow(self, user_id: int, payload: str):
+        try:
+            data = json.loads(payload)
+        except Exception:
+            log_error(f"Поврежден сохраненный flow пользователя {user_id}:\n" + traceback.format_exc())
+            return None
+        if data.get("state") not in TRANSITIONS:
+            return None
+        flow = FlowState(data["state"], data.get("start_time"))
+        flow.phone = data.get("phone")
+        flow.auth_messages = [tuple(m) for m in data.get("auth_messages", [])]
+        if time.time() >= flow.start_time + SESSION_TTL_SECONDS:
+            # истекший flow восстанавливается без клиента: планировщик сразу его закроет и удалит авторизационные сообщения
+            return flow
+        client = None
+        try:
+            if flow.state in LOGIN_CLIENT_STATES:
+                if not data.get("session"):
+                    return None
+                client = client_from_session_string(data["session"])
+                await client.connect()
+                flow.client = client
+                flow.code_hash = data.get("code_hash")
+            elif flow.state == STATE_CHOOSE_CHAT:
+                if not await self._restore_chat_picker(user_id, flow, data):
+                    return None
+        except Exception:
+            log_error(f"Не удалось восстановить flow пользователя {user_id}:\n" + traceback.format_exc())
+            if client is not None:
+                try:
+                    await client.disconnect()
+                except Exception:
+                    pass
+            return None
+        return flow
+
+    async def _pooled_client(self, session_key: str, owner: int):
+        # (клиент, индекс чатов) авторизованной сессии из хранилища или None, если сессия истекла;
+        # клиент снова попадает в пул до конца срока сессии. restore_chat_pickers и resume_jobs идут параллельно:
+        # вызовы по одной сессии ждут одно подключение — второй клиент с тем же ключом авторизации не создается
+        return await self._client_flights.run(session_key, lambda: self._connect_pooled(session_key, owner))
+
+    async def _connect_pooled(self, session_key: str, owner: int):
+        meta = active_sessions.get(session_key)
+        if meta is None or time.time() >= meta["created"] + SESSION_TTL_SECONDS:
+            return None
+        client = await client_pool.get(session_key)
+        if client is not None:
+            return client, await get_chat_index(client, session_key)
+        client = new_client(session_key)
+        try:
+            await client.connect()
+            chats = await get_chat_index(client, session_key)
+        except Exception:
+            await client.disconnect()
+            raise
+        client_pool.put(session_key, client, meta["created"] + SESSION_TTL_SECONDS, owner)
+        return client, chats
+
+    async def _restore_chat_picker(self, user_id: int, flow: FlowState, data: dict) -> bool:
+        restored = await self._pooled_client(_session_key_for_phone(flow.phone or ""), user_id)
+        if restored is None:
+            return False
+        client, chats = restored
+        flow.client = client
+        flow.chats = chats
+        flow.results = [i for i in data.get("results", []) if chats.get(i) is not None] or chats.order
+        flow.page = data.get("page", 0)
+        flow.format = data.get("format")
+        flow.selected = data.get("selected")
+        flow.bundle = data.get("bundle")
+        return True
+
+    async def resume_jobs(self, resume):
+        # задачи экспорта, прерванные перезапуском: resume(spec, client, chats) ставит задачу в очередь заново
+        # (запускается после scan_scheduler.start); задача без действующей сессии или чатов отбрасывается
+        for key, payload in list(self._resuming.items()):
+            try:
+                spec = json.loads(payload)
+                restored = await self._pooled_client(spec["session_key"], spec["user_id"])
+                if restored is None or not await resume(spec, *restored):
+                    log_session(f"Задача экспорта {key} не продолжена: сессия истекла или чаты недоступны")
+            except Exception:
+                log_error(f"Не удалось продолжить задачу экспорта {key}:\n" + traceback.format_exc())
+            finally:
+                self._resuming.pop(key, None)
+
+
+flow_store = FlowStore(FLOWS_DB)
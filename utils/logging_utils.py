@@ -1,7 +1,14 @@
 # logging_utils.py — функции логирования
 # Изменения: вынесены все функции логирования из main.py
+# Изменения: запись логов через очередь и фоновый поток пачками, ротация по размеру/времени со сжатием gzip
 
 import os
+import gzip
+import time
+import queue
+import atexit
+import shutil
+import threading
 from datetime import datetime
 
 # -----------------------
@@ -16,29 +23,126 @@ LOG_ERRORS = os.path.join(LOG_DIR, "error.log")
 LOG_WRONG_ACCESS = os.path.join(LOG_DIR, "wrong_access.log")
 
 
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+# Ротация: при превышении размера (байт) или возраста файла (секунд, 0 — выкл.) файл сжимается в <имя>.1.gz
+LOG_MAX_BYTES = _env_int("LOG_MAX_BYTES", 10 * 1024 * 1024)
+LOG_ROTATE_SECONDS = _env_int("LOG_ROTATE_SECONDS", 0)
+LOG_BACKUP_COUNT = _env_int("LOG_BACKUP_COUNT", 5)
+# Сколько записей фоновый поток забирает из очереди за один проход
+LOG_BATCH_SIZE = 1000
+
+
 def now_iso_local():
     return datetime.now().astimezone().isoformat()
 
 
+# -----------------------
+# === Фоновая запись ===
+# -----------------------
+_queue = queue.SimpleQueue()
+_STOP = object()
+_file_started = {}  # path -> время начала текущего файла (для ротации по времени)
+
+
+def _rotate(path: str):
+    # <имя>.N.gz -> <имя>.N+1.gz, текущий файл сжимается в <имя>.1.gz
+    oldest = f"{path}.{LOG_BACKUP_COUNT}.gz"
+    if os.path.exists(oldest):
+        os.remove(oldest)
+    for i in range(LOG_BACKUP_COUNT - 1, 0, -1):
+        src = f"{path}.{i}.gz"
+        if os.path.exists(src):
+            os.replace(src, f"{path}.{i + 1}.gz")
+    if LOG_BACKUP_COUNT > 0:
+        with open(path, "rb") as src, gzip.open(f"{path}.1.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    os.remove(path)
+
+
+def _should_rotate(path: str, incoming: int) -> bool:
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    if size == 0:
+        return False
+    if LOG_MAX_BYTES and size + incoming > LOG_MAX_BYTES:
+        return True
+    started = _file_started.setdefault(path, time.time())
+    return bool(LOG_ROTATE_SECONDS) and time.time() - started >= LOG_ROTATE_SECONDS
+
+
+def _write_batch(batch: list):
+    by_path = {}
+    for path, line in batch:
+        by_path.setdefault(path, []).append(line)
+    for path, lines in by_path.items():
+        data = "".join(lines)
+        try:
+            if _should_rotate(path, len(data.encode("utf-8"))):
+                _rotate(path)
+                _file_started[path] = time.time()
+        except Exception:
+            pass
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(data)
+        except Exception:
+            pass
+
+
+def _writer_loop():
+    while True:
+        batch = [_queue.get()]
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        stop = any(item is _STOP for item in batch)
+        _write_batch([item for item in batch if item is not _STOP])
+        if stop:
+            return
+
+
+_writer = threading.Thread(target=_writer_loop, name="log-writer", daemon=True)
+_writer.start()
+
+
+@atexit.register
+def flush_logs(timeout: float = 5.0):
+    # дописываем очередь при завершении процесса
+    if _writer.is_alive():
+        _queue.put(_STOP)
+        _writer.join(timeout)
+
+
+def _enqueue(path: str, line: str):
+    _queue.put((path, line))
+
+
 def log_session(msg: str):
     try:
-        with open(LOG_SESSIONS, "a", encoding="utf-8") as f:
-            f.write(f"{now_iso_local()} | {msg}\n")
+        _enqueue(LOG_SESSIONS, f"{now_iso_local()} | {msg}\n")
     except Exception:
         pass
 
 
 def log_error(exc_text: str):
     try:
-        with open(LOG_ERRORS, "a", encoding="utf-8") as f:
-            f.write(f"{now_iso_local()} | {exc_text}\n\n")
+        _enqueue(LOG_ERRORS, f"{now_iso_local()} | {exc_text}\n\n")
     except Exception:
         pass
 
 
 def log_wrong_access(user_id: int, msg: str):
     try:
-        with open(LOG_WRONG_ACCESS, "a", encoding="utf-8") as f:
-            f.write(f"{now_iso_local()} | user_id={user_id} | {msg}\n")
+        _enqueue(LOG_WRONG_ACCESS, f"{now_iso_local()} | user_id={user_id} | {msg}\n")
     except Exception:
         pass
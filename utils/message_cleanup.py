@@ -1,40 +1,108 @@
 # message_cleanup.py — функции очистки сообщений
 # Изменения: вынесены функции удаления временных сообщений из main.py
+# Изменения: авторизационные сообщения хранятся в FlowState как кортежи (chat_id, message_id, from_bot)
+# Изменения: удаление пачками через deleteMessages (до 100 сообщений чата за запрос), при ошибке —
+# поштучно с ограничением параллельности; приложение берется из config.GLOBAL_APP в момент вызова
+# Изменения: purge_auth_messages_later — удаление в фоне, чтобы ответ пользователю не ждал очереди лимитера
 
-import time
+import asyncio
+import traceback
 
-from utils.config import GLOBAL_APP
+from utils import config
+from utils.config import DELETE_MESSAGES_CHUNK, CLEANUP_DELETE_CONCURRENCY
 from utils.logging_utils import log_error
 
 
-async def purge_auth_messages_for_user(user_id: int):
-    global GLOBAL_APP
-    if GLOBAL_APP is None:
-        return
+async def _delete_one_by_one(bot, chat_id: int, message_ids: list, sem: asyncio.Semaphore) -> int:
+    async def _one(message_id):
+        async with sem:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+                return 1
+            except Exception:
+                log_error(f"Не удалось удалить сообщение {message_id} в чате {chat_id}:\n" + traceback.format_exc())
+                return 0
+
+    return sum(await asyncio.gather(*(_one(m) for m in message_ids)))
+
+
+async def delete_messages(bot, messages: list) -> int:
+    # messages — [(chat_id, message_id), ...]; сообщения группируются по чату, на каждые 100 — один запрос.
+    # Bot API пропускает уже удаленные сообщения, ошибка всего запроса — повод удалить пачку поштучно
+    by_chat = {}
+    for chat_id, message_id in messages:
+        by_chat.setdefault(chat_id, []).append(message_id)
+    sem = asyncio.Semaphore(CLEANUP_DELETE_CONCURRENCY)
+
+    async def _chunk(chat_id, message_ids):
+        async with sem:
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+                return len(message_ids)
+            except Exception:
+                log_error(f"Пакетное удаление {len(message_ids)} сообщений в чате {chat_id} не удалось, удаление по одному:\n" + traceback.format_exc())
+        return await _delete_one_by_one(bot, chat_id, message_ids, sem)
+
+    chunks = [
+        (chat_id, ids[i:i + DELETE_MESSAGES_CHUNK])
+        for chat_id, ids in by_chat.items()
+        for i in range(0, len(ids), DELETE_MESSAGES_CHUNK)
+    ]
+    return sum(await asyncio.gather(*(_chunk(c, ids) for c, ids in chunks)))
+
+
+def _take_auth_messages(user_id: int) -> list:
+    # сообщения забираются из flow сразу: повторная очистка того же flow их уже не увидит
     from utils.config import pending_action
     pa = pending_action.get(user_id)
-    if not pa:
+    if pa is None or not pa.auth_messages:
+        return []
+    msgs = pa.auth_messages
+    pa.auth_messages = []
+    # порядок не важен, повторы (одно сообщение записано дважды) отбрасываются
+    return list(dict.fromkeys((chat_id, message_id) for chat_id, message_id, _ in msgs))
+
+
+async def _purge(app, user_id: int, unique: list):
+    try:
+        await delete_messages(app.bot, unique)
+    except Exception:
+        log_error(f"Не удалось удалить авторизационные сообщения пользователя {user_id}:\n" + traceback.format_exc())
+
+
+async def purge_auth_messages_for_user(user_id: int):
+    app = config.GLOBAL_APP
+    if app is None:
+        return
+    unique = _take_auth_messages(user_id)
+    if unique:
+        await _purge(app, user_id, unique)
+
+
+# фоновые удаления (ссылки держатся до завершения задачи)
+_purge_tasks = set()
+
+
+def purge_auth_messages_later(user_id: int):
+    # для обработчиков, которые сразу отвечают пользователю: удаление идет в лимитере с низшим приоритетом
+    # и не должно задерживать ответ; сообщения забираются из flow сейчас, до того как flow будет закрыт
+    app = config.GLOBAL_APP
+    if app is None:
+        return
+    unique = _take_auth_messages(user_id)
+    if not unique:
         return
-    msgs = pa.get("auth_messages", [])
-    for m in msgs:
-        chat_id = m.get("chat_id")
-        message_id = m.get("message_id")
-        try:
-            await GLOBAL_APP.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except Exception:
-            log_error(f"Не удалось удалить сообщение {message_id} в чате {chat_id} для пользователя {user_id}:\n" + str(locals()))
-    pa["auth_messages"] = []
+    task = asyncio.ensure_future(_purge(app, user_id, unique))
+    _purge_tasks.add(task)
+    task.add_done_callback(_purge_tasks.discard)
 
 
 def record_auth_message(user_id: int, chat_id: int, message_id: int, from_bot: bool):
     from utils.config import pending_action
+    from utils.flow_state import start_flow, STATE_IDLE
     pa = pending_action.get(user_id)
-    entry = {"chat_id": chat_id, "message_id": message_id, "from_bot": bool(from_bot)}
     if pa is None:
-        pending_action[user_id] = {"auth_messages": [entry], "start_time": time.time()}
-    else:
-        lst = pa.get("auth_messages", [])
-        lst.append(entry)
-        pa["auth_messages"] = lst
-        if "start_time" not in pa:
-            pa["start_time"] = time.time()
+        pa = start_flow(user_id, STATE_IDLE)
+        from utils.background_tasks import track_pending
+        track_pending(user_id)
+    pa.auth_messages.append((chat_id, message_id, bool(from_bot)))
@@ -1,349 +1,546 @@
 # message_handlers.py — обработчики сообщений
 # Изменения: вынесены обработчики сообщений из handlers.py
+# Изменения: выбор чата по dialog_id из inline-клавиатуры, текст в шаге choose_chat — поиск по названию
+# Изменения: авторизованный клиент хранится в пуле до конца сессии, после экспорта можно выбрать следующий чат
+# Изменения: сессии хранятся в session_vault по ключу телефона, а не в файлах SESSIONS_DIR
+# Изменения: сроки сессий и flow регистрируются в планировщике истечения (track_session/track_pending)
+# Изменения: экспорт выбранного чата ставится в фоновую очередь scan_scheduler
+# Изменения: статус экспорта в одном сообщении, Отмена и /cancel прерывают выполняющиеся сканы
+# Изменения: длительность connect/sign_in и итог экспортов пишутся в метрики
+# Изменения: администраторы и операторы меняются через role_store, запись users.enc — вне event loop
+# Изменения: формат файла выбирается на скан, администратор задает формат по умолчанию
+# Изменения: пакетный экспорт нескольких чатов одной задачей (export_selected_chats)
+# Изменения: разбор сообщений — таблицы маршрутизации (подпись меню и состояние flow -> обработчик) вместо цепочки if,
+# шаги flow — отдельные обработчики над FlowState
+# Изменения: при отмене авторизационные сообщения удаляются в фоне — ответ не ждет очереди удаления
+# Изменения: задача экспорта ставится в очередь с описанием (чаты, формат, сессия) — после перезапуска бота
+# она запускается снова (resume_export) и продолжает сканирование с checkpoint'а
 
 import time
+import asyncio
 import traceback
 
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import ContextTypes
 
 from utils.config import LABEL_ADD_ADMIN, LABEL_ADD_OPERATOR, LABEL_REMOVE_OPERATOR
-from utils.config import LABEL_LIST_OPERATORS, LABEL_SCAN, LABEL_CANCEL
-from utils.config import pending_action, SESSIONS_DIR, API_ID, API_HASH, SESSION_TTL_SECONDS
-from utils.user_management import get_user_role, users_data, save_users
-from utils.ui_utils import main_menu_keyboard, cancel_keyboard, chats_keyboard, normalize, send_main_menu
+from utils.config import LABEL_LIST_OPERATORS, LABEL_SCAN, LABEL_CANCEL, LABEL_EXPORT_FORMAT
+from utils.config import pending_action, SESSION_TTL_SECONDS
+from utils.user_management import get_user_role, role_store
+from utils.ui_utils import main_menu_keyboard, cancel_keyboard, chat_picker_keyboard, normalize, send_main_menu
+from utils.ui_utils import export_formats_keyboard, parse_export_format
+from utils.export_writers import format_label
 from utils.logging_utils import log_wrong_access, log_error, log_session
-from utils.telethon_client import list_user_chats_and_store, telethon_send_code, normalize_phone, _session_filename_for_phone
-from utils.export_utils import export_members_to_xlsx_and_send
-from utils.message_cleanup import record_auth_message, purge_auth_messages_for_user
-from telethon import TelegramClient
+from utils.telethon_client import list_user_chats_and_store, telethon_send_code, _session_key_for_phone
+from utils.telethon_client import new_client, store_session
+from utils.session_vault import session_vault
+from utils.export_utils import export_members_to_xlsx_and_send, export_batch_and_send, default_export_format, normalize_phone
+from utils.message_cleanup import record_auth_message, purge_auth_messages_later
+from utils.client_pool import client_pool, release_client
+from utils.background_tasks import track_session, track_pending
+from utils.scan_jobs import scan_scheduler
+from utils.progress import ExportProgress
+from utils.metrics import STAGE_SECONDS, EXPORTS
+from utils.flow_state import FlowState, start_flow, STATE_PHONE, STATE_CODE, STATE_PASSWORD, STATE_CHOOSE_CHAT
+from utils.flow_state import STATE_ADD_ADMIN, STATE_ADD_OPERATOR, STATE_REMOVE_OPERATOR, STATE_SET_EXPORT_FORMAT
 from telethon.errors import SessionPasswordNeededError
-from utils.config import active_sessions
 
 
 # -----------------------
-# === Обработчик текстовых сообщений ===
+# === Отмена flow и экспорт выбранного чата ===
 # -----------------------
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    raw_text = (update.message.text or "")
-    text = raw_text.strip()
-    n = normalize(text)
-    role = get_user_role(user_id)
+async def cancel_flow(user_id: int) -> int:
+    # возвращает число отмененных сканирований
+    cancelled = 0
+    try:
+        cancelled = await scan_scheduler.cancel(user_id)
+    except Exception:
+        log_error("Не удалось отменить сканирования пользователя:\n" + traceback.format_exc())
+    if user_id not in pending_action:
+        return cancelled
+    client = pending_action[user_id].client
+    try:
+        await release_client(client)
+    except Exception:
+        log_error("Ошибка отключения клиента при отмене (handle_message):\n" + traceback.format_exc())
+    try:
+        purge_auth_messages_later(user_id)
+    except Exception:
+        log_error("Не удалось очистить авторизационные сообщения при отмене (handle_message):\n" + traceback.format_exc())
+    pending_action.pop(user_id, None)
+    return cancelled
 
-    # Если пользователь без доступа — логируем и игнорируем (не отвечаем)
-    if role is None:
-        log_wrong_access(user_id, f"Неавторизованное сообщение: {text[:200]}")
+
+async def reply_cancelled(update: Update, cancelled: int):
+    if not cancelled:
         return
+    try:
+        await update.effective_message.reply_text(f"⛔ Отменено сканирований: {cancelled}")
+    except Exception:
+        log_error("Не удалось сообщить об отмене сканирований:\n" + traceback.format_exc())
 
-    # если пользователь в pending flow — записываем входящее сообщение (чтобы потом удалить)
-    if user_id in pending_action:
-        try:
-            record_auth_message(user_id, update.effective_chat.id, update.message.message_id, from_bot=False)
-        except Exception:
-            log_error("Не удалось записать авторизационное сообщение (сообщение пользователя):\n" + traceback.format_exc())
 
-    # Обработка Отмена
-    if n == normalize(LABEL_CANCEL):
-        if user_id in pending_action:
-            client = pending_action[user_id].get("client")
-            try:
-                if client:
-                    await client.disconnect()
-            except Exception:
-                log_error("Ошибка отключения клиента при отмене (handle_message):\n" + traceback.format_exc())
-            try:
-                await purge_auth_messages_for_user(user_id)
-            except Exception:
-                log_error("Не удалось очистить авторизационные сообщения при отмене (handle_message):\n" + traceback.format_exc())
-            pending_action.pop(user_id, None)
-        await send_main_menu(update, user_id)
-        return
+def _export_runner(bot_app, chat_id: int, chats: list, bundle: str = None):
+    # (название задачи, run) для одного чата (bundle=None) или пакета чатов одним файлом;
+    # run(client, progress, fmt) возвращает текст итога или None, если файл не сформирован
+    if bundle is None:
+        chat = chats[0]
 
-    # Если в pending flow — обрабатываем шаги
-    if user_id in pending_action:
-        action = pending_action[user_id]
-        act = action.get("action")
-
-        if act == "login":
-            step = action.get("step")
-            if step == "phone":
-                phone_raw = text
-                if not phone_raw or (not phone_raw[0].isdigit() and phone_raw[0] not in ["+", "8"]):
-                    try:
-                        msg = await update.message.reply_text("❌ Некорректный номер. Введите в формате +79161234567 или нажмите Отмена.", reply_markup=cancel_keyboard())
-                        record_auth_message(user_id, msg.chat.id, msg.message_id, from_bot=True)
-                    except Exception:
-                        log_error("Не удалось отправить сообщение о недействительном номере:\n" + traceback.format_exc())
-                    return
-                phone_norm = normalize_phone(phone_raw)
-                pa = pending_action.get(user_id, {})
-                pa["phone"] = phone_norm
-                pa["start_time"] = pa.get("start_time", time.time())
-                # ensure auth_messages list exists
-                if "auth_messages" not in pa:
-                    pa["auth_messages"] = []
-                pending_action[user_id] = pa
-
-                session_name, session_path = _session_filename_for_phone(phone_norm)
-                # если сессия уже есть — используем её
-                if os.path.exists(session_path):
-                    try:
-                        client = TelegramClient(os.path.join(SESSIONS_DIR, session_name), API_ID, API_HASH)
-                        await client.connect()
-                        now = time.time()
-                        active_sessions[session_path] = {"created": now, "expiry": now + SESSION_TTL_SECONDS, "owner": user_id}
-                        log_session(f"Повторно использованная сессия активирована для {phone_norm} (path={session_path}) пользователем {user_id}")
-                        await list_user_chats_and_store(client, update, user_id)
-                    except Exception:
-                        log_error("Не удалось использовать существующую сессию:\n" + traceback.format_exc())
-                        try:
-                            await client.disconnect()
-                        except Exception:
-                            pass
-                    return
-
-                # иначе отправляем код
-                try:
-                    msg = await update.message.reply_text("⏳ Отправляем код подтверждения...", reply_markup=cancel_keyboard())
-                    record_auth_message(user_id, msg.chat.id, msg.message_id, from_bot=True)
-                except Exception:
-                    log_error("Не удалось отправить сообщение 'отправка кода':\n" + traceback.format_exc())
-                client, err = await telethon_send_code(phone_norm)
-                if client is None:
-                    if err == "exists":
-                        try:
-                            await update.message.reply_text("⚠️ Сессия уже существует.", reply_markup=main_menu_keyboard(role))
-                        except Exception:
-                            log_error("Не удалось ответить 'сессия существует':\n" + traceback.format_exc())
-                    else:
-                        try:
-                            await update.message.reply_text(f"❌ Ошибка при отправке кода: {err}", reply_markup=main_menu_keyboard(role))
-                        except Exception:
-                            log_error("Не удалось ответить 'ошибка отправки кода':\n" + traceback.format_exc())
-                    pending_action.pop(user_id, None)
-                    return
-                try:
-                    msg2 = await update.message.reply_text("📩 Код подтверждения отправлен. Введите его:", reply_markup=cancel_keyboard())
-                    record_auth_message(user_id, msg2.chat.id, msg2.message_id, from_bot=True)
-                except Exception:
-                    log_error("Не удалось отправить запрос 'введите код':\n" + traceback.format_exc())
-                pending_action[user_id] = {"action": "login", "step": "code", "client": client, "phone": phone_norm, "start_time": time.time(), "auth_messages": pending_action[user_id].get("auth_messages", [])}
-                return
-
-            if step == "code":
-                code = text
-                client = action.get("client")
-                phone = action.get("phone")
-                try:
-                    await client.sign_in(phone, code)
-                    session_name, session_path = _session_filename_for_phone(phone)
-                    now = time.time()
-                    active_sessions[session_path] = {"created": now, "expiry": now + SESSION_TTL_SECONDS, "owner": user_id}
-                    log_session(f"Сессия создана для {phone} (path={session_path}) пользователем {user_id}")
-                    await list_user_chats_and_store(client, update, user_id)
-                    return
-                except SessionPasswordNeededError:
-                    pending_action[user_id] = {"action": "login", "step": "password", "client": client, "phone": phone, "start_time": action.get("start_time", time.time()), "auth_messages": action.get("auth_messages", [])}
-                    try:
-                        msg = await update.message.reply_text("🔒 Введите пароль 2FA:", reply_markup=cancel_keyboard())
-                        record_auth_message(user_id, msg.chat.id, msg.message_id, from_bot=True)
-                    except Exception:
-                        log_error("Не удалось отправить запрос 2FA:\n" + traceback.format_exc())
-                    return
-                except Exception:
-                    log_error("Ошибка в шаге кода sign_in:\n" + traceback.format_exc())
-                    try:
-                        await client.disconnect()
-                    except Exception:
-                        pass
-                    pending_action.pop(user_id, None)
-                    try:
-                        await update.message.reply_text(f"❌ Ошибка авторизации.", reply_markup=main_menu_keyboard(role))
-                    except Exception:
-                        log_error("Не удалось ответить сообщением об ошибке авторизации:\n" + traceback.format_exc())
-                    return
-
-            if step == "password":
-                password = text
-                client = action.get("client")
-                phone = action.get("phone")
+        async def _run(client, progress, fmt):
+            rows = await export_members_to_xlsx_and_send(client, chat["dialog"], chat_id, bot_app, progress=progress, fmt=fmt)
+            return f"выгружено строк: {rows}" if rows else None
+
+        return chat["title"], _run
+
+    async def _run(client, progress, fmt):
+        result = await export_batch_and_send(client, chats, chat_id, bot_app, bundle=bundle, fmt=fmt, progress=progress)
+        return f"чатов: {result[0]}, строк: {result[1]}" if result else None
+
+    return f"Пакет чатов: {len(chats)}", _run
+
+
+async def _submit_export(bot_app, user_id: int, chat_id: int, client, fmt: str, chats: list, bundle: str = None,
+                         action: FlowState = None, key: str = None):
+    # задача очереди; spec сохраняется flow_store, пока задача не завершится (только для клиента из пула —
+    # по ключу его сессии задача восстанавливается)
+    title, run = _export_runner(bot_app, chat_id, chats, bundle)
+    pooled = client_pool.is_pooled(client)
+    spec = None
+    if pooled:
+        spec = {
+            "key": key or f"{user_id}-{time.time_ns()}",
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "session_key": client_pool.session_key_of(client),
+            "dialogs": [chat["id"] for chat in chats],
+            "bundle": bundle,
+            "format": fmt,
+        }
+
+    async def _job(job):
+        progress = ExportProgress(bot_app.bot, chat_id, title, job.id)
+        await progress.start()
+        try:
+            summary = await run(client, progress, fmt)
+            EXPORTS.inc(result="ok" if summary else "empty")
+            await progress.finish(f"✅ «{title}»: {summary}" if summary else f"⚠️ «{title}»: файл не сформирован")
+        except asyncio.CancelledError:
+            EXPORTS.inc(result="cancelled")
+            await progress.finish(f"⛔ «{title}»: экспорт отменен")
+            raise
+        except Exception:
+            EXPORTS.inc(result="error")
+            log_error("Ошибка экспорта участников:\n" + traceback.format_exc())
+            await progress.finish(f"❌ «{title}»: ошибка при экспорте участников")
+        finally:
+            if not pooled:
                 try:
-                    await client.sign_in(password=password)
-                    session_name, session_path = _session_filename_for_phone(phone)
-                    now = time.time()
-                    active_sessions[session_path] = {"created": now, "expiry": now + SESSION_TTL_SECONDS, "owner": user_id}
-                    log_session(f"Сессия создана (2FA) для {phone} (path={session_path}) пользователем {user_id}")
-                    await list_user_chats_and_store(client, update, user_id)
-                    return
+                    await release_client(client)
                 except Exception:
-                    log_error("Ошибка в шаге пароля sign_in:\n" + traceback.format_exc())
-                    try:
-                        await client.disconnect()
-                    except Exception:
-                        pass
+                    log_error("Не удалось отключить клиент после экспорта:\n" + traceback.format_exc())
+                if action is not None and pending_action.get(user_id) is action:
                     pending_action.pop(user_id, None)
-                    try:
-                        await update.message.reply_text(f"❌ Ошибка 2FA.", reply_markup=main_menu_keyboard(role))
-                    except Exception:
-                        log_error("Не удалось ответить ошибкой 2FA:\n" + traceback.format_exc())
-                    return
-
-        if act == "add_admin":
-            incoming = text.strip()
-            if not incoming:
-                await update.message.reply_text("❌ Неверный ID. Введите Telegram ID (число) или нажмите Отмена.", reply_markup=cancel_keyboard())
-                return
-            try:
-                new_id = int(incoming)
-            except Exception:
-                await update.message.reply_text("❌ ID должен быть числом. Введите корректный Telegram ID.", reply_markup=cancel_keyboard())
-                return
-            users = users_data
-            admins = users.get("admins", [])
-            if new_id in admins:
-                await update.message.reply_text("⚠️ Этот пользователь уже является администратором.", reply_markup=main_menu_keyboard(get_user_role(user_id)))
-            else:
-                admins.append(new_id)
-                users["admins"] = admins
-                save_users(users)
-                await update.message.reply_text(f"✅ Добавлен администратор: {new_id}", reply_markup=main_menu_keyboard(get_user_role(user_id)))
-            pending_action.pop(user_id, None)
-            return
 
-        if act == "add_operator":
-            incoming = text.strip()
-            if not incoming:
-                await update.message.reply_text("❌ Неверный ID. Введите Telegram ID (число) или нажмите Отмена.", reply_markup=cancel_keyboard())
-                return
-            try:
-                new_id = int(incoming)
-            except Exception:
-                await update.message.reply_text("❌ ID должен быть числом. Введите корректный Telegram ID.", reply_markup=cancel_keyboard())
-                return
-            users = users_data
-            ops = users.get("operators", [])
-            if new_id in ops:
-                await update.message.reply_text("⚠️ Этот пользователь уже является оператором.", reply_markup=main_menu_keyboard(get_user_role(user_id)))
-            else:
-                ops.append(new_id)
-                users["operators"] = ops
-                save_users(users)
-                await update.message.reply_text(f"✅ Добавлен оператор: {new_id}", reply_markup=main_menu_keyboard(get_user_role(user_id)))
-            pending_action.pop(user_id, None)
-            return
+    job = await scan_scheduler.submit(user_id, title, _job, spec=spec)
+    return title, job
 
-        if act == "remove_operator":
-            incoming = text.strip()
-            if not incoming:
-                await update.message.reply_text("❌ Неверный ввод. Нажмите ID оператора или введите его числом, либо нажмите Отмена.", reply_markup=cancel_keyboard())
-                return
-            try:
-                remove_id = int(incoming)
-            except Exception:
-                await update.message.reply_text("❌ ID должен быть числом. Выберите ID оператора из списка или введите его вручную.", reply_markup=cancel_keyboard())
-                return
-            users = users_data
-            ops = users.get("operators", [])
-            if remove_id not in ops:
-                await update.message.reply_text("⚠️ Такой оператор не найден.", reply_markup=main_menu_keyboard(get_user_role(user_id)))
-            else:
-                ops.remove(remove_id)
-                users["operators"] = ops
-                save_users(users)
-                await update.message.reply_text(f"✅ Оператор {remove_id} удалён.", reply_markup=main_menu_keyboard(get_user_role(user_id)))
-            pending_action.pop(user_id, None)
-            return
 
-        if act == "choose_chat":
-            dialogs = action.get("dialogs", [])
-            matched = None
-            for d in dialogs:
-                if d["title"] == text:
-                    matched = d
-                    break
-            if not matched:
-                try:
-                    await update.message.reply_text("❌ Чат не найден. Нажмите Отмена и попробуйте снова.", reply_markup=chats_keyboard([d["title"] for d in dialogs]))
-                except Exception:
-                    log_error("Не удалось отправить сообщение 'чат не найден':\n" + traceback.format_exc())
-                return
-            dialog_obj = matched.get("dialog")
-            client = action.get("client")
-            try:
-                await export_members_to_xlsx_and_send(client, dialog_obj, update.effective_chat.id, context.application)
-            except Exception:
-                log_error("Ошибка экспорта участников:\n" + traceback.format_exc())
-                try:
-                    await context.application.bot.send_message(chat_id=update.effective_chat.id, text="❌ Ошибка при экспорте участников.")
-                except Exception:
-                    log_error("Не удалось уведомить пользователя об ошибке экспорта:\n" + traceback.format_exc())
+async def _enqueue_export(update: Update, context: ContextTypes.DEFAULT_TYPE, chats: list, bundle: str = None):
+    # экспорт выполняется в фоне (scan_scheduler), обработчик только подтверждает постановку в очередь
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    bot_app = context.application
+    action = pending_action.get(user_id)
+    if action is None:
+        return
+    title, job = await _submit_export(bot_app, user_id, chat_id, action.client, action.format, chats, bundle, action)
+    ahead = scan_scheduler.position(job) - 1
+    text = f"⏳ Экспорт «{title}» поставлен в очередь"
+    text += f" (впереди задач: {ahead})." if ahead > 0 else "."
+    text += " Файл придет, когда будет готов."
+
+    # клиент из пула остается подключенным — сразу предлагаем следующий чат без повторного входа
+    if client_pool.is_pooled(action.client) and pending_action.get(user_id) is action:
+        try:
+            await bot_app.bot.send_message(
+                chat_id=chat_id,
+                text=text + "\nМожно выбрать следующий чат, ввести часть названия для поиска или нажать Отмена:",
+                reply_markup=chat_picker_keyboard(action)
+            )
+        except Exception:
+            log_error("Не удалось отправить список чатов после постановки экспорта:\n" + traceback.format_exc())
+        return
+
+    try:
+        await bot_app.bot.send_message(chat_id=chat_id, text=text)
+    except Exception:
+        log_error("Не удалось подтвердить постановку экспорта в очередь:\n" + traceback.format_exc())
+
+
+async def export_selected_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, chat: dict):
+    await _enqueue_export(update, context, [chat])
+
+
+async def export_selected_chats(update: Update, context: ContextTypes.DEFAULT_TYPE, chats: list, bundle: str):
+    # пакет чатов — одна задача очереди и один файл (книга или архив) на одном клиенте
+    await _enqueue_export(update, context, chats, bundle)
+
+
+async def resume_export(bot_app, spec: dict, client, chats) -> bool:
+    # задача, прерванная перезапуском бота: снова в очередь с тем же ключом; чаты ищутся в текущем списке аккаунта
+    found = [chats.get(dialog_id) for dialog_id in spec.get("dialogs", [])]
+    found = [chat for chat in found if chat is not None]
+    if not found:
+        return False
+    title, _ = await _submit_export(bot_app, spec["user_id"], spec["chat_id"], client, spec.get("format"), found,
+                                    spec.get("bundle"), key=spec["key"])
+    try:
+        await bot_app.bot.send_message(chat_id=spec["chat_id"], text=f"♻️ Экспорт «{title}» продолжается после перезапуска бота.")
+    except Exception:
+        log_error("Не удалось сообщить о продолжении экспорта:\n" + traceback.format_exc())
+    return True
+
+
+# -----------------------
+# === Шаги входа ===
+# -----------------------
+async def _activate_session(update: Update, user_id: int, client, phone: str, note: str):
+    # сессия авторизована: сохраняем, регистрируем срок, кладем клиент в пул и показываем чаты
+    session_key = _session_key_for_phone(phone)
+    await store_session(session_key, client)
+    now = time.time()
+    track_session(session_key, user_id, now)
+    client_pool.put(session_key, client, now + SESSION_TTL_SECONDS, user_id)
+    log_session(f"{note} для {phone} (session={session_key}) пользователем {user_id}")
+    await list_user_chats_and_store(client, update, user_id, session_key)
+
+
+async def _reply_auth(update: Update, user_id: int, text: str, what: str):
+    # ответ внутри flow входа; сообщение попадает в авторизационные и будет удалено
+    try:
+        msg = await update.message.reply_text(text, reply_markup=cancel_keyboard())
+        record_auth_message(user_id, msg.chat.id, msg.message_id, from_bot=True)
+    except Exception:
+        log_error(f"Не удалось отправить {what}:\n" + traceback.format_exc())
+
+
+async def _on_phone(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: FlowState, text: str, n: str):
+    user_id = update.effective_user.id
+    if not text or (not text[0].isdigit() and text[0] not in ["+", "8"]):
+        await _reply_auth(update, user_id, "❌ Некорректный номер. Введите в формате +79161234567 или нажмите Отмена.", "сообщение о недействительном номере")
+        return
+    phone_norm = normalize_phone(text)
+    flow.phone = phone_norm
+
+    session_key = _session_key_for_phone(phone_norm)
+    # клиент из пула уже подключен и авторизован — без connect и повторного входа
+    client = await client_pool.get(session_key)
+    if client is not None:
+        log_session(f"Клиент из пула использован для {phone_norm} (session={session_key}) пользователем {user_id}")
+        await list_user_chats_and_store(client, update, user_id, session_key)
+        return
+    # если сессия уже есть — используем её
+    if session_key in session_vault:
+        try:
+            client = new_client(session_key)
+            with STAGE_SECONDS.time(stage="connect"):
+                await client.connect()
+            await _activate_session(update, user_id, client, phone_norm, "Повторно использованная сессия активирована")
+        except Exception:
+            log_error("Не удалось использовать существующую сессию:\n" + traceback.format_exc())
             try:
                 await client.disconnect()
             except Exception:
-                log_error("Не удалось отключить клиент после экспорта:\n" + traceback.format_exc())
+                pass
+        return
+
+    # иначе отправляем код
+    await _reply_auth(update, user_id, "⏳ Отправляем код подтверждения...", "сообщение 'отправка кода'")
+    client, err, code_hash = await telethon_send_code(phone_norm)
+    if client is None:
+        text = "⚠️ Сессия уже существует." if err == "exists" else f"❌ Ошибка при отправке кода: {err}"
+        try:
+            await update.message.reply_text(text, reply_markup=main_menu_keyboard(get_user_role(user_id)))
+        except Exception:
+            log_error("Не удалось ответить об ошибке отправки кода:\n" + traceback.format_exc())
+        if pending_action.get(user_id) is flow:
             pending_action.pop(user_id, None)
-            await send_main_menu(update, user_id)
-            return
+        return
+    await _reply_auth(update, user_id, "📩 Код подтверждения отправлен. Введите его:", "запрос 'введите код'")
+    # срок flow отсчитывается заново: на ввод кода дается полный TTL
+    flow.advance(STATE_CODE)
+    flow.client = client
+    flow.code_hash = code_hash
+    flow.start_time = time.time()
 
-    # -----------------------
-    # === Главное меню: обработка кнопок ===
-    # -----------------------
-    if normalize(text) == normalize(LABEL_SCAN):
-        if role not in ["admin", "operator"]:
-            log_wrong_access(user_id, f"Попытка использовать Scan без прав")
-            await update.message.reply_text("🚫 Недостаточно прав.")
-            return
-        pending_action[user_id] = {"action": "login", "step": "phone", "start_time": time.time(), "auth_messages": []}
+
+async def _fail_sign_in(update: Update, user_id: int, flow: FlowState, text: str):
+    try:
+        await flow.client.disconnect()
+    except Exception:
+        pass
+    if pending_action.get(user_id) is flow:
+        pending_action.pop(user_id, None)
+    try:
+        await update.message.reply_text(text, reply_markup=main_menu_keyboard(get_user_role(user_id)))
+    except Exception:
+        log_error("Не удалось ответить сообщением об ошибке авторизации:\n" + traceback.format_exc())
+
+
+async def _on_code(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: FlowState, text: str, n: str):
+    user_id = update.effective_user.id
+    try:
+        with STAGE_SECONDS.time(stage="sign_in"):
+            await flow.client.sign_in(flow.phone, text, phone_code_hash=flow.code_hash)
+        await _activate_session(update, user_id, flow.client, flow.phone, "Сессия создана")
+    except SessionPasswordNeededError:
+        flow.advance(STATE_PASSWORD)
+        await _reply_auth(update, user_id, "🔒 Введите пароль 2FA:", "запрос 2FA")
+    except Exception:
+        log_error("Ошибка в шаге кода sign_in:\n" + traceback.format_exc())
+        await _fail_sign_in(update, user_id, flow, "❌ Ошибка авторизации.")
+
+
+async def _on_password(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: FlowState, text: str, n: str):
+    user_id = update.effective_user.id
+    try:
+        with STAGE_SECONDS.time(stage="sign_in"):
+            await flow.client.sign_in(password=text)
+        await _activate_session(update, user_id, flow.client, flow.phone, "Сессия создана (2FA)")
+    except Exception:
+        log_error("Ошибка в шаге пароля sign_in:\n" + traceback.format_exc())
+        await _fail_sign_in(update, user_id, flow, "❌ Ошибка 2FA.")
+
+
+# -----------------------
+# === Шаги администратора ===
+# -----------------------
+async def _read_user_id(update: Update, text: str, empty_hint: str, invalid_hint: str):
+    # Telegram ID из текста или None (подсказка уже отправлена)
+    if not text:
+        await update.message.reply_text(empty_hint, reply_markup=cancel_keyboard())
+        return None
+    try:
+        return int(text)
+    except Exception:
+        await update.message.reply_text(invalid_hint, reply_markup=cancel_keyboard())
+        return None
+
+
+async def _finish_admin_action(update: Update, user_id: int, flow: FlowState, text: str):
+    await update.message.reply_text(text, reply_markup=main_menu_keyboard(get_user_role(user_id)))
+    if pending_action.get(user_id) is flow:
+        pending_action.pop(user_id, None)
+
+
+async def _on_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: FlowState, text: str, n: str):
+    new_id = await _read_user_id(
+        update, text, "❌ Неверный ID. Введите Telegram ID (число) или нажмите Отмена.",
+        "❌ ID должен быть числом. Введите корректный Telegram ID."
+    )
+    if new_id is None:
+        return
+    if not await role_store.add_admin(new_id):
+        reply = "⚠️ Этот пользователь уже является администратором."
+    else:
+        reply = f"✅ Добавлен администратор: {new_id}"
+    await _finish_admin_action(update, update.effective_user.id, flow, reply)
+
+
+async def _on_add_operator(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: FlowState, text: str, n: str):
+    new_id = await _read_user_id(
+        update, text, "❌ Неверный ID. Введите Telegram ID (число) или нажмите Отмена.",
+        "❌ ID должен быть числом. Введите корректный Telegram ID."
+    )
+    if new_id is None:
+        return
+    if not await role_store.add_operator(new_id):
+        reply = "⚠️ Этот пользователь уже является оператором."
+    else:
+        reply = f"✅ Добавлен оператор: {new_id}"
+    await _finish_admin_action(update, update.effective_user.id, flow, reply)
+
+
+async def _on_remove_operator(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: FlowState, text: str, n: str):
+    remove_id = await _read_user_id(
+        update, text, "❌ Неверный ввод. Нажмите ID оператора или введите его числом, либо нажмите Отмена.",
+        "❌ ID должен быть числом. Выберите ID оператора из списка или введите его вручную."
+    )
+    if remove_id is None:
+        return
+    if not await role_store.remove_operator(remove_id):
+        reply = "⚠️ Такой оператор не найден."
+    else:
+        reply = f"✅ Оператор {remove_id} удалён."
+    await _finish_admin_action(update, update.effective_user.id, flow, reply)
+
+
+async def _on_set_export_format(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: FlowState, text: str, n: str):
+    user_id = update.effective_user.id
+    fmt = parse_export_format(text)
+    if fmt is None:
+        await update.message.reply_text("❌ Неизвестный формат. Выберите формат кнопкой или нажмите Отмена.", reply_markup=export_formats_keyboard())
+        return
+    await role_store.set_setting("export_format", fmt)
+    log_session(f"Формат экспорта по умолчанию изменен на {fmt} пользователем {user_id}")
+    await _finish_admin_action(update, user_id, flow, f"✅ Формат экспорта по умолчанию: {format_label(fmt)}")
+
+
+# -----------------------
+# === Выбор чата текстом ===
+# -----------------------
+async def _on_choose_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: FlowState, text: str, n: str):
+    chats = flow.chats
+    # точное совпадение названия (как при выборе кнопкой раньше) — сразу экспорт
+    exact = chats.exact(n)
+    if len(exact) == 1 and flow.selected is None:
+        await export_selected_chat(update, context, chats.get(exact[0]))
+        return
+    results = chats.search(text)
+    if not results:
         try:
-            await update.message.reply_text("📱 Введите номер телефона для входа:", reply_markup=cancel_keyboard())
+            await update.message.reply_text("❌ Чаты не найдены. Введите другую часть названия или нажмите Отмена.")
         except Exception:
-            log_error("Не удалось отправить запрос 'введите телефон':\n" + traceback.format_exc())
+            log_error("Не удалось отправить сообщение 'чат не найден':\n" + traceback.format_exc())
         return
+    flow.results = results
+    flow.page = 0
+    try:
+        await update.message.reply_text(f"Найдено чатов: {len(results)}. Выберите чат:", reply_markup=chat_picker_keyboard(flow))
+    except Exception:
+        log_error("Не удалось отправить результаты поиска чатов:\n" + traceback.format_exc())
 
-    if normalize(text) == normalize(LABEL_ADD_ADMIN):
-        if role != "admin":
-            log_wrong_access(user_id, f"Попытка добавить администратора без прав")
-            await update.message.reply_text("🚫 Только админ может это делать.")
-            return
-        pending_action[user_id] = {"action": "add_admin", "start_time": time.time(), "auth_messages": []}
-        await update.message.reply_text("Введите Telegram ID нового администратора (число):", reply_markup=cancel_keyboard())
+
+# -----------------------
+# === Главное меню ===
+# -----------------------
+async def _menu_scan(update: Update, user_id: int, role: str):
+    start_flow(user_id, STATE_PHONE)
+    track_pending(user_id)
+    try:
+        await update.message.reply_text("📱 Введите номер телефона для входа:", reply_markup=cancel_keyboard())
+    except Exception:
+        log_error("Не удалось отправить запрос 'введите телефон':\n" + traceback.format_exc())
+
+
+async def _menu_add_admin(update: Update, user_id: int, role: str):
+    start_flow(user_id, STATE_ADD_ADMIN)
+    track_pending(user_id)
+    await update.message.reply_text("Введите Telegram ID нового администратора (число):", reply_markup=cancel_keyboard())
+
+
+async def _menu_add_operator(update: Update, user_id: int, role: str):
+    start_flow(user_id, STATE_ADD_OPERATOR)
+    track_pending(user_id)
+    await update.message.reply_text("Введите Telegram ID нового оператора (число):", reply_markup=cancel_keyboard())
+
+
+async def _menu_remove_operator(update: Update, user_id: int, role: str):
+    ops = role_store.operators_list()
+    if not ops:
+        await update.message.reply_text("Операторов нет.", reply_markup=main_menu_keyboard(role))
         return
+    buttons = [[str(x)] for x in ops]
+    buttons.append([LABEL_CANCEL])
+    start_flow(user_id, STATE_REMOVE_OPERATOR)
+    track_pending(user_id)
+    await update.message.reply_text("Выберите оператора для удаления (нажмите ID) или введите ID вручную:", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
 
-    if normalize(text) == normalize(LABEL_ADD_OPERATOR):
-        if role != "admin":
-            log_wrong_access(user_id, f"Попытка добавить оператора без прав")
-            await update.message.reply_text("🚫 Только админ может это делать.")
-            return
-        pending_action[user_id] = {"action": "add_operator", "start_time": time.time(), "auth_messages": []}
-        await update.message.reply_text("Введите Telegram ID нового оператора (число):", reply_markup=cancel_keyboard())
+
+async def _menu_export_format(update: Update, user_id: int, role: str):
+    start_flow(user_id, STATE_SET_EXPORT_FORMAT)
+    track_pending(user_id)
+    await update.message.reply_text(
+        f"Текущий формат по умолчанию: {format_label(default_export_format())}. Выберите новый формат:",
+        reply_markup=export_formats_keyboard()
+    )
+
+
+async def _menu_list_operators(update: Update, user_id: int, role: str):
+    ops = role_store.operators_list()
+    if not ops:
+        await update.message.reply_text("Операторов нет.", reply_markup=main_menu_keyboard(role))
         return
+    await update.message.reply_text("Список операторов:\n" + "\n".join(str(x) for x in ops), reply_markup=main_menu_keyboard(role))
 
-    if normalize(text) == normalize(LABEL_REMOVE_OPERATOR):
-        if role != "admin":
-            log_wrong_access(user_id, f"Попытка удалить оператора без прав")
-            await update.message.reply_text("🚫 Только админ может это делать.")
-            return
-        ops = users_data.get("operators", [])
-        if not ops:
-            await update.message.reply_text("Операторов нет.", reply_markup=main_menu_keyboard(role))
-            return
-        buttons = [[str(x)] for x in ops]
-        buttons.append([LABEL_CANCEL])
-        pending_action[user_id] = {"action": "remove_operator", "start_time": time.time(), "auth_messages": []}
-        await update.message.reply_text("Выберите оператора для удаления (нажмите ID) или введите ID вручную:", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
+
+# -----------------------
+# === Таблицы маршрутизации ===
+# -----------------------
+# Подписи кнопок нормализуются один раз при импорте: выбор обработчика — одно обращение к dict,
+# стоимость разбора сообщения не зависит от числа кнопок меню и состояний flow
+CANCEL_KEY = normalize(LABEL_CANCEL)
+
+STAFF_ROLES = frozenset({"admin", "operator"})
+ADMIN_ROLES = frozenset({"admin"})
+
+# нормализованная подпись -> (обработчик, роли с доступом, запись в лог при отказе)
+MENU_ROUTES = {
+    normalize(LABEL_SCAN): (_menu_scan, STAFF_ROLES, "Попытка использовать Scan без прав"),
+    normalize(LABEL_ADD_ADMIN): (_menu_add_admin, ADMIN_ROLES, "Попытка добавить администратора без прав"),
+    normalize(LABEL_ADD_OPERATOR): (_menu_add_operator, ADMIN_ROLES, "Попытка добавить оператора без прав"),
+    normalize(LABEL_REMOVE_OPERATOR): (_menu_remove_operator, ADMIN_ROLES, "Попытка удалить оператора без прав"),
+    normalize(LABEL_EXPORT_FORMAT): (_menu_export_format, ADMIN_ROLES, "Попытка изменить формат экспорта без прав"),
+    normalize(LABEL_LIST_OPERATORS): (_menu_list_operators, ADMIN_ROLES, "Попытка получить список операторов без прав"),
+}
+
+# состояние flow -> обработчик текста; STATE_IDLE обработчика не имеет — текст идет в меню
+STATE_HANDLERS = {
+    STATE_PHONE: _on_phone,
+    STATE_CODE: _on_code,
+    STATE_PASSWORD: _on_password,
+    STATE_CHOOSE_CHAT: _on_choose_chat,
+    STATE_ADD_ADMIN: _on_add_admin,
+    STATE_ADD_OPERATOR: _on_add_operator,
+    STATE_REMOVE_OPERATOR: _on_remove_operator,
+    STATE_SET_EXPORT_FORMAT: _on_set_export_format,
+}
+
+
+# -----------------------
+# === Обработчик текстовых сообщений ===
+# -----------------------
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    text = (update.message.text or "").strip()
+    n = normalize(text)
+    role = get_user_role(user_id)
+
+    # Если пользователь без доступа — логируем и игнорируем (не отвечаем)
+    if role is None:
+        log_wrong_access(user_id, f"Неавторизованное сообщение: {text[:200]}")
+        return
+
+    flow = pending_action.get(user_id)
+    # если пользователь в pending flow — записываем входящее сообщение (чтобы потом удалить)
+    if flow is not None:
+        try:
+            record_auth_message(user_id, update.effective_chat.id, update.message.message_id, from_bot=False)
+        except Exception:
+            log_error("Не удалось записать авторизационное сообщение (сообщение пользователя):\n" + traceback.format_exc())
+
+    # Обработка Отмена
+    if n == CANCEL_KEY:
+        await reply_cancelled(update, await cancel_flow(user_id))
+        await send_main_menu(update, user_id)
         return
 
-    if normalize(text) == normalize(LABEL_LIST_OPERATORS):
-        if role != "admin":
-            log_wrong_access(user_id, f"Попытка получить список операторов без прав")
-            await update.message.reply_text("🚫 Только админ может это делать.")
+    # Если в pending flow — шаг текущего состояния
+    if flow is not None:
+        handler = STATE_HANDLERS.get(flow.state)
+        if handler is not None:
+            await handler(update, context, flow, text, n)
             return
-        ops = users_data.get("operators", [])
-        if not ops:
-            await update.message.reply_text("Операторов нет.", reply_markup=main_menu_keyboard(role))
+
+    # Кнопки главного меню
+    route = MENU_ROUTES.get(n)
+    if route is not None:
+        handler, roles, denied = route
+        if role not in roles:
+            log_wrong_access(user_id, denied)
+            await update.message.reply_text("🚫 Недостаточно прав." if roles is STAFF_ROLES else "🚫 Только админ может это делать.")
             return
-        await update.message.reply_text("Список операторов:\n" + "\n".join(str(x) for x in ops), reply_markup=main_menu_keyboard(role))
+        await handler(update, user_id, role)
         return
     try:
         await update.message.reply_text("Неизвестная команда. Используйте кнопки меню.")
@@ -0,0 +1,237 @@
+# metrics.py — метрики этапов сканирования в текстовом формате Prometheus
+# Изменения: счетчики, гистограммы и gauge'и для этапов сканирования; локальный HTTP-эндпоинт /metrics
+
+import time
+import asyncio
+import threading
+from bisect import bisect_left
+
+from utils.config import METRICS_HOST, METRICS_PORT
+from utils.logging_utils import log_session, log_error
+
+
+_registry = []
+_lock = threading.Lock()  # экспорт пишет метрики и из потоков пула
+
+
+def _label_key(labelnames: tuple, labels: dict) -> tuple:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: tuple, key: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with _lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Gauge:
+    # значение либо выставляется set(), либо берется из функции в момент запроса /metrics
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, func=None):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self._value = 0
+        _registry.append(self)
+
+    def set(self, value: float):
+        self._value = value
+
+    def render(self) -> list:
+        value = self._value
+        if self.func is not None:
+            try:
+                value = self.func()
+            except Exception:
+                value = 0
+        return [f"{self.name} {value}"]
+
+
+class _Timer:
+    def __init__(self, histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+        return False
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = labelnames
+        self._series = {}  # key -> [counts по корзинам, sum, count]
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels) -> _Timer:
+        # with STAGE_SECONDS.time(stage="connect"): await client.connect()
+        return _Timer(self, labels)
+
+    def render(self) -> list:
+        lines = []
+        with _lock:
+            items = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# -----------------------
+# === Метрики сканирования ===
+# -----------------------
+STAGE_SECONDS = Histogram(
+    "scanbot_stage_seconds",
+    "Длительность этапов: send_code, connect, sign_in, dialogs, admins, participants_fetch, render, upload",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+    labelnames=("stage",),
+)
+FETCH_ROWS_PER_SECOND = Histogram(
+    "scanbot_fetch_rows_per_second",
+    "Скорость получения участников из Telegram за один проход",
+    buckets=(10, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+ROWS_FETCHED = Counter("scanbot_rows_fetched_total", "Участников получено из Telegram", ("mode",))
+ROWS_EXPORTED = Counter("scanbot_rows_exported_total", "Строк записано в файлы экспорта")
+UPLOAD_BYTES = Counter("scanbot_upload_bytes_total", "Байт отправлено через send_document")
+FLOOD_WAIT_SECONDS = Counter("scanbot_floodwait_seconds_total", "Суммарное время FloodWait, запрошенное Telegram", ("method",))
+EXPORTS = Counter("scanbot_exports_total", "Завершенные экспорты по результату", ("result",))
+PARTICIPANTS_CACHE = Counter("scanbot_participants_cache_total", "Обновления кэша участников по типу", ("result",))
+
+# -----------------------
+# === Исходящие запросы Bot API ===
+# -----------------------
+OUTBOUND_WAIT_SECONDS = Histogram(
+    "scanbot_outbound_wait_seconds",
+    "Ожидание запроса к Bot API в очереди лимитера по приоритету",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+    labelnames=("priority",),
+)
+BOT_API_RETRY_AFTER = Counter("scanbot_bot_api_retry_after_total", "Ответы 429 (RetryAfter) от Bot API", ("priority",))
+
+
+def register_gauge(name: str, help_text: str, func) -> Gauge:
+    return Gauge(name, help_text, func)
+
+
+def record_flood_wait(exc, method: str):
+    # FloodWaitError и родственные ошибки несут время ожидания в seconds
+    seconds = getattr(exc, "seconds", None)
+    if isinstance(seconds, (int, float)) and seconds > 0:
+        FLOOD_WAIT_SECONDS.inc(seconds, method=method)
+
+
+# -----------------------
+# === HTTP-эндпоинт ===
+# -----------------------
+async def _handle_metrics_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # заголовки запроса не нужны — дочитываем до пустой строки
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if not line or line in (b"\r\n", b"\n"):
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body = render_metrics().encode("utf-8")
+            status = "200 OK"
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+            content_type = "text/plain; charset=utf-8"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+            + body
+        )
+        await writer.drain()
+    except Exception:
+        log_error("Ошибка обработки запроса /metrics:\n" + str(locals()))
+    finally:
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+_server = None
+
+
+async def start_metrics_server():
+    # только локальный адрес по умолчанию; METRICS_PORT=0 отключает эндпоинт
+    global _server
+    if not METRICS_PORT:
+        return None
+    if _server is not None:
+        # после перезапуска supervisor'ом старый event loop закрыт — освобождаем порт вручную
+        for sock in _server.sockets or ():
+            try:
+                sock.close()
+            except Exception:
+                pass
+        _server = None
+    server = await asyncio.start_server(_handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    _server = server
+    log_session(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
@@ -0,0 +1,425 @@
+# participants_cache.py — локальный кэш участников чатов (SQLite)
+# Изменения: снимок участников по dialog_id, инкрементальное обновление и single-flight для одновременных сканов
+# Изменения: время и скорость получения участников, тип обновления кэша и FloodWait пишутся в метрики
+# Изменения: участники читаются через flood_governor — FloodWait выжидается, чтение продолжается с той же страницы
+# Изменения: полный проход пишет checkpoint (смещение и число строк) вместе с каждой пачкой; после падения или
+# перезапуска скан продолжается с checkpoint'а, уже записанные строки повторно не запрашиваются
+# Изменения: проход с лимитом строк не удаляет остальных участников и не заменяет полный снимок чата
+# Изменения: продолжение с checkpoint'а — только при ожидаемых внутренностях RequestIter (Telethon 1.45, requirements.txt),
+# иначе проход идет с начала на новом итераторе
+
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from telethon.requestiter import RequestIter
+from telethon.tl.types import Channel, ChannelParticipantsRecent
+
+from utils.config import PARTICIPANTS_DB, EXPORT_BATCH_SIZE
+from utils.config import PARTICIPANTS_CACHE_FRESH_SECONDS, PARTICIPANTS_FULL_REFRESH_SECONDS, SCAN_CHECKPOINT_MAX_AGE_SECONDS
+from utils.cache_utils import SingleFlight
+from utils.logging_utils import log_session, log_error
+from utils.metrics import STAGE_SECONDS, FETCH_ROWS_PER_SECOND, ROWS_FETCHED, PARTICIPANTS_CACHE, record_flood_wait
+from utils.flood_governor import flood_governor
+
+
+# Все операции с базой идут через один поток: SQLite сериализует запись, а event loop не блокируется
+CACHE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="participants-db")
+
+
+async def run_in_cache_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(CACHE_EXECUTOR, func, *args)
+
+
+def participant_record(user) -> tuple:
+    # (user_id, username, first_name, last_name, phone, joined_ts) — то, что хранится в кэше
+    joined_ts = None
+    try:
+        part = getattr(user, "participant", None)
+        joined_attr = getattr(part, "date", None) if part is not None else None
+        if joined_attr:
+            joined_ts = int(joined_attr.timestamp())
+    except Exception:
+        joined_ts = None
+    return (
+        getattr(user, "id", None),
+        getattr(user, "username", None) or "",
+        getattr(user, "first_name", None) or "",
+        getattr(user, "last_name", None) or "",
+        getattr(user, "phone", None) or "",
+        joined_ts,
+    )
+
+
+# -----------------------
+# === Хранилище SQLite ===
+# -----------------------
+class ParticipantStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _db(self):
+        if self.conn is None:
+            conn = self._connect()
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    dialog_id INTEGER PRIMARY KEY,
+                    updated REAL NOT NULL,
+                    full_updated REAL NOT NULL,
+                    total INTEGER,
+                    complete INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS participants (
+                    dialog_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    phone TEXT,
+                    joined_ts INTEGER,
+                    gen INTEGER NOT NULL,
+                    PRIMARY KEY (dialog_id, user_id)
+                );
+                CREATE INDEX IF NOT EXISTS participants_joined ON participants (dialog_id, joined_ts);
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    dialog_id INTEGER PRIMARY KEY,
+                    gen INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    rows INTEGER NOT NULL,
+                    lim INTEGER NOT NULL,
+                    updated REAL NOT NULL
+                );
+                """
+            )
+            self.conn = conn
+        return self.conn
+
+    def get_snapshot(self, dialog_id: int):
+        with self.lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT updated, full_updated, total, complete FROM snapshots WHERE dialog_id = ?", (dialog_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            count = db.execute("SELECT COUNT(*) FROM participants WHERE dialog_id = ?", (dialog_id,)).fetchone()[0]
+        return {"updated": row[0], "full_updated": row[1], "total": row[2], "complete": bool(row[3]), "count": count}
+
+    def joined_ts_of(self, dialog_id: int, user_ids: list) -> dict:
+        # user_id -> joined_ts для уже известных участников
+        if not user_ids:
+            return {}
+        with self.lock:
+            placeholders = ",".join("?" * len(user_ids))
+            rows = self._db().execute(
+                f"SELECT user_id, joined_ts FROM participants WHERE dialog_id = ? AND user_id IN ({placeholders})",
+                (dialog_id, *user_ids),
+            ).fetchall()
+        return dict(rows)
+
+    def get_checkpoint(self, dialog_id: int):
+        with self.lock:
+            row = self._db().execute(
+                "SELECT gen, offset, rows, lim, updated FROM checkpoints WHERE dialog_id = ?", (dialog_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"gen": row[0], "offset": row[1], "rows": row[2], "limit": row[3], "updated": row[4]}
+
+    def drop_checkpoint(self, dialog_id: int):
+        with self.lock:
+            db = self._db()
+            with db:
+                db.execute("DELETE FROM checkpoints WHERE dialog_id = ?", (dialog_id,))
+
+    def upsert(self, dialog_id: int, records: list, gen: int, checkpoint: tuple = None):
+        # checkpoint (offset, rows, limit) пишется в той же транзакции, что и пачка: после падения
+        # checkpoint никогда не опережает записанные строки
+        with self.lock:
+            db = self._db()
+            with db:
+                if checkpoint is not None:
+                    db.execute(
+                        "INSERT OR REPLACE INTO checkpoints (dialog_id, gen, offset, rows, lim, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                        (dialog_id, gen, *checkpoint, time.time()),
+                    )
+                db.executemany(
+                    "INSERT INTO participants (dialog_id, user_id, username, first_name, last_name, phone, joined_ts, gen) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (dialog_id, user_id) DO UPDATE SET username = excluded.username, "
+                    "first_name = excluded.first_name, last_name = excluded.last_name, phone = excluded.phone, "
+                    "joined_ts = excluded.joined_ts, gen = excluded.gen",
+                    [(dialog_id, *r, gen) for r in records],
+                )
+
+    def finish_full(self, dialog_id: int, gen: int, total, complete: bool):
+        # полный проход: все, кто не встретился, покинули чат. Проход с лимитом видел только часть участников —
+        # остальные строки и описание снимка (в том числе полного) не трогаем, записанные строки просто обновлены
+        now = time.time()
+        with self.lock:
+            db = self._db()
+            with db:
+                db.execute("DELETE FROM checkpoints WHERE dialog_id = ?", (dialog_id,))
+                if complete:
+                    db.execute("DELETE FROM participants WHERE dialog_id = ? AND gen != ?", (dialog_id, gen))
+                    db.execute(
+                        "INSERT OR REPLACE INTO snapshots (dialog_id, updated, full_updated, total, complete) VALUES (?, ?, ?, ?, ?)",
+                        (dialog_id, now, now, total, 1),
+                    )
+                else:
+                    db.execute(
+                        "INSERT OR IGNORE INTO snapshots (dialog_id, updated, full_updated, total, complete) VALUES (?, ?, ?, ?, ?)",
+                        (dialog_id, now, now, total, 0),
+                    )
+
+    def apply_delta(self, dialog_id: int, records: list, gen: int, total):
+        with self.lock:
+            db = self._db()
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO participants (dialog_id, user_id, username, first_name, last_name, phone, joined_ts, gen) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(dialog_id, *r, gen) for r in records],
+                )
+                db.execute("UPDATE snapshots SET updated = ?, total = ? WHERE dialog_id = ?", (time.time(), total, dialog_id))
+
+    def open_reader(self, dialog_id: int, limit: int = 0):
+        # отдельное соединение на чтение: экспорт читает снимок пачками, пока другие сканы пишут
+        conn = self._connect()
+        sql = (
+            "SELECT user_id, username, first_name, last_name, phone, joined_ts FROM participants "
+            "WHERE dialog_id = ? ORDER BY joined_ts DESC, user_id"
+        )
+        params = (dialog_id,)
+        if limit:
+            sql += " LIMIT ?"
+            params = (dialog_id, limit)
+        return conn, conn.execute(sql, params)
+
+
+participants_store = ParticipantStore(PARTICIPANTS_DB)
+_refresh_flights = SingleFlight()
+
+
+# -----------------------
+# === Обновление снимка ===
+# -----------------------
+async def refresh_participants(client, entity, dialog_id: int, limit: int = 0, progress=None):
+    # одновременные сканы одного чата разделяют один запрос к Telegram (прогресс видит тот, кто его начал)
+    snap = await _refresh_flights.run(dialog_id, lambda: _refresh(client, entity, dialog_id, limit, progress))
+    if snap and not snap["complete"] and (not limit or snap["count"] < limit):
+        # присоединились к сканированию с меньшим лимитом — догружаем сами
+        snap = await _refresh_flights.run(dialog_id, lambda: _refresh(client, entity, dialog_id, limit, progress))
+    return snap
+
+
+async def _refresh(client, entity, dialog_id: int, limit: int, progress=None):
+    snap = await run_in_cache_executor(participants_store.get_snapshot, dialog_id)
+    now = time.time()
+    if snap and snap["complete"]:
+        if now - snap["updated"] < PARTICIPANTS_CACHE_FRESH_SECONDS:
+            log_session(f"Участники чата {dialog_id} взяты из кэша ({snap['count']})")
+            PARTICIPANTS_CACHE.inc(result="fresh")
+            return snap
+        if now - snap["full_updated"] < PARTICIPANTS_FULL_REFRESH_SECONDS and isinstance(entity, Channel):
+            if await _refresh_incremental(client, entity, dialog_id, snap):
+                PARTICIPANTS_CACHE.inc(result="incremental")
+                return await run_in_cache_executor(participants_store.get_snapshot, dialog_id)
+    resumed = await _refresh_full(client, entity, dialog_id, limit, progress)
+    PARTICIPANTS_CACHE.inc(result="resumed" if resumed else "full")
+    return await run_in_cache_executor(participants_store.get_snapshot, dialog_id)
+
+
+def _observe_fetch(mode: str, started: float, cnt: int):
+    elapsed = time.monotonic() - started
+    STAGE_SECONDS.observe(elapsed, stage="participants_fetch")
+    ROWS_FETCHED.inc(cnt, mode=mode)
+    if cnt and elapsed > 0:
+        FETCH_ROWS_PER_SECOND.observe(cnt / elapsed)
+
+
+def _request_offset(it):
+    # смещение следующей страницы у итератора участников канала; у обычной группы (все участники
+    # приходят одним запросом) его нет — такой скан не пишет checkpoint
+    offset = getattr(getattr(it, "requests", None), "offset", None)
+    return offset if isinstance(offset, int) else None
+
+
+def _page_done(it) -> bool:
+    buffer = getattr(it, "buffer", None)
+    return isinstance(buffer, list) and getattr(it, "index", 0) >= len(buffer)
+
+
+def _seekable(it) -> bool:
+    # _seek опирается на внутренности RequestIter, проверенные на версии Telethon из requirements.txt;
+    # если их нет или они другого типа, продолжать с checkpoint'а нельзя
+    return (
+        isinstance(it, RequestIter)
+        and callable(getattr(it, "_init", None))
+        and isinstance(getattr(it, "kwargs", None), dict)
+        and isinstance(getattr(it, "limit", None), (int, float))
+    )
+
+
+async def _seek(it, offset: int, rows: int) -> bool:
+    # RequestIter Telethon: инициализация без первой страницы, затем смещение запроса берется из checkpoint'а
+    it.buffer = []
+    if await it._init(**it.kwargs):
+        it.left = len(it.buffer)
+        return False
+    if _request_offset(it) is None or not isinstance(it.buffer, list) or it.buffer:
+        return False
+    it.requests.offset = offset
+    it.left = it.limit - rows
+    return True
+
+
+async def _resume_point(client, raw, dialog_id: int, limit: int):
+    # (gen, offset, rows) незавершенного прохода с тем же лимитом или None; устаревший checkpoint удаляется.
+    # При None состояние raw могло измениться — проход с начала идет на новом итераторе
+    cp = await run_in_cache_executor(participants_store.get_checkpoint, dialog_id)
+    if cp is None:
+        return None
+    if cp["limit"] != limit or time.time() - cp["updated"] > SCAN_CHECKPOINT_MAX_AGE_SECONDS:
+        await run_in_cache_executor(participants_store.drop_checkpoint, dialog_id)
+        return None
+    if not _seekable(raw):
+        log_session(f"Итератор участников не поддерживает продолжение — чат {dialog_id} сканируется с начала")
+        return None
+    try:
+        if not await flood_governor.call(client, "participants", _seek, raw, cp["offset"], cp["rows"]):
+            return None
+    except (AttributeError, TypeError):
+        log_error(f"Не удалось продолжить скан чата {dialog_id} с checkpoint'а, скан с начала:\n" + traceback.format_exc())
+        return None
+    return cp["gen"], cp["offset"], cp["rows"]
+
+
+def _participants_stream(client, entity, limit: int, progress=None):
+    raw = client.iter_participants(entity, limit=limit or None)
+    return raw, flood_governor.stream(
+        client, "participants", raw,
+        on_wait=progress.note_wait if progress is not None else None,
+    )
+
+
+async def _refresh_full(client, entity, dialog_id: int, limit: int, progress=None) -> bool:
+    # True — проход продолжен с checkpoint'а
+    gen = time.time_ns()
+    started = time.monotonic()
+    raw, it = _participants_stream(client, entity, limit, progress)
+    cnt = 0
+    resumed = await _resume_point(client, raw, dialog_id, limit)
+    if resumed is not None:
+        gen, offset, cnt = resumed
+        log_session(f"Сканирование участников чата {dialog_id} продолжается с checkpoint: смещение {offset}, строк {cnt}")
+    else:
+        raw, it = _participants_stream(client, entity, limit, progress)
+    from_checkpoint = cnt
+    # последняя полностью прочитанная страница: (смещение следующей, строк до нее); пишется вместе с пачкой
+    page_mark = None
+    # в полете не больше одной пачки: пока поток пишет предыдущую, получаем следующую
+    pending_write = None
+    batch = []
+    try:
+        async for user in it:
+            batch.append(participant_record(user))
+            cnt += 1
+            if _page_done(raw):
+                offset = _request_offset(raw)
+                if offset is not None:
+                    page_mark = (offset, cnt, limit)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                if pending_write is not None:
+                    await pending_write
+                pending_write = asyncio.ensure_future(
+                    run_in_cache_executor(participants_store.upsert, dialog_id, batch, gen, page_mark)
+                )
+                batch = []
+                if progress is not None:
+                    progress.update(cnt, limit or getattr(it, "total", None))
+        if pending_write is not None:
+            await pending_write
+            pending_write = None
+        if batch:
+            await run_in_cache_executor(participants_store.upsert, dialog_id, batch, gen)
+    except Exception as e:
+        record_flood_wait(e, "participants")
+        raise
+    finally:
+        if pending_write is not None and not pending_write.done():
+            try:
+                await pending_write
+            except Exception:
+                pass
+    _observe_fetch("full", started, cnt - from_checkpoint)
+    complete = not limit or cnt < limit
+    await run_in_cache_executor(participants_store.finish_full, dialog_id, gen, getattr(it, "total", None), complete)
+    log_session(f"Полное обновление участников чата {dialog_id}: {cnt}")
+    return resumed is not None
+
+
+async def _refresh_incremental(client, entity, dialog_id: int, snap: dict) -> bool:
+    # Recent отдает участников от недавно вступивших к давним: читаем, пока не встретим уже известного
+    # участника с той же датой вступления. Если после этого число участников сходится с total —
+    # ушедших нет и дельты достаточно, иначе нужен полный проход.
+    gen = time.time_ns()
+    started = time.monotonic()
+    it = flood_governor.stream(client, "participants", client.iter_participants(entity, filter=ChannelParticipantsRecent()))
+    delta = []
+    added = 0
+    page = []
+    overlap = False
+    fetched = 0
+    try:
+        async for user in it:
+            page.append(participant_record(user))
+            fetched += 1
+            if len(page) < 100:
+                continue
+            added, overlap = await _merge_page(dialog_id, page, delta, added)
+            page = []
+            if overlap:
+                break
+            if len(delta) > EXPORT_BATCH_SIZE * 10:
+                return False
+        if page and not overlap:
+            added, overlap = await _merge_page(dialog_id, page, delta, added)
+    except Exception as e:
+        record_flood_wait(e, "participants")
+        raise
+    finally:
+        _observe_fetch("incremental", started, fetched)
+
+    total = getattr(it, "total", None)
+    if total is None or snap["count"] + added != total:
+        return False
+    await run_in_cache_executor(participants_store.apply_delta, dialog_id, delta, gen, total)
+    log_session(f"Инкрементальное обновление участников чата {dialog_id}: +{added}")
+    return True
+
+
+async def _merge_page(dialog_id: int, page: list, delta: list, added: int):
+    known = await run_in_cache_executor(participants_store.joined_ts_of, dialog_id, [r[0] for r in page])
+    for rec in page:
+        if rec[0] in known and known[rec[0]] == rec[5]:
+            return added, True
+        if rec[0] not in known:
+            added += 1
+        delta.append(rec)
+    return added, False
@@ -0,0 +1,128 @@
+# progress.py — статус выполнения экспорта
+# Изменения: одно сообщение со счетчиком строк, скоростью и ETA; правки не чаще PROGRESS_MIN_INTERVAL_SECONDS
+# Изменения: единица счетчика задается этапом (строки или чаты пакетного экспорта)
+# Изменения: промежуточные правки статуса идут в лимитере после ответов пользователю, итоговая — наравне с ними
+# Изменения: во время FloodWait статус показывает, сколько Telegram просит подождать
+
+import time
+import asyncio
+
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+
+from utils.config import PROGRESS_MIN_INTERVAL_SECONDS, LABEL_CANCEL
+from utils.logging_utils import log_error
+from utils.rate_limiter import PRIORITY_INTERACTIVE, PRIORITY_PROGRESS, priority_args
+
+# callback_data кнопки отмены конкретного сканирования: "scan:cancel:<job_id>"
+CB_SCAN_CANCEL = "scan:cancel:"
+
+STAGE_TITLES = {
+    "fetch": "получение участников",
+    "write": "формирование файла",
+    "upload": "отправка файла",
+}
+
+
+def _fmt_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    return f"{seconds // 60} мин {seconds % 60:02d} с"
+
+
+class ExportProgress:
+    def __init__(self, bot, chat_id: int, title: str, job_id: int = None, min_interval: float = PROGRESS_MIN_INTERVAL_SECONDS):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.title = title
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.message_id = None
+        self.stage = "fetch"
+        self.unit = "Строк"
+        self.done = 0
+        self.total = None
+        self.started = time.monotonic()
+        self.stage_started = self.started
+        self._last_edit = 0.0
+        self._last_text = None
+        self._edit_task = None
+        self.wait_until = 0.0
+
+    def _markup(self):
+        if self.job_id is None:
+            return None
+        return InlineKeyboardMarkup([[InlineKeyboardButton(LABEL_CANCEL, callback_data=f"{CB_SCAN_CANCEL}{self.job_id}")]])
+
+    def _text(self) -> str:
+        elapsed = time.monotonic() - self.stage_started
+        text = f"⏳ «{self.title}»: {STAGE_TITLES.get(self.stage, self.stage)}"
+        if self.done:
+            text += f"\n{self.unit}: {self.done}" + (f" из {self.total}" if self.total else "")
+            if elapsed > 0:
+                rate = self.done / elapsed
+                text += f"\nСкорость: {round(rate) if rate >= 10 else round(rate, 1)} {self.unit.lower()}/с"
+                if self.total and rate > 0 and self.total > self.done:
+                    text += f"\nОсталось: ~{_fmt_seconds((self.total - self.done) / rate)}"
+        wait = self.wait_until - time.monotonic()
+        if wait > 0:
+            text += f"\nTelegram ограничил запросы, продолжение через ~{_fmt_seconds(wait)}"
+        return text
+
+    async def start(self):
+        try:
+            msg = await self.bot.send_message(chat_id=self.chat_id, text=self._text(), reply_markup=self._markup())
+            self.message_id = msg.message_id
+            self._last_edit = time.monotonic()
+        except Exception:
+            log_error("Не удалось отправить статус экспорта:\n" + str(locals()))
+
+    def set_stage(self, stage: str, total: int = None, unit: str = "Строк"):
+        self.stage = stage
+        self.unit = unit
+        self.done = 0
+        self.total = total
+        self.stage_started = time.monotonic()
+        self._schedule_edit(force=True)
+
+    def note_wait(self, seconds: float):
+        # FloodWait при получении участников: уже полученное сохраняется, чтение продолжится после ожидания
+        self.wait_until = time.monotonic() + seconds
+        self._schedule_edit(force=True)
+
+    def update(self, done: int, total: int = None):
+        # вызывается на каждой пачке строк; сама правка сообщения не блокирует экспорт
+        self.done = done
+        if total:
+            self.total = total
+        self._schedule_edit()
+
+    def _schedule_edit(self, force: bool = False):
+        if self.message_id is None:
+            return
+        if self._edit_task is not None and not self._edit_task.done():
+            return
+        if not force and time.monotonic() - self._last_edit < self.min_interval:
+            return
+        self._last_edit = time.monotonic()
+        self._edit_task = asyncio.ensure_future(self._edit(self._text(), self._markup()))
+
+    async def _edit(self, text: str, markup, priority: int = PRIORITY_PROGRESS):
+        if text == self._last_text:
+            return
+        self._last_text = text
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id, message_id=self.message_id, text=text, reply_markup=markup,
+                **priority_args(self.bot, priority),
+            )
+        except Exception:
+            log_error("Не удалось обновить статус экспорта:\n" + str(locals()))
+
+    async def finish(self, text: str):
+        if self._edit_task is not None and not self._edit_task.done():
+            self._edit_task.cancel()
+        if self.message_id is None:
+            return
+        total_time = _fmt_seconds(time.monotonic() - self.started)
+        await self._edit(f"{text} ({total_time})", None, PRIORITY_INTERACTIVE)
@@ -0,0 +1,251 @@
+# rate_limiter.py — исходящие запросы к Bot API с учетом лимитов Telegram
+# Изменения: общий лимитер Application: глобальный token bucket и bucket на чат, очередь по приоритетам
+# (ответы пользователю -> статус экспорта -> файлы -> удаление сообщений), повтор запроса после 429 (RetryAfter)
+
+import time
+import asyncio
+from collections import deque
+
+from telegram import InputFile
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from utils.config import RATE_LIMIT_GLOBAL_PER_SECOND, RATE_LIMIT_GLOBAL_BURST, RATE_LIMIT_CHAT_PER_SECOND, RATE_LIMIT_CHAT_BURST
+from utils.config import RATE_LIMIT_GROUP_PER_MINUTE, RATE_LIMIT_MAX_RETRIES
+from utils.logging_utils import log_session
+from utils.metrics import OUTBOUND_WAIT_SECONDS, BOT_API_RETRY_AFTER, register_gauge
+
+
+# Приоритеты: меньше — раньше. По умолчанию приоритет определяется методом (ENDPOINT_PRIORITY),
+# вызывающий код может задать его явно через rate_limit_args (см. priority_args)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PROGRESS = 1
+PRIORITY_DOCUMENT = 2
+PRIORITY_CLEANUP = 3
+PRIORITY_NAMES = ("interactive", "progress", "document", "cleanup")
+
+ENDPOINT_PRIORITY = {
+    "sendDocument": PRIORITY_DOCUMENT,
+    "deleteMessage": PRIORITY_CLEANUP,
+    "deleteMessages": PRIORITY_CLEANUP,
+}
+
+# лимиты Telegram касаются отправки и изменения сообщений; getMe, answerCallbackQuery и т.п. идут без очереди
+_LIMITED_PREFIXES = ("send", "edit", "delete", "copy", "forward")
+# удаление не считается отправкой в чат — для него действует только глобальный лимит
+_GLOBAL_ONLY_PREFIXES = ("delete",)
+
+# сколько bucket'ов чатов держать, прежде чем выбросить простаивающие (полные)
+_MAX_IDLE_CHAT_BUCKETS = 1024
+
+
+def priority_args(bot, priority: int) -> dict:
+    # rate_limit_args допустим только при заданном лимитере (иначе PTB бросает ValueError)
+    if getattr(bot, "rate_limiter", None) is None:
+        return {}
+    return {"rate_limit_args": priority}
+
+
+def _chat_key(chat_id):
+    # chat_id приходит как int или строка ("123", "@channel"); числовые строки приводятся к одному ключу с int
+    if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+        return int(chat_id)
+    return chat_id
+
+
+def _retry_seconds(exc: RetryAfter) -> float:
+    # retry_after в PTB — int или timedelta в зависимости от настроек библиотеки
+    value = exc.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+def _rewind_files(data: dict):
+    # повторная отправка файла: поток буфера уже прочитан первой попыткой
+    for value in data.values():
+        if isinstance(value, InputFile) and hasattr(value.input_file_content, "seek"):
+            value.input_file_content.seek(0)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        # 0 — запрос можно отправить сейчас, иначе — через сколько секунд появится токен
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, until: float):
+        # после 429 чат (или весь бот) молчит до until и начинает с пустого bucket'а
+        self.paused_until = max(self.paused_until, until)
+        self.tokens = 0.0
+        self.updated = until
+
+    def idle(self, now: float) -> bool:
+        return now >= self.paused_until and self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    # Запросы ждут в очередях по приоритету; диспетчер выдает разрешение первому запросу самой важной очереди,
+    # у чата которого есть токен, — занятый чат не задерживает запросы в другие чаты
+    def __init__(
+        self,
+        global_per_second: float = RATE_LIMIT_GLOBAL_PER_SECOND,
+        global_burst: int = RATE_LIMIT_GLOBAL_BURST,
+        chat_per_second: float = RATE_LIMIT_CHAT_PER_SECOND,
+        chat_burst: int = RATE_LIMIT_CHAT_BURST,
+        group_per_minute: float = RATE_LIMIT_GROUP_PER_MINUTE,
+        max_retries: int = RATE_LIMIT_MAX_RETRIES,
+    ):
+        self.chat_per_second = chat_per_second
+        self.chat_burst = chat_burst
+        self.group_per_second = group_per_minute / 60
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_per_second, global_burst)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._queues = [deque() for _ in PRIORITY_NAMES]  # (future, chat_id или None)
+        self._wakeup = None
+        self._dispatcher = None
+        self._loop = None
+        self._closed = False
+
+    # --- жизненный цикл (вызывается Application) ---
+    async def initialize(self):
+        self._closed = False
+        self._start()
+
+    async def shutdown(self):
+        # запросы после остановки (итоговые сообщения отменяемых задач) идут без очереди — ждать их некому
+        self._closed = True
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for queue in self._queues:
+            while queue:
+                future, _ = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+
+    def _start(self):
+        # после перезапуска run_polling supervisor'ом диспетчер создается заново в новом event loop
+        # (ожидающие старого loop'а уже не дождутся); в том же loop'е очередь сохраняется
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._dispatcher is not None and not self._dispatcher.done():
+            return
+        if self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._queues = [deque() for _ in PRIORITY_NAMES]
+        self._dispatcher = loop.create_task(self._dispatch())
+
+    def queued(self) -> int:
+        # не __len__: ExtBot проверяет лимитер как `if not self.rate_limiter`, пустая очередь отключила бы его
+        return sum(len(q) for q in self._queues)
+
+    # --- bucket'ы ---
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_IDLE_CHAT_BUCKETS:
+                now = time.monotonic()
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            # отрицательный id (или @username) — группа или канал: лимит в минуту
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            rate = self.group_per_second if is_group else self.chat_per_second
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    # --- диспетчер ---
+    def _grant_ready(self):
+        # выдает разрешения, пока есть глобальный токен; возвращает, через сколько проверить снова (None — ждать нового запроса)
+        now = time.monotonic()
+        while True:
+            global_wait = self.global_bucket.wait_time(now)
+            soonest = None
+            granted = False
+            for queue in self._queues:
+                for i, (future, chat_id) in enumerate(queue):
+                    if future.done():
+                        continue
+                    wait = 0.0 if chat_id is None else self._chat_bucket(chat_id).wait_time(now)
+                    if wait > 0:
+                        soonest = wait if soonest is None else min(soonest, wait)
+                        continue
+                    if global_wait > 0:
+                        return global_wait
+                    del queue[i]
+                    self.global_bucket.take()
+                    if chat_id is not None:
+                        self._chat_bucket(chat_id).take()
+                    future.set_result(None)
+                    granted = True
+                    break
+                if granted:
+                    break
+                # отмененные запросы (таймаут вызывающей стороны) выбрасываются из очереди
+                while queue and queue[0][0].done():
+                    queue.popleft()
+            if not granted:
+                return soonest
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._grant_ready()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, priority: int, chat_id):
+        self._start()
+        future = self._loop.create_future()
+        self._queues[priority].append((future, chat_id))
+        self._wakeup.set()
+        await future
+
+    # --- интерфейс BaseRateLimiter ---
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if self._closed or not endpoint.startswith(_LIMITED_PREFIXES):
+            return await callback(*args, **kwargs)
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else ENDPOINT_PRIORITY.get(endpoint, PRIORITY_INTERACTIVE)
+        priority = min(max(priority, 0), len(PRIORITY_NAMES) - 1)
+        chat_id = None if endpoint.startswith(_GLOBAL_ONLY_PREFIXES) else _chat_key(data.get("chat_id"))
+
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            await self._acquire(priority, chat_id)
+            OUTBOUND_WAIT_SECONDS.observe(time.monotonic() - started, priority=PRIORITY_NAMES[priority])
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                delay = _retry_seconds(e)
+                BOT_API_RETRY_AFTER.inc(priority=PRIORITY_NAMES[priority])
+                log_session(f"Bot API 429 для {endpoint} (chat={data.get('chat_id')}): пауза {delay} с, повтор {attempt}")
+                # 429 на запрос в чат — пауза этого чата; без чата — пауза всех запросов
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.pause(time.monotonic() + delay)
+                _rewind_files(data)
+
+
+# один лимитер на процесс: лимиты Telegram действуют на бота целиком
+outbound_limiter = PriorityRateLimiter()
+register_gauge("scanbot_outbound_queue", "Запросы к Bot API, ожидающие очереди лимитера", outbound_limiter.queued)
@@ -0,0 +1,144 @@
+# scan_jobs.py — фоновое выполнение сканирований
+# Изменения: очередь задач экспорта с пулом воркеров, лимитом на оператора и общим бюджетом памяти
+# Изменения: отмена задач оператора — из очереди и выполняющихся
+# Изменения: у задачи может быть описание (spec) — по нему flow_store сохраняет задачу и запускает ее снова после перезапуска
+
+import time
+import asyncio
+import itertools
+from collections import deque
+
+from utils.config import SCAN_WORKERS, SCAN_JOBS_PER_USER, SCAN_MEMORY_BUDGET_BYTES, SCAN_JOB_MEMORY_ESTIMATE
+from utils.logging_utils import log_session, log_error
+from utils.metrics import register_gauge
+
+
+class ScanJob:
+    __slots__ = ("id", "user_id", "title", "factory", "memory", "spec", "task", "created", "started")
+
+    def __init__(self, job_id: int, user_id: int, title: str, factory, memory: int, spec: dict = None):
+        self.id = job_id
+        self.user_id = user_id
+        self.title = title
+        self.factory = factory
+        self.memory = memory
+        self.spec = spec
+        self.task = None
+        self.created = time.time()
+        self.started = None
+
+
+class ScanScheduler:
+    # Воркер берет первую задачу, которую можно запустить: у оператора меньше per_user задач
+    # в работе и суммарная оценка памяти укладывается в бюджет (одна задача запускается всегда)
+    def __init__(self, workers: int, per_user: int, memory_budget: int):
+        self.workers = workers
+        self.per_user = per_user
+        self.memory_budget = memory_budget
+        self._queue = deque()
+        self._running = {}  # user_id -> set(ScanJob)
+        self._memory_used = 0
+        self._cond = None
+        self._worker_tasks = []
+        self._loop = None
+        self._ids = itertools.count(1)
+
+    def start(self):
+        # после перезапуска run_polling supervisor'ом воркеры создаются заново в новом event loop;
+        # задачи старого loop'а выполнить уже нельзя — сохраненные flow_store задачи запускаются заново
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue.clear()
+        self._running.clear()
+        self._memory_used = 0
+        self._cond = asyncio.Condition()
+        self._worker_tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def _runnable_index(self):
+        running_total = sum(len(jobs) for jobs in self._running.values())
+        for i, job in enumerate(self._queue):
+            if len(self._running.get(job.user_id, ())) >= self.per_user:
+                continue
+            if running_total and self._memory_used + job.memory > self.memory_budget:
+                continue
+            return i
+        return None
+
+    async def submit(self, user_id: int, title: str, factory, memory: int = SCAN_JOB_MEMORY_ESTIMATE, spec: dict = None) -> ScanJob:
+        # factory(job) возвращает корутину экспорта; spec — JSON-совместимое описание задачи для восстановления
+        job = ScanJob(next(self._ids), user_id, title, factory, memory, spec)
+        async with self._cond:
+            self._queue.append(job)
+            self._cond.notify_all()
+        log_session(f"Задача сканирования #{job.id} ({title}) поставлена в очередь пользователем {user_id}")
+        return job
+
+    def position(self, job: ScanJob) -> int:
+        # 0 — уже выполняется
+        for i, queued in enumerate(self._queue):
+            if queued is job:
+                return i + 1
+        return 0
+
+    async def cancel(self, user_id: int, job_id: int = None) -> int:
+        # отменяет задачи оператора (или одну задачу job_id); возвращает число отмененных
+        cancelled = 0
+        async with self._cond:
+            for job in list(self._queue):
+                if job.user_id == user_id and (job_id is None or job.id == job_id):
+                    self._queue.remove(job)
+                    cancelled += 1
+            for job in self._running.get(user_id, ()):
+                if (job_id is None or job.id == job_id) and job.task is not None and not job.task.done():
+                    job.task.cancel()
+                    cancelled += 1
+        if cancelled:
+            log_session(f"Отменено задач сканирования пользователя {user_id}: {cancelled}")
+        return cancelled
+
+    def specs(self) -> dict:
+        # ключ задачи -> spec для задач в очереди и в работе
+        jobs = list(self._queue) + [job for running in self._running.values() for job in running]
+        return {job.spec["key"]: job.spec for job in jobs if job.spec is not None}
+
+    def has_active(self, user_id: int) -> bool:
+        return bool(self._running.get(user_id)) or any(job.user_id == user_id for job in self._queue)
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._runnable_index() is not None)
+                i = self._runnable_index()
+                job = self._queue[i]
+                del self._queue[i]
+                self._running.setdefault(job.user_id, set()).add(job)
+                self._memory_used += job.memory
+            job.started = time.time()
+            job.task = asyncio.ensure_future(job.factory(job))
+            try:
+                # wait, а не await job.task: отмена задачи пользователем не должна выглядеть как отмена воркера
+                await asyncio.wait({job.task})
+                error = None if job.task.cancelled() else job.task.exception()
+                if error is not None:
+                    log_error(f"Задача сканирования #{job.id} завершилась с ошибкой:\n" + str(locals()))
+            except asyncio.CancelledError:
+                # остановка самого воркера (завершение приложения) — задача отменяется вместе с ним
+                job.task.cancel()
+                raise
+            finally:
+                async with self._cond:
+                    jobs = self._running.get(job.user_id)
+                    if jobs is not None:
+                        jobs.discard(job)
+                        if not jobs:
+                            self._running.pop(job.user_id, None)
+                    self._memory_used -= job.memory
+                    self._cond.notify_all()
+                log_session(f"Задача сканирования #{job.id} завершена за {time.time() - job.started:.1f} с")
+
+
+scan_scheduler = ScanScheduler(SCAN_WORKERS, SCAN_JOBS_PER_USER, SCAN_MEMORY_BUDGET_BYTES)
+register_gauge("scanbot_scan_jobs_queued", "Задачи сканирования в очереди", lambda: len(scan_scheduler._queue))
+register_gauge("scanbot_scan_jobs_running", "Выполняющиеся задачи сканирования", lambda: sum(len(j) for j in scan_scheduler._running.values()))
@@ -0,0 +1,115 @@
+# session_vault.py — зашифрованное хранилище сессий Telethon
+# Изменения: все сессии хранятся в одном файле (Fernet-ключ из user_management) вместо SQLite-файла на каждый телефон
+# Изменения: шифрование и запись хранилища — в потоке VAULT_EXECUTOR с fsync перед заменой, event loop не блокируется
+
+import os
+import json
+import time
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.config import SESSIONS_VAULT_FILE, SESSIONS_DIR, SESSION_TTL_SECONDS
+from utils.user_management import fernet
+from utils.logging_utils import log_session, log_error
+
+# один поток: записи выполняются в порядке вызова, более поздний снимок не перезаписывается более ранним
+VAULT_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions-vault")
+
+
+class SessionVault:
+    # session_key -> {"session": строка StringSession, "created": ts}; поиск и удаление — по ключу словаря
+    def __init__(self, path: str):
+        self.path = path
+        self._sessions = None
+
+    def _data(self) -> dict:
+        if self._sessions is None:
+            self._sessions = self._load()
+        return self._sessions
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            if not data:
+                return {}
+            return json.loads(fernet.decrypt(data).decode())
+        except Exception:
+            log_error("Не удалось прочитать хранилище сессий:\n" + traceback.format_exc())
+            return {}
+
+    def _write(self, data: dict) -> bool:
+        # запись во временный файл и атомарная замена: файл хранилища никогда не остается наполовину записанным
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(fernet.encrypt(json.dumps(data).encode()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            return True
+        except Exception:
+            log_error("Не удалось сохранить хранилище сессий:\n" + traceback.format_exc())
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+
+    async def _save(self) -> bool:
+        # снимок берется в event loop, шифрование и запись — в потоке VAULT_EXECUTOR
+        data = {k: dict(v) for k, v in self._data().items()}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(VAULT_EXECUTOR, self._write, data)
+
+    def get(self, session_key: str):
+        entry = self._data().get(session_key)
+        return entry["session"] if entry else None
+
+    def __contains__(self, session_key: str) -> bool:
+        return session_key in self._data()
+
+    async def set(self, session_key: str, session_string: str, created: float = None):
+        self._data()[session_key] = {"session": session_string, "created": created or time.time()}
+        await self._save()
+
+    def created(self) -> dict:
+        # session_key -> время создания/последнего сохранения сессии
+        return {k: v.get("created", 0) for k, v in self._data().items()}
+
+    async def delete(self, session_key: str) -> bool:
+        if self._data().pop(session_key, None) is None:
+            return False
+        await self._save()
+        return True
+
+    def purge_expired(self, ttl: float = SESSION_TTL_SECONDS) -> int:
+        # вызывается при запуске, до event loop, — запись синхронная
+        now = time.time()
+        expired = [k for k, v in self._data().items() if now >= v.get("created", 0) + ttl]
+        for k in expired:
+            self._data().pop(k, None)
+        if expired:
+            self._write(self._data())
+            log_session(f"Удалены устаревшие сессии из хранилища: {len(expired)}")
+        return len(expired)
+
+
+session_vault = SessionVault(SESSIONS_VAULT_FILE)
+
+
+def purge_legacy_session_files():
+    # SQLite-файлы сессий из прежней схемы хранения (session_<hash>.session и журналы) больше не используются
+    if not os.path.isdir(SESSIONS_DIR):
+        return
+    for fname in os.listdir(SESSIONS_DIR):
+        if fname.startswith("session_"):
+            try:
+                os.remove(os.path.join(SESSIONS_DIR, fname))
+                log_session(f"Удален файл сессии старого формата: {fname}")
+            except Exception:
+                log_error("Не удалось удалить файл сессии старого формата:\n" + traceback.format_exc())
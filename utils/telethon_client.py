@@ -1,143 +1,171 @@
 # telethon_client.py — функции для работы с Telethon
 # Изменения: вынесены функции сессий и авторизации из main.py
+# Изменения: список чатов читается лениво через iter_dialogs (без лимита 200) и кэшируется на время сессии
+# Изменения: сессии Telethon — StringSession из зашифрованного хранилища session_vault, без файлов на телефон
+# Изменения: длительность connect/send_code/dialogs и FloodWait пишутся в метрики
+# Изменения: flow выбора чата хранит формат экспорта (по умолчанию — настройка администратора)
+# Изменения: выбор чата — переход FlowState в STATE_CHOOSE_CHAT из шага входа
+# Изменения: telethon_send_code возвращает phone_code_hash, клиент входа можно восстановить из строки сессии
+# Изменения: авторизационные сообщения удаляются в фоне, список чатов отправляется сразу
+# Изменения: список чатов читается через flood_governor — FloodWait выжидается, чтение продолжается с той же страницы
+# Изменения: копия normalize_phone (со сравнением str > 0) удалена — используется исправленная из export_utils
 
-import os
-import re
 import hashlib
-import time
+import traceback
 from typing import Tuple, Optional
 
 from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError, RPCError
-from telethon.tl.types import ChannelParticipantsAdmins
+from telethon.sessions import StringSession
+from telethon.errors import RPCError
 
-from utils.config import API_ID, API_HASH, SESSIONS_DIR
+from utils.config import API_ID, API_HASH, SESSION_TTL_SECONDS, DIALOGS_CACHE_MAX_SESSIONS, pending_action
+from utils.flow_state import start_flow, STATE_PHONE, LOGIN_STATES
 from utils.logging_utils import log_session, log_error
-from utils.user_management import users_data
-from utils.ui_utils import get_user_role, chats_keyboard
-from utils.message_cleanup import purge_auth_messages_for_user
-
-
-def normalize_phone(raw: str) -> str:
-    if not raw:
-        return raw
-    raw = raw.strip()
-    plus_prefixed = raw.startswith("+")
-    digits = re.sub(r"\D", "", raw)
-    if plus_prefixed:
-        return "+" + digits
-    if len(digits) == 11 and digits.startswith("8"):
-        return "+7" + digits[1:]
-    if len(digits) == 11 and digits.startswith("7"):
-        return "+" + digits
-    if len(digits) == 10:
-        return "+7" + digits
-    if digits > 0:
-        return "+" + digits
-    return raw
-
-
-def _session_filename_for_phone(phone: str):
+from utils.ui_utils import get_user_role, main_menu_keyboard, ChatIndex, chat_picker_keyboard
+from utils.message_cleanup import purge_auth_messages_later
+from utils.cache_utils import TTLCache
+from utils.client_pool import release_client
+from utils.session_vault import session_vault
+from utils.export_utils import default_export_format
+from utils.metrics import STAGE_SECONDS, record_flood_wait
+from utils.flood_governor import flood_governor, flood_seconds
+
+
+def _session_key_for_phone(phone: str) -> str:
     h = hashlib.sha256(phone.encode()).hexdigest()
-    session_name = f"session_{h}"
-    # Telethon создает несколько файлов: session_name.session, session_name.session-journal и т.д.
-    session_filepath = os.path.join(SESSIONS_DIR, session_name + ".session")
-    return session_name, session_filepath
+    return f"session_{h}"
+
+
+def new_client(session_key: str) -> TelegramClient:
+    # сохраненная сессия из хранилища или новая пустая
+    return TelegramClient(StringSession(session_vault.get(session_key) or ""), API_ID, API_HASH)
+
+
+def client_from_session_string(session_string: str) -> TelegramClient:
+    # клиент незавершенного входа, восстановленный после перезапуска
+    return TelegramClient(StringSession(session_string), API_ID, API_HASH)
 
 
-async def telethon_send_code(phone: str) -> Tuple[Optional[TelegramClient], Optional[str]]:
+async def store_session(session_key: str, client: TelegramClient):
+    await session_vault.set(session_key, client.session.save())
+
+
+async def telethon_send_code(phone: str) -> Tuple[Optional[TelegramClient], Optional[str], Optional[str]]:
+    # (клиент, ошибка, phone_code_hash)
     if API_ID is None or not API_HASH:
         raise RuntimeError("API_ID/API_HASH не заданы в .env")
 
-    session_name, session_filepath = _session_filename_for_phone(phone)
-    if os.path.exists(session_filepath):
-        return None, "exists"
+    session_key = _session_key_for_phone(phone)
+    if session_key in session_vault:
+        return None, "exists", None
 
-    client = TelegramClient(os.path.join(SESSIONS_DIR, session_name), API_ID, API_HASH)
+    client = new_client(session_key)
     try:
-        await client.connect()
+        with STAGE_SECONDS.time(stage="connect"):
+            await client.connect()
         # send_code_request может вызвать RPCError/FloodWait и т.д.
-        await client.send_code_request(phone)
-        log_session(f"Отправлен запрос кода для телефона {phone} (session={session_filepath})")
-        return client, None
+        with STAGE_SECONDS.time(stage="send_code"):
+            sent = await client.send_code_request(phone)
+        log_session(f"Отправлен запрос кода для телефона {phone} (session={session_key})")
+        return client, None, getattr(sent, "phone_code_hash", None)
     except RPCError as e:
+        record_flood_wait(e, "send_code")
         try:
             await client.disconnect()
         except Exception:
             pass
         log_error("telethon_send_code RPCError:\n" + str(e))
-        return None, str(e)
+        return None, str(e), None
     except Exception as e:
         log_error("telethon_send_code ошибка:\n" + str(e))
         try:
             await client.disconnect()
         except Exception:
             pass
-        return None, "send_code_error"
+        return None, "send_code_error", None
+
+
+# session_key -> ChatIndex групп/каналов аккаунта; живет не дольше самой сессии
+dialogs_cache = TTLCache(SESSION_TTL_SECONDS, DIALOGS_CACHE_MAX_SESSIONS)
+
+
+def _dialog_title(d):
+    title = getattr(d, "title", None) or getattr(d, "name", None)
+    if title:
+        return title
+    try:
+        return getattr(d.entity, "title", None) or getattr(d.entity, "name", None)
+    except Exception:
+        return None
 
 
-async def list_user_chats_and_store(client: TelegramClient, update, user_id: int):
+async def iter_group_dialogs(client: TelegramClient):
+    # iter_dialogs запрашивает диалоги страницами; храним только группы/каналы и только нужные поля,
+    # сами объекты Dialog (с последними сообщениями) не накапливаются
+    async for d in flood_governor.stream(client, "dialogs", client.iter_dialogs(ignore_migrated=True)):
+        if not (getattr(d, "is_group", False) or getattr(d, "is_channel", False)):
+            continue
+        title = _dialog_title(d)
+        if title:
+            yield {"title": title, "id": getattr(d, "id", None), "dialog": d.entity}
+
+
+async def get_chat_index(client: TelegramClient, session_key: str = None) -> ChatIndex:
+    if session_key:
+        cached = dialogs_cache.get(session_key)
+        if cached is not None:
+            return cached
     try:
-        dialogs = await client.get_dialogs(limit=200)
+        with STAGE_SECONDS.time(stage="dialogs"):
+            index = ChatIndex([d async for d in iter_group_dialogs(client)])
+    except RPCError as e:
+        record_flood_wait(e, "dialogs")
+        raise
+    if session_key:
+        dialogs_cache.set(session_key, index)
+    return index
+
+
+async def list_user_chats_and_store(client: TelegramClient, update, user_id: int, session_key: str = None):
+    try:
+        chats = await get_chat_index(client, session_key)
     except Exception as e:
-        log_error("Ошибка в get_dialogs:\n" + str(e))
+        log_error("Ошибка в iter_dialogs:\n" + traceback.format_exc())
+        seconds = flood_seconds(e)
+        text = "Ошибка при получении чатов." if seconds is None else f"Telegram ограничил запросы этого аккаунта на {seconds} с. Повторите позже."
         try:
-            await update.message.reply_text("Ошибка при получении чатов.", reply_markup=main_menu_keyboard(get_user_role(user_id)))
+            await update.message.reply_text(text, reply_markup=main_menu_keyboard(get_user_role(user_id)))
         except Exception:
-            log_error("Не удалось сообщить пользователю об ошибке get_dialogs:\n" + str(e))
+            log_error("Не удалось сообщить пользователю об ошибке получения чатов:\n" + traceback.format_exc())
         return
 
-    dialogs_filtered = []
-    titles = []
-    for d in dialogs:
-        title = None
-        if hasattr(d, "title") and d.title:
-            title = d.title
-        elif hasattr(d, "name") and d.name:
-            title = d.name
-        else:
-            try:
-                title = getattr(d.entity, "title", None) or getattr(d.entity, "name", None)
-            except Exception:
-                title = None
-
-        is_channel = getattr(d, "is_channel", False)
-        is_group = getattr(d, "is_group", False)
-        if (is_group or is_channel) and title:
-            dialogs_filtered.append({"title": title, "id": getattr(d, "id", None), "dialog": d})
-            titles.append(title)
-
-    if not titles:
+    if not len(chats):
         try:
             await update.message.reply_text("⚠️ Не найдено доступных чатов.", reply_markup=main_menu_keyboard(get_user_role(update.effective_user.id)))
         except Exception:
-            log_error("Не удалось ответить 'нет чатов':\n" + str(e))
+            log_error("Не удалось ответить 'нет чатов':\n" + traceback.format_exc())
         try:
-            await client.disconnect()
+            await release_client(client)
         except Exception:
             pass
         return
 
-    from utils.config import pending_action
-    existing = pending_action.get(update.effective_user.id, {})
-    auth_msgs = existing.get("auth_messages", [])
-    # ensure auth_messages present
-    pending_action[update.effective_user.id] = {
-        "action": "choose_chat",
-        "phone": existing.get("phone"),
-        "client": client,
-        "dialogs": dialogs_filtered,
-        "auth_messages": auth_msgs,
-        "start_time": existing.get("start_time", time.time())
-    }
-
-    # попытка удалить авторизационные сообщения (базовая очистка)
+    flow = pending_action.get(user_id)
+    if flow is None or flow.state not in LOGIN_STATES:
+        # flow завершился (истек или отменен), пока шел вход — выбор чата открывается новым flow
+        flow = start_flow(user_id, STATE_PHONE)
+    flow.enter_choose_chat(client, chats, default_export_format())
+
+    # попытка удалить авторизационные сообщения (базовая очистка); список чатов отправляется, не дожидаясь удаления
     try:
-        await purge_auth_messages_for_user(update.effective_user.id)
+        purge_auth_messages_later(update.effective_user.id)
     except Exception:
-        log_error("Не удалось очистить авторизационные сообщения после получения списка чатов:\n" + str(e))
+        log_error("Не удалось очистить авторизационные сообщения после получения списка чатов:\n" + traceback.format_exc())
 
     try:
-        await update.message.reply_text("Выберите чат:", reply_markup=chats_keyboard(titles))
+        await update.message.reply_text(
+            f"Выберите чат ({len(chats)}) или введите часть названия для поиска:",
+            reply_markup=chat_picker_keyboard(flow)
+        )
     except Exception:
-        log_error("Не удалось отправить сообщение со списком чатов:\n" + str(e))
+        log_error("Не удалось отправить сообщение со списком чатов:\n" + traceback.format_exc())
@@ -1,12 +1,19 @@
 # ui_utils.py — утилиты для пользовательского интерфейса
 # Изменения: вынесены функции клавиатур и утилиты нормализации из main.py
+# Изменения: выбор чата через inline-клавиатуру с постраничным выводом и поиском по индексу названий
+# Изменения: под списком чатов — выбор формата файла экспорта, у администратора — кнопка формата по умолчанию
+# Изменения: режим выбора нескольких чатов для пакетного экспорта (книга XLSX или ZIP)
+# Изменения: подписи форматов нормализуются один раз; точное совпадение названия чата — поиск по dict
 
 import re
-from telegram import ReplyKeyboardMarkup
+from bisect import bisect_left
+from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
 
 from utils.config import LABEL_ADD_ADMIN, LABEL_ADD_OPERATOR, LABEL_REMOVE_OPERATOR
-from utils.config import LABEL_LIST_OPERATORS, LABEL_SCAN, LABEL_CANCEL
+from utils.config import LABEL_LIST_OPERATORS, LABEL_SCAN, LABEL_CANCEL, LABEL_EXPORT_FORMAT, CHATS_PAGE_SIZE
 from utils.user_management import get_user_role
+from utils.export_writers import available_formats, format_available, format_label
+from utils.export_utils import BUNDLE_WORKBOOK, BUNDLE_ZIP
 
 
 def main_menu_keyboard(role: str):
@@ -14,7 +21,8 @@ def main_menu_keyboard(role: str):
         return ReplyKeyboardMarkup(
             [
                 [LABEL_ADD_ADMIN, LABEL_ADD_OPERATOR, LABEL_REMOVE_OPERATOR],
-                [LABEL_LIST_OPERATORS, LABEL_SCAN]
+                [LABEL_LIST_OPERATORS, LABEL_SCAN],
+                [LABEL_EXPORT_FORMAT]
             ],
             resize_keyboard=True
         )
@@ -28,10 +36,127 @@ def cancel_keyboard():
     return ReplyKeyboardMarkup([[LABEL_CANCEL]], resize_keyboard=True)
 
 
-def chats_keyboard(chats):
-    buttons = [[chat] for chat in chats[:25]]
-    buttons.append([LABEL_CANCEL])
-    return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
+def export_formats_keyboard():
+    return ReplyKeyboardMarkup([[format_label(f) for f in available_formats()], [LABEL_CANCEL]], resize_keyboard=True)
+
+
+def parse_export_format(text: str):
+    return _EXPORT_FORMAT_KEYS.get(normalize(text))
+
+
+# -----------------------
+# === Выбор чата ===
+# -----------------------
+# callback_data кнопок: "chat:<dialog_id>", "chats:page:<n>", "chats:fmt:<формат>", "chats:cancel",
+# пакетный режим: "chats:batch" (вкл/выкл), "chats:bundle:<workbook|zip>", "chats:run"
+CB_CHAT = "chat:"
+CB_CHATS_PAGE = "chats:page:"
+CB_CHATS_FORMAT = "chats:fmt:"
+CB_CHATS_CANCEL = "chats:cancel"
+CB_CHATS_BATCH = "chats:batch"
+CB_CHATS_BUNDLE = "chats:bundle:"
+CB_CHATS_RUN = "chats:run"
+
+
+class ChatIndex:
+    # Индекс чатов аккаунта: dialog_id -> чат за O(1) и отсортированные нормализованные названия
+    # (целиком и с начала каждого слова) для поиска по префиксу бинарным поиском
+    def __init__(self, chats: list):
+        self.chats = chats
+        self.by_id = {c["id"]: c for c in chats}
+        self.order = [c["id"] for c in chats]
+        self._titles = [(normalize(c["title"]), c["id"]) for c in chats]
+        self._exact = {}
+        for norm, chat_id in self._titles:
+            self._exact.setdefault(norm, []).append(chat_id)
+        entries = []
+        for norm, chat_id in self._titles:
+            for m in re.finditer(r"\S+", norm):
+                entries.append((norm[m.start():], chat_id))
+        entries.sort()
+        self._keys = [k for k, _ in entries]
+        self._ids = [i for _, i in entries]
+
+    def get(self, chat_id):
+        return self.by_id.get(chat_id)
+
+    def exact(self, normalized_title: str) -> list:
+        # dialog_id чатов, нормализованное название которых совпадает целиком
+        return self._exact.get(normalized_title, [])
+
+    def search(self, query: str) -> list:
+        q = normalize(query)
+        if not q:
+            return list(self.order)
+        found = []
+        seen = set()
+        i = bisect_left(self._keys, q)
+        while i < len(self._keys) and self._keys[i].startswith(q):
+            chat_id = self._ids[i]
+            if chat_id not in seen:
+                seen.add(chat_id)
+                found.append(chat_id)
+            i += 1
+        # совпадения внутри слова — после совпадений по началу слова
+        for norm, chat_id in self._titles:
+            if chat_id not in seen and q in norm:
+                seen.add(chat_id)
+                found.append(chat_id)
+        return found
+
+    def __len__(self):
+        return len(self.chats)
+
+
+def chats_inline_keyboard(index: ChatIndex, ids: list, page: int = 0, fmt: str = None, selected: list = None, bundle: str = None):
+    # selected — список выбранных dialog_id в пакетном режиме (None — обычный выбор одного чата)
+    pages = max(1, (len(ids) + CHATS_PAGE_SIZE - 1) // CHATS_PAGE_SIZE)
+    page = min(max(0, page), pages - 1)
+    start = page * CHATS_PAGE_SIZE
+    buttons = []
+    for chat_id in ids[start:start + CHATS_PAGE_SIZE]:
+        chat = index.get(chat_id)
+        if chat is None:
+            continue
+        title = chat["title"] if len(chat["title"]) <= 60 else chat["title"][:57] + "..."
+        if selected is not None:
+            title = ("✅ " if chat_id in selected else "▫️ ") + title
+        buttons.append([InlineKeyboardButton(title, callback_data=f"{CB_CHAT}{chat_id}")])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"{CB_CHATS_PAGE}{page - 1}"))
+    if pages > 1:
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{CB_CHATS_PAGE}{page}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"{CB_CHATS_PAGE}{page + 1}"))
+    if nav:
+        buttons.append(nav)
+    if fmt and not (selected is not None and bundle == BUNDLE_WORKBOOK):
+        buttons.append([
+            InlineKeyboardButton(("✅ " if f == fmt else "") + format_label(f), callback_data=f"{CB_CHATS_FORMAT}{f}")
+            for f in available_formats()
+        ])
+    if selected is None:
+        buttons.append([InlineKeyboardButton("☑️ Несколько чатов", callback_data=CB_CHATS_BATCH)])
+    else:
+        bundles = [(BUNDLE_ZIP, "🗜 ZIP")]
+        if format_available("xlsx"):
+            bundles.insert(0, (BUNDLE_WORKBOOK, "📘 Одна книга XLSX"))
+        buttons.append([
+            InlineKeyboardButton(("✅ " if b == bundle else "") + label, callback_data=f"{CB_CHATS_BUNDLE}{b}")
+            for b, label in bundles
+        ])
+        buttons.append([
+            InlineKeyboardButton("1️⃣ Один чат", callback_data=CB_CHATS_BATCH),
+            InlineKeyboardButton(f"▶️ Выгрузить ({len(selected)})", callback_data=CB_CHATS_RUN),
+        ])
+    buttons.append([InlineKeyboardButton(LABEL_CANCEL, callback_data=CB_CHATS_CANCEL)])
+    return InlineKeyboardMarkup(buttons)
+
+
+def chat_picker_keyboard(flow):
+    # клавиатура выбора чата по FlowState в состоянии choose_chat
+    return chats_inline_keyboard(flow.chats, flow.results, flow.page, flow.format, flow.selected, flow.bundle)
 
 
 # -----------------------
@@ -44,17 +169,24 @@ def normalize(text: str) -> str:
     if t.startswith("/"):
         t = t[1:]
     parts = t.split()
-    return ".join(parts).lower()
+    return " ".join(parts).lower()
 
 
 def is_same_label(text: str, label: str) -> bool:
     return normalize(text) == normalize(label)
 
 
+# ключ формата и нормализованная подпись -> ключ формата (набор форматов известен при импорте)
+_EXPORT_FORMAT_KEYS = {}
+for _fmt in available_formats():
+    _EXPORT_FORMAT_KEYS[_fmt] = _fmt
+    _EXPORT_FORMAT_KEYS[normalize(format_label(_fmt))] = _fmt
+
+
 async def send_main_menu(update, user_id: int):
     role = get_user_role(user_id)
     try:
-        await update.message.reply_text("Возврат в главное меню:", reply_markup=main_menu_keyboard(role))
+        await update.effective_message.reply_text("Возврат в главное меню:", reply_markup=main_menu_keyboard(role))
     except Exception:
         from utils.logging_utils import log_error
         log_error("Не удалось отправить главное меню:\n" + str(locals()))
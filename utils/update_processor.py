@@ -0,0 +1,45 @@
+# update_processor.py — параллельная обработка update с сохранением порядка для каждого пользователя
+# Изменения: update разных пользователей обрабатываются одновременно (ожидание лимитера одного чата не задерживает
+# остальных), update одного пользователя — строго по очереди, как при последовательной обработке
+
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+
+def _update_key(update):
+    # flow и сессии привязаны к пользователю; update без пользователя (например, посты канала) — к чату
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat is not None else None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # ключ -> [asyncio.Lock, число update, ожидающих или занявших блокировку]
+
+    async def do_process_update(self, update, coroutine):
+        key = _update_key(update)
+        if key is None:
+            await coroutine
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._locks.clear()
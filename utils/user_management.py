@@ -1,12 +1,19 @@
 # user_management.py — управление пользователями и шифрование
 # Изменения: вынесены функции управления пользователями из main.py
+# Изменения: роли хранятся в RoleStore (поиск роли за O(1)), запись users.enc атомарная и вне event loop,
+# изменения файла на диске (add_admin.py) подхватываются без перезапуска
+# Изменения: настройки бота (формат экспорта по умолчанию) хранятся в users.enc рядом с ролями
+# Изменения: ошибка чтения или расшифровки users.enc при перезагрузке не сбрасывает роли — остаются прежние
 
 import json
 import os
+import asyncio
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
 
-from utils.config import USERS_FILE, KEY_FILE
+from utils.config import USERS_FILE, KEY_FILE, USERS_RELOAD_INTERVAL_SECONDS
 from utils.logging_utils import log_session, log_error
 
 
@@ -28,48 +35,188 @@ def load_key():
 fernet = Fernet(load_key())
 
 
-def load_users():
+# Запись users.enc идет через один поток: сохранения применяются в том порядке, в котором вызваны
+USERS_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="users-file")
+
+
+def read_users():
+    # отсутствующий или пустой users.enc — пустая структура; ошибка чтения или расшифровки пробрасывается вызывающему
     if not os.path.exists(USERS_FILE):
         # Не создаем файл автоматически при запуске, если его нет
         log_session("users.enc не найден, ожидание создания add_admin.py")
         return {"admins": [], "operators": []}
+    with open(USERS_FILE, "rb") as f:
+        data = f.read()
+    if not data:
+        log_session("users.enc пуст -> создание структуры по умолчанию")
+        return {"admins": [], "operators": []}
+    users = json.loads(fernet.decrypt(data).decode())
+    log_session(f"Загружен users.enc: администраторы={users.get('admins', [])}, операторы={users.get('operators', [])}")
+    return users
+
+
+def load_users():
     try:
-        with open(USERS_FILE, "rb") as f:
-            data = f.read()
-            if not data:
-                log_session("users.enc пуст -> создание структуры по умолчанию")
-                return {"admins": [], "operators": []}
-            try:
-                decoded = fernet.decrypt(data).decode()
-                users = json.loads(decoded)
-                log_session(f"Загружен users.enc: администраторы={users.get('admins', [])}, операторы={users.get('operators', [])}")
-                return users
-            except Exception:
-                # if decryption/parsing fails — log and fallback to safe empty lists
-                log_error("Не удалось расшифровать/разобрать users.enc:\n" + traceback.format_exc())
-                return {"admins": [], "operators": []}
+        return read_users()
     except Exception:
-        log_error("Не удалось прочитать users.enc:\n" + traceback.format_exc())
+        # if reading/decryption/parsing fails — log and fallback to safe empty lists
+        log_error("Не удалось прочитать/расшифровать/разобрать users.enc:\n" + traceback.format_exc())
         return {"admins": [], "operators": []}
 
 
 def save_users(data):
+    # запись во временный файл и атомарная замена: читатель (бот или add_admin.py) не увидит файл наполовину
+    tmp_path = f"{USERS_FILE}.{os.getpid()}.tmp"
     try:
-        with open(USERS_FILE, "wb") as f:
+        os.makedirs(os.path.dirname(USERS_FILE), exist_ok=True)
+        with open(tmp_path, "wb") as f:
             f.write(fernet.encrypt(json.dumps(data).encode()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, USERS_FILE)
         log_session("Сохранен users.enc")
+        return True
     except Exception:
         log_error("Не удалось сохранить users.enc:\n" + traceback.format_exc())
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+
+def _file_stamp(path: str):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+# -----------------------
+# === Хранилище ролей ===
+# -----------------------
+class RoleStore:
+    # admins/operators — dict как упорядоченное множество: проверка за O(1), порядок добавления сохраняется
+    def __init__(self, path: str):
+        self.path = path
+        self.admins = {}
+        self.operators = {}
+        self._extra = {}  # прочие ключи users.enc сохраняются как есть
+        self._stamp = None
+        self._bad_stamp = None  # mtime/размер users.enc, который не удалось прочитать: повторно не читается
+        self._saving = 0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def _apply(self, data: dict):
+        self.admins = dict.fromkeys(int(x) for x in data.get("admins", []))
+        self.operators = dict.fromkeys(int(x) for x in data.get("operators", []))
+        self._extra = {k: v for k, v in data.items() if k not in ("admins", "operators")}
+
+    def snapshot(self) -> dict:
+        return {**self._extra, "admins": list(self.admins), "operators": list(self.operators)}
+
+    def reload(self):
+        stamp = _file_stamp(self.path)
+        self._apply(load_users())
+        self._stamp = stamp
+
+    def _read_if_changed(self):
+        # выполняется в потоке USERS_EXECUTOR: чтение и расшифровка — только если изменились mtime/размер;
+        # ошибка пробрасывается — неудачное чтение не должно выглядеть как файл без ролей
+        stamp = _file_stamp(self.path)
+        if stamp == self._stamp or stamp == self._bad_stamp:
+            return None
+        try:
+            return stamp, read_users()
+        except Exception:
+            self._bad_stamp = stamp
+            raise
+
+    async def reload_if_changed(self) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            changed = await loop.run_in_executor(USERS_EXECUTOR, self._read_if_changed)
+        except Exception as e:
+            # неверный ключ, поврежденный или недоступный файл: текущие роли и _stamp остаются прежними
+            log_error(f"Не удалось перечитать users.enc ({type(e).__name__}), роли не изменены:\n" + str(locals()))
+            return False
+        # пока идет собственная запись, файл на диске может быть старше данных в памяти
+        if changed is None or self._saving:
+            return False
+        self._stamp, data = changed
+        self._apply(data)
+        log_session("users.enc изменен на диске — роли перезагружены")
+        return True
+
+    def role(self, user_id: int):
+        if user_id in self.admins:
+            return "admin"
+        if user_id in self.operators:
+            return "operator"
+        return None
+
+    def operators_list(self) -> list:
+        return list(self.operators)
+
+    def get_setting(self, name: str, default=None):
+        return self._extra.get("settings", {}).get(name, default)
+
+    async def set_setting(self, name: str, value):
+        self._extra = {**self._extra, "settings": {**self._extra.get("settings", {}), name: value}}
+        await self.save()
+
+    def _write(self, data: dict):
+        with self._lock:
+            ok = save_users(data)
+            if ok:
+                self._stamp = _file_stamp(self.path)
+            return ok
+
+    async def save(self) -> bool:
+        # снимок берется в event loop, шифрование и запись — в потоке USERS_EXECUTOR
+        data = self.snapshot()
+        self._saving += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(USERS_EXECUTOR, self._write, data)
+        finally:
+            self._saving -= 1
+
+    async def add_admin(self, user_id: int) -> bool:
+        if user_id in self.admins:
+            return False
+        self.admins[user_id] = None
+        await self.save()
+        return True
+
+    async def add_operator(self, user_id: int) -> bool:
+        if user_id in self.operators:
+            return False
+        self.operators[user_id] = None
+        await self.save()
+        return True
+
+    async def remove_operator(self, user_id: int) -> bool:
+        if user_id not in self.operators:
+            return False
+        del self.operators[user_id]
+        await self.save()
+        return True
+
+    async def watch(self, interval: float = USERS_RELOAD_INTERVAL_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload_if_changed()
+            except Exception:
+                log_error("Ошибка проверки изменений users.enc:\n" + traceback.format_exc())
 
 
 # Загружаем данные пользователей при инициализации
-users_data = load_users()
+role_store = RoleStore(USERS_FILE)
 
 
 def get_user_role(user_id: int):
-    users = users_data
-    if user_id in users.get("admins", []):
-        return "admin"
-    if user_id in users.get("operators", []):
-        return "operator"
-    return None
+    return role_store.role(user_id)